@@ -0,0 +1,183 @@
+# !/usr/bin/env python3
+"""
+Space usage and fragmentation analytics of the image, computed in one
+pass over the FAT (bulk operations on its bytes) and the directory tree
+"""
+import heapq
+
+import fateditor
+
+BAD_CLUSTER = 0x0FFFFFF7
+DEFAULT_TOP = 10
+
+
+def get_size_bucket(length):
+    """
+    Returns (min, max) of the power of two histogram bucket of the length
+    """
+    bucket_min = 1 << (length.bit_length() - 1)
+    return bucket_min, bucket_min * 2 - 1
+
+
+class SpaceReport:
+    def __init__(self, cluster_size, clusters_amount):
+        self.cluster_size = cluster_size
+        self.clusters_amount = clusters_amount
+        self.free_clusters = 0
+        self.bad_clusters = 0
+        self.files = 0
+        self.directories = 0
+        self.fragmented_files = 0
+        self.extents = 0
+        self.slack_bytes = 0
+        self.largest_free_runs = list()
+        self.free_runs_histogram = list()
+        self.most_fragmented_files = list()
+        self.largest_slack_files = list()
+        self.largest_directories = list()
+
+    @property
+    def used_clusters(self):
+        return self.clusters_amount - self.free_clusters - self.bad_clusters
+
+    def to_dict(self):
+        return {
+            "cluster_size": self.cluster_size,
+            "clusters": self.clusters_amount,
+            "free_clusters": self.free_clusters,
+            "used_clusters": self.used_clusters,
+            "bad_clusters": self.bad_clusters,
+            "files": self.files,
+            "directories": self.directories,
+            "fragmented_files": self.fragmented_files,
+            "extents": self.extents,
+            "slack_bytes": self.slack_bytes,
+            "largest_free_runs": [
+                {"first_cluster": start, "clusters": length}
+                for start, length in self.largest_free_runs],
+            "free_runs_histogram": [
+                {"min_clusters": bucket_min, "max_clusters": bucket_max,
+                 "runs": runs, "clusters": clusters}
+                for bucket_min, bucket_max, runs, clusters
+                in self.free_runs_histogram],
+            "most_fragmented_files": [
+                {"path": path, "extents": extents}
+                for extents, path in self.most_fragmented_files],
+            "largest_slack_files": [
+                {"path": path, "slack_bytes": slack}
+                for slack, path in self.largest_slack_files],
+            "largest_directories": [
+                {"path": path, "size_bytes": size, "entries": entries}
+                for size, entries, path in self.largest_directories],
+        }
+
+    def get_report_str(self):
+        lines = [
+            "Clusters: {:d} of {:d} bytes, {:d} used, {:d} free, {:d} bad"
+            .format(self.clusters_amount, self.cluster_size,
+                    self.used_clusters, self.free_clusters,
+                    self.bad_clusters),
+            "Files: {:d}, directories: {:d}, fragmented files: {:d}, "
+            "extents: {:d}".format(self.files, self.directories,
+                                   self.fragmented_files, self.extents),
+            "Slack space: {:d} bytes".format(self.slack_bytes),
+            "Largest free runs (first cluster: clusters):"]
+        lines += ["\t{:d}: {:d}".format(start, length)
+                  for start, length in self.largest_free_runs]
+        lines.append("Free runs histogram (clusters: runs, clusters):")
+        lines += ["\t{:d}-{:d}: {:d}, {:d}".format(*bucket)
+                  for bucket in self.free_runs_histogram]
+        lines.append("Most fragmented files (extents):")
+        lines += ["\t{}: {:d}".format(path, extents)
+                  for extents, path in self.most_fragmented_files]
+        lines.append("Largest slack (bytes):")
+        lines += ["\t{}: {:d}".format(path, slack)
+                  for slack, path in self.largest_slack_files]
+        lines.append("Largest directories (bytes, entries):")
+        lines += ["\t{}: {:d}, {:d}".format(path or "/", size, entries)
+                  for size, entries, path in self.largest_directories]
+        return "\n".join(lines)
+
+
+def _analyze_free_space(report, fat_reader, fat_bytes, top):
+    runs = fat_reader.get_free_cluster_runs(fat_bytes)
+    report.free_clusters = sum(length for _, length in runs)
+    report.largest_free_runs = heapq.nlargest(top, runs,
+                                              key=lambda run: run[1])
+    histogram = dict()
+    for _, length in runs:
+        bucket = get_size_bucket(length)
+        runs_amount, clusters = histogram.get(bucket, (0, 0))
+        histogram[bucket] = (runs_amount + 1, clusters + length)
+    report.free_runs_histogram = [
+        bucket + histogram[bucket] for bucket in sorted(histogram)]
+
+
+def _count_extents(fat, first_cluster):
+    """
+    Returns (extents, clusters) of the chain
+    """
+    extents = 1
+    clusters = 1
+    cluster = first_cluster
+    while clusters <= len(fat):
+        next_cluster = fat[cluster]
+        if not 2 <= next_cluster < len(fat):
+            break
+        if next_cluster != cluster + 1:
+            extents += 1
+        cluster = next_cluster
+        clusters += 1
+    return extents, clusters
+
+
+def analyze(fat_reader, root, top=DEFAULT_TOP):
+    cluster_size = fat_reader.get_cluster_size()
+    report = SpaceReport(cluster_size, fat_reader.get_clusters_amount())
+    fat_bytes = fat_reader.read_fat_bytes(masked=True)
+    fat = fateditor.fat_bytes_to_table(fat_bytes)
+    report.bad_clusters = fat.count(BAD_CLUSTER)
+    _analyze_free_space(report, fat_reader, fat_bytes, top)
+
+    fragmented = list()
+    slack = list()
+    directories = list()
+    # directory -> [recursive size, entries], filled in post-order
+    directory_sizes = dict()
+    stack = [(root, False)]
+    while stack:
+        file, is_visited = stack.pop()
+        if file.is_directory and not is_visited:
+            directory_sizes[id(file)] = [0, len(file.content or ())]
+            stack.append((file, True))
+            stack += [(child, False) for child in file.content or ()]
+            continue
+
+        path = file.get_absolute_path()
+        if file.is_directory:
+            size, entries = directory_sizes.pop(id(file))
+            directories.append((size, entries, path))
+            if file is not root:
+                report.directories += 1
+        else:
+            size = file.size_bytes
+            report.files += 1
+        if file.parent is not None:
+            directory_sizes[id(file.parent)][0] += size
+
+        if file.is_directory or file._start_cluster <= 0:
+            continue
+        extents, clusters = _count_extents(fat, file._start_cluster)
+        report.extents += extents
+        if extents > 1:
+            report.fragmented_files += 1
+            fragmented.append((extents, path))
+        file_slack = max(0, clusters * cluster_size - file.size_bytes)
+        report.slack_bytes += file_slack
+        if file_slack > 0:
+            slack.append((file_slack, path))
+
+    report.most_fragmented_files = heapq.nlargest(top, fragmented)
+    report.largest_slack_files = heapq.nlargest(top, slack)
+    report.largest_directories = heapq.nlargest(top, directories)
+    return report
@@ -0,0 +1,150 @@
+# !/usr/bin/env python3
+import asyncio
+import concurrent.futures
+
+import dirbrowser
+
+DEFAULT_MAX_PENDING = 16
+
+
+def _normalize_path(path):
+    return path.replace("\\", "/").strip("/")
+
+
+class AsyncFat32Reader:
+    """
+    asyncio facade over Fat32Reader: every call to the reader runs on
+    a bounded executor, so the event loop is never blocked by image I/O.
+    Fat32Reader seeks the shared image file, so the calls are serialized
+    by a lock and never run concurrently, even on the given executor with
+    several workers (by default an own single worker one is used).
+    """
+
+    def __init__(self, fat_reader, executor=None,
+                 max_pending=DEFAULT_MAX_PENDING):
+        if max_pending <= 0:
+            raise ValueError("max_pending must be positive!")
+        self._fat_reader = fat_reader
+        self._own_executor = executor is None
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1) if executor is None else executor
+        self._pending = asyncio.Semaphore(max_pending)
+        self._reader_lock = asyncio.Lock()
+        self._root = None
+        self._root_lock = asyncio.Lock()
+
+    async def _run(self, func, *args):
+        async with self._pending, self._reader_lock:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, func, *args)
+
+    async def get_root_directory(self):
+        async with self._root_lock:
+            if self._root is None:
+                self._root = await self._run(
+                    self._fat_reader.get_root_directory)
+        return self._root
+
+    async def _find(self, path, priority=None):
+        root = await self.get_root_directory()
+        name = _normalize_path(path)
+        if not name:
+            return root
+        file = dirbrowser.find(name, source=root, priority=priority)
+        if file is None:
+            raise FileNotFoundError('"' + path + '" not found.')
+        return file
+
+    async def stat(self, path):
+        return await self._find(path)
+
+    async def list_dir(self, path="/"):
+        directory = await self._find(path, priority="directory")
+        if not directory.is_directory:
+            raise NotADirectoryError('"' + path + '" is not a directory.')
+        return list(directory.content)
+
+    async def open(self, path):
+        file = await self._find(path, priority="file")
+        if file.is_directory:
+            raise IsADirectoryError('"' + path + '" is a directory.')
+        return AsyncFileStream(self, file)
+
+    def close(self):
+        if self._own_executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class AsyncFileStream:
+    """
+    Async byte stream over the file content. Content is read one chunk
+    at a time (a run of consecutive clusters up to the read-ahead window
+    of the reader) and only when requested, so a slow consumer never
+    makes the reader run further ahead of it.
+    """
+
+    def __init__(self, async_reader, file):
+        self.file = file
+        self._async_reader = async_reader
+        self._chunks = None
+        self._buffer = b''
+        self._eof = False
+        self._lock = asyncio.Lock()
+
+    def _next_chunk(self):
+        if self._chunks is None:
+            self._chunks = self.file.iter_file_content(
+                self._async_reader._fat_reader)
+        return next(self._chunks, None)
+
+    async def _read_chunk(self):
+        chunk = await self._async_reader._run(self._next_chunk)
+        if chunk is None:
+            self._eof = True
+            return b''
+        return chunk
+
+    async def read(self, size=-1):
+        async with self._lock:
+            if size is None or size < 0:
+                parts = [self._buffer]
+                self._buffer = b''
+                while not self._eof:
+                    parts.append(await self._read_chunk())
+                return b''.join(parts)
+
+            while len(self._buffer) < size and not self._eof:
+                self._buffer += await self._read_chunk()
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+            return data
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        async with self._lock:
+            if self._buffer:
+                data, self._buffer = self._buffer, b''
+                return data
+            while not self._eof:
+                data = await self._read_chunk()
+                if data:
+                    return data
+        raise StopAsyncIteration
+
+    async def close(self):
+        self._eof = True
+        self._buffer = b''
+        self._chunks = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
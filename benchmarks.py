@@ -0,0 +1,290 @@
+# !/usr/bin/env python3
+"""
+Benchmarks of the reader and editor over generated FAT32 images.
+Images are synthesized (sparse) in a work directory, results are written
+as JSON and can be compared with results of another version.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import fateditor
+import fatgen
+
+RESULTS_VERSION = 1
+# timings below are too noisy to be reported as regressions
+MIN_COMPARED_SECONDS = 0.001
+SHAPES = ("deep", "flat", "fragmented", "large")
+
+
+def _build_deep(builder, scale):
+    directory = builder.root
+    for level in range(50 * scale):
+        directory = builder.add_directory(directory, "L{:07d}".format(level),
+                                          "level {:d}".format(level))
+        builder.add_file(directory, "FILE.TXT", "", 100)
+        builder.add_file(directory, "DATA.BIN", "", builder.cluster_size * 3)
+
+
+def _build_flat(builder, scale):
+    directory = builder.add_directory(builder.root, "FLAT")
+    for i in range(5000 * scale):
+        if i % 4 == 0:
+            builder.add_file(directory, "L{:07d}.TXT".format(i),
+                             "long file name {:d}.txt".format(i), 100)
+        else:
+            builder.add_file(directory, "F{:07d}.TXT".format(i), "", 100)
+
+
+def _build_fragmented(builder, scale):
+    builder.add_file(builder.root, "RUNS.BIN", "", 2 * 2 ** 20 * scale,
+                     fragments=64)
+    builder.add_files_interleaved(
+        builder.root, [("FRAG{:04d}.BIN".format(i), "") for i in range(8)],
+        2 * 2 ** 20 * scale)
+
+
+def _build_large(builder, scale):
+    builder.add_file(builder.root, "LARGE.BIN", "", 64 * 2 ** 20 * scale)
+
+
+_SHAPE_BUILDERS = {
+    "deep": _build_deep,
+    "flat": _build_flat,
+    "fragmented": _build_fragmented,
+    "large": _build_large,
+}
+
+
+def generate_image(path, shape, size_bytes, cluster_size=4096, scale=1):
+    with open(path, "w+b") as image_file:
+        builder = fatgen.ImageBuilder(image_file, size_bytes, cluster_size)
+        _SHAPE_BUILDERS[shape](builder, scale)
+        builder.finish()
+
+
+def _measure(function, repeat, setup=None):
+    """
+    Returns best and median time of the function calls and result
+    of the last call. Result of setup (not measured) called before every
+    call is passed to the function.
+    """
+    times = list()
+    result = None
+    for _ in range(repeat):
+        arguments = () if setup is None else (setup(),)
+        start = time.perf_counter()
+        result = function(*arguments)
+        times.append(time.perf_counter() - start)
+    return min(times), statistics.median(times), result
+
+
+def run_shape_benchmark(image_path, work_dir, repeat=3, import_size=2 ** 20):
+    results = dict()
+    with open(image_path, "r+b") as fi:
+        results["open_seconds"], results["open_median_seconds"], f = \
+            _measure(lambda: fateditor.Fat32Editor(fi), repeat)
+
+        def walk(editor):
+            return sum(1 for _ in editor.get_root_directory().iter_tree())
+
+        # every walk parses the tree by a new editor with an empty cache
+        results["tree_walk_seconds"], results["tree_walk_median_seconds"], \
+            results["files"] = _measure(
+                walk, repeat, lambda: fateditor.Fat32Editor(fi))
+
+        files = [file for file in f.get_root_directory().iter_tree()
+                 if not file.is_directory]
+        total_size = sum(file.size_bytes for file in files)
+        extract_path = os.path.join(work_dir, "extracted")
+
+        def extract():
+            for file in files:
+                with open(extract_path, "wb") as system_file:
+                    f.copy_file_content(file, system_file)
+
+        best, median, _ = _measure(extract, repeat)
+        results["extract_mib_per_s"] = _get_mib_per_s(total_size, best)
+        results["extract_median_mib_per_s"] = _get_mib_per_s(total_size,
+                                                             median)
+
+        import_paths = list()
+        for i in range(repeat):
+            import_path = os.path.join(work_dir, "import{:d}.bin".format(i))
+            with open(import_path, "wb") as import_file:
+                import_file.write(os.urandom(import_size))
+            import_paths.append(import_path)
+        root = f.get_root_directory()
+
+        def import_file():
+            f.write_to_image(import_paths.pop(), "", root)
+
+        best, median, _ = _measure(import_file, repeat)
+        results["import_mib_per_s"] = _get_mib_per_s(import_size, best)
+        results["import_median_mib_per_s"] = _get_mib_per_s(import_size,
+                                                            median)
+        f.close()
+
+    # scandisk may repair the image, so it runs on its own handle after
+    # the editor above has written its changes
+    with open(image_path, "r+b") as scan_fi:
+        def scan():
+            with fateditor.Fat32Editor(scan_fi, True,
+                                       silent_scan=True) as editor:
+                editor.scandisk(True, True, True)
+
+        results["scandisk_seconds"], results["scandisk_median_seconds"], _ = \
+            _measure(scan, repeat)
+    return results
+
+
+def _get_mib_per_s(size_bytes, seconds):
+    return size_bytes / 2 ** 20 / seconds if seconds > 0 else 0.0
+
+
+def run_benchmarks(shapes, work_dir, size_bytes, cluster_size=4096, scale=1,
+                   repeat=3, import_size=2 ** 20):
+    results = {
+        "version": RESULTS_VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {
+            "image_size": size_bytes,
+            "cluster_size": cluster_size,
+            "scale": scale,
+            "repeat": repeat,
+            "import_size": import_size
+        },
+        "shapes": dict()
+    }
+    for shape in shapes:
+        image_path = os.path.join(work_dir, shape + ".img")
+        print("Generating {} image...".format(shape))
+        start = time.perf_counter()
+        generate_image(image_path, shape, size_bytes, cluster_size, scale)
+        generate_seconds = time.perf_counter() - start
+        print("Running {} benchmark...".format(shape))
+        shape_results = run_shape_benchmark(image_path, work_dir, repeat,
+                                            import_size)
+        shape_results["generate_seconds"] = generate_seconds
+        results["shapes"][shape] = shape_results
+        os.remove(image_path)
+    return results
+
+
+def compare_results(baseline, current, threshold=10.0):
+    """
+    Returns list of (shape, metric, baseline, current, change in percents,
+    is regression) for metrics present in both results
+    """
+    comparison = list()
+    for shape, metrics in current["shapes"].items():
+        baseline_metrics = baseline["shapes"].get(shape, dict())
+        for metric, value in metrics.items():
+            old_value = baseline_metrics.get(metric)
+            if not old_value or not _is_timing_metric(metric):
+                continue
+            change = (value - old_value) / old_value * 100
+            if metric.endswith("_seconds"):
+                is_regression = change > threshold and \
+                    value >= MIN_COMPARED_SECONDS
+            else:
+                is_regression = change < -threshold
+            comparison.append((shape, metric, old_value, value, change,
+                               is_regression))
+    return comparison
+
+
+def _is_timing_metric(metric):
+    return metric.endswith("_seconds") or metric.endswith("_mib_per_s")
+
+
+def print_results(results):
+    for shape, metrics in results["shapes"].items():
+        print(shape + ":")
+        for metric, value in metrics.items():
+            if isinstance(value, float):
+                print("\t{}: {:.4f}".format(metric, value))
+            else:
+                print("\t{}: {}".format(metric, value))
+
+
+def print_comparison(comparison):
+    for shape, metric, old_value, value, change, is_regression in comparison:
+        print("{}.{}: {:.4f} -> {:.4f} ({:+.1f}%){}".format(
+            shape, metric, old_value, value, change,
+            " REGRESSION" if is_regression else ""))
+
+
+def main():
+    parsed_args = parse_args()
+    work_dir = parsed_args.work_dir or tempfile.mkdtemp(prefix="fat32bench")
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        results = run_benchmarks(parsed_args.shapes, work_dir,
+                                 parsed_args.image_size * 2 ** 20,
+                                 parsed_args.cluster_size, parsed_args.scale,
+                                 parsed_args.repeat,
+                                 parsed_args.import_size * 1024)
+    except ValueError as e:
+        print("Error: " + str(e))
+        return 1
+    finally:
+        if parsed_args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_results(results)
+    if parsed_args.output:
+        with open(parsed_args.output, "w", encoding="utf-8") as output:
+            json.dump(results, output, indent=2)
+    if parsed_args.compare:
+        with open(parsed_args.compare, encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+        comparison = compare_results(baseline, results, parsed_args.threshold)
+        print_comparison(comparison)
+        if any(is_regression for *_, is_regression in comparison):
+            return 1
+    return 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks of the FAT32 reader and editor over "
+                    "generated images")
+    parser.add_argument("--shapes", nargs="+", choices=SHAPES,
+                        default=list(SHAPES),
+                        help="Shapes of the generated images")
+    parser.add_argument("--image-size", type=int, default=512, metavar="MIB",
+                        help="Size of the generated (sparse) images")
+    parser.add_argument("--cluster-size", type=int, default=4096,
+                        choices=[512 * 2 ** i for i in range(8)],
+                        help="Cluster size of the generated images")
+    parser.add_argument("--scale", type=int, default=1,
+                        help="Multiplier of the amount of files, depth "
+                             "and file sizes")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Runs of each measurement, best one is "
+                             "reported")
+    parser.add_argument("--import-size", type=int, default=1024,
+                        metavar="KIB", help="Size of the imported file")
+    parser.add_argument("--work-dir",
+                        help="Directory for the generated images "
+                             "(temporary directory by default)")
+    parser.add_argument("-o", "--output", help="Write JSON results to file")
+    parser.add_argument("--compare", metavar="BASELINE",
+                        help="Compare results with JSON results of "
+                             "another run")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        metavar="PERCENT",
+                        help="Slowdown reported as regression")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,153 @@
+# !/usr/bin/env python3
+from collections import OrderedDict
+
+BYTES_PER_MIB = 2 ** 20
+DEFAULT_CACHE_SIZE = 16 * BYTES_PER_MIB
+
+
+class BlockCache:
+    """
+    Size-bounded LRU cache of image blocks (sectors and clusters).
+    Blocks are evicted least recently used first once the total size
+    of the cached blocks exceeds max_bytes. max_bytes = 0 disables it.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_SIZE):
+        if max_bytes < 0:
+            raise ValueError("Cache size cannot be negative!")
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._blocks = OrderedDict()
+        self._size = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @property
+    def size_bytes(self):
+        return self._size
+
+    def get(self, key):
+        block = self._blocks.get(key)
+        if block is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._blocks.move_to_end(key)
+        return block
+
+    def put(self, key, block):
+        if len(block) > self.max_bytes:
+            return
+        old_block = self._blocks.pop(key, None)
+        if old_block is not None:
+            self._size -= len(old_block)
+        self._blocks[key] = block
+        self._size += len(block)
+        while self._size > self.max_bytes:
+            _, evicted = self._blocks.popitem(last=False)
+            self._size -= len(evicted)
+
+    def update(self, key, offset, data):
+        """
+        Patches cached block (if there is one) with data written at offset
+        """
+        block = self._blocks.get(key)
+        if block is None:
+            return
+        data = data[:len(block) - offset]
+        self._blocks[key] = block[:offset] + data + \
+            block[offset + len(data):]
+
+    def invalidate(self, key):
+        block = self._blocks.pop(key, None)
+        if block is not None:
+            self._size -= len(block)
+
+    def clear(self):
+        self._blocks.clear()
+        self._size = 0
+
+    def namespace(self, name):
+        """
+        Returns view of the cache for one of the images sharing it
+        """
+        return BlockCacheNamespace(self, name)
+
+    def get_stats_str(self):
+        requests = self.hits + self.misses
+        hit_rate = self.hits / requests * 100 if requests else 0
+        return "Block cache: {:d} hits, {:d} misses ({:.2f}% hit rate), " \
+               "{:d} of {:d} bytes used".format(self.hits, self.misses,
+                                                hit_rate, self._size,
+                                                self.max_bytes)
+
+    def __contains__(self, key):
+        return key in self._blocks
+
+    def __len__(self):
+        return len(self._blocks)
+
+
+class BlockCacheNamespace:
+    """
+    Part of the shared BlockCache with its own keys, blocks of all the
+    namespaces compete for the shared size by LRU
+    """
+
+    def __init__(self, cache, name):
+        self.cache = cache
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.cache.enabled
+
+    @property
+    def max_bytes(self):
+        return self.cache.max_bytes
+
+    @property
+    def size_bytes(self):
+        return sum(len(block) for key, block in self.cache._blocks.items()
+                   if key[0] == self.name)
+
+    def get(self, key):
+        block = self.cache.get((self.name, key))
+        if block is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return block
+
+    def put(self, key, block):
+        self.cache.put((self.name, key), block)
+
+    def update(self, key, offset, data):
+        self.cache.update((self.name, key), offset, data)
+
+    def invalidate(self, key):
+        self.cache.invalidate((self.name, key))
+
+    def clear(self):
+        for key in [key for key in self.cache._blocks
+                    if key[0] == self.name]:
+            self.cache.invalidate(key)
+
+    def get_stats_str(self):
+        requests = self.hits + self.misses
+        hit_rate = self.hits / requests * 100 if requests else 0
+        return "Block cache of {}: {:d} hits, {:d} misses ({:.2f}% hit " \
+               "rate), {:d} of {:d} shared bytes used".format(
+                   self.name, self.hits, self.misses, hit_rate,
+                   self.size_bytes, self.max_bytes)
+
+    def __contains__(self, key):
+        return (self.name, key) in self.cache
+
+    def __len__(self):
+        return sum(1 for key in self.cache._blocks if key[0] == self.name)
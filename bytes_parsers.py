@@ -5,6 +5,23 @@ from datetime import datetime, date, time
 
 DEBUG_MODE = False
 
+ASCII_REPLACEMENT_CHAR = '\u2592'
+
+
+def get_ascii_replace_errors_table(replacement=ASCII_REPLACEMENT_CHAR):
+    """
+    Returns str.translate table for latin-1 decoded text which replaces
+    all non-ASCII characters with replacement
+    """
+    return {code: replacement for code in range(128, 256)}
+
+
+ASCII_REPLACE_ERRORS_TABLE = get_ascii_replace_errors_table()
+
+
+def decode_ascii_replace_errors(bytes_, table=ASCII_REPLACE_ERRORS_TABLE):
+    return bytes_.decode("latin-1").translate(table)
+
 
 def debug(message):
     if DEBUG_MODE:
@@ -30,9 +47,12 @@ class BytesParser:
                                                     errors=errors)
 
     def parse_ascii_string_replace_errors(self, start, length,
-                                          replacement='\u2592'):
-        return ''.join(chr(byte) if byte in range(128) else replacement
-                       for byte in self.get_bytes(start, length))
+                                          replacement=ASCII_REPLACEMENT_CHAR):
+        table = ASCII_REPLACE_ERRORS_TABLE \
+            if replacement == ASCII_REPLACEMENT_CHAR else \
+            get_ascii_replace_errors_table(replacement)
+        return decode_ascii_replace_errors(self.get_bytes(start, length),
+                                           table)
 
     def parse_time_date(self, start):
         parsed_time = self.parse_time(start)
@@ -145,3 +165,21 @@ def time_to_bits(time):
     result = hour_bin + minute_bin + seconds_bin
     debug("time_to_bits: " + result)
     return result
+
+
+def date_to_int(date_):
+    return ((date_.year - 1980) & 0x7F) << 9 | date_.month << 5 | date_.day
+
+
+def time_to_int(time_):
+    return time_.hour << 11 | time_.minute << 5 | time_.second // 2
+
+
+def int_to_date(value):
+    return date(year=1980 + (value >> 9), month=(value >> 5) & 0x0F,
+                day=value & 0x1F)
+
+
+def int_to_time(value):
+    return time(hour=value >> 11, minute=(value >> 5) & 0x3F,
+                second=(value & 0x1F) * 2)
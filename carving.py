@@ -0,0 +1,224 @@
+# !/usr/bin/env python3
+"""
+Carving of the files left in the free clusters of the image by their
+signatures. Only runs of free clusters (read from the FAT) are scanned:
+the image is mapped with mmap, headers of all the known formats are
+matched by one regular expression at the cluster starts and footers are
+searched limited to the run (pos/endpos), so the pages of the used
+clusters are never read. A file is carved up to its footer found in the
+same run of free clusters. Ranges of clusters are scanned in a process
+pool, every process maps the image by itself.
+"""
+import concurrent.futures
+import mmap
+import os
+import re
+
+DEFAULT_WORKERS = min(8, os.cpu_count() or 1)
+# free clusters scanned by one task of the pool
+TASK_CLUSTERS = 2 ** 16
+READ_CHUNK_SIZE = 2 ** 20
+
+
+class Signature:
+    def __init__(self, name, extension, header, footer, max_size):
+        self.name = name
+        self.extension = extension
+        self.header = header
+        # regular expression matching the end of the file
+        self.footer = re.compile(footer, re.DOTALL)
+        self.max_size = max_size
+
+
+SIGNATURES = [
+    Signature("jpeg", "jpg", b'\xff\xd8\xff[\xc0-\xfe]', b'\xff\xd9',
+              64 * 2 ** 20),
+    Signature("png", "png", b'\x89PNG\r\n\x1a\n', b'IEND\xae\x42\x60\x82',
+              64 * 2 ** 20),
+    Signature("pdf", "pdf", b'%PDF-1\\.[0-9]', b'%%EOF\r?\n?',
+              256 * 2 ** 20),
+    # end of central directory record without archive comment
+    Signature("zip", "zip", b'PK\x03\x04', b'PK\x05\x06.{16}\x00\x00',
+              2 ** 30),
+]
+
+
+def get_headers_pattern(signatures):
+    """
+    Returns regular expression matching headers of all the signatures,
+    lastindex of the match is the number of the signature plus one
+    """
+    return re.compile(b'|'.join(b'(' + signature.header + b')'
+                                for signature in signatures), re.DOTALL)
+
+
+class CarvedFile:
+    def __init__(self, signature_name, extension, offset, size,
+                 first_cluster):
+        self.signature_name = signature_name
+        self.extension = extension
+        self.offset = offset
+        self.size = size
+        self.first_cluster = first_cluster
+        # host path of the extracted file
+        self.output_path = None
+
+    @property
+    def file_name(self):
+        return "f{:08d}.{}".format(self.first_cluster, self.extension)
+
+    def to_dict(self):
+        return {
+            "type": self.signature_name,
+            "first_cluster": self.first_cluster,
+            "offset": self.offset,
+            "size": self.size,
+            "output_path": self.output_path,
+        }
+
+
+class CarveReport:
+    def __init__(self):
+        self.files = list()
+        self.scanned_clusters = 0
+        # headers without footer in the same run of free clusters
+        self.unterminated = 0
+
+    @property
+    def carved_bytes(self):
+        return sum(file.size for file in self.files)
+
+    def to_dict(self):
+        return {
+            "files": [file.to_dict() for file in self.files],
+            "scanned_clusters": self.scanned_clusters,
+            "carved_bytes": self.carved_bytes,
+            "unterminated": self.unterminated,
+        }
+
+    def get_report_str(self):
+        lines = ["{:<5} {:>10} {:>12} {}".format(
+            file.signature_name, file.first_cluster, file.size,
+            file.output_path or file.file_name) for file in self.files]
+        lines.append("Carved files: {:d} ({:d} bytes), headers without "
+                     "footer: {:d}, free clusters scanned: {:d}".format(
+                         len(self.files), self.carved_bytes,
+                         self.unterminated, self.scanned_clusters))
+        return "\n".join(lines)
+
+
+def split_runs(runs, task_clusters=TASK_CLUSTERS):
+    """
+    Splits (first cluster, clusters amount) runs of free clusters to tasks,
+    every task is list of (first cluster, clusters amount, end cluster
+    of the run) of at most task_clusters clusters in total
+    """
+    tasks = list()
+    task = list()
+    task_size = 0
+    for first_cluster, amount in runs:
+        run_end = first_cluster + amount
+        while first_cluster < run_end:
+            part = min(run_end - first_cluster, task_clusters - task_size)
+            task.append((first_cluster, part, run_end))
+            task_size += part
+            first_cluster += part
+            if task_size == task_clusters:
+                tasks.append(task)
+                task = list()
+                task_size = 0
+    if task:
+        tasks.append(task)
+    return tasks
+
+
+def _carve_ranges(image_path, data_area_start, cluster_size, ranges,
+                  signatures):
+    """
+    Returns (list of (signature number, offset, size), unterminated) of
+    the files with headers in the cluster ranges of one task
+    """
+    def get_offset(cluster):
+        return data_area_start + (cluster - 2) * cluster_size
+
+    headers = get_headers_pattern(signatures)
+    found = list()
+    unterminated = 0
+    with open(image_path, "rb") as image, \
+            mmap.mmap(image.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for first_cluster, amount, run_end in ranges:
+            run_end = min(get_offset(run_end), len(data))
+            cluster = first_cluster
+            while cluster < first_cluster + amount:
+                start = get_offset(cluster)
+                cluster += 1
+                match = headers.match(data, start, run_end)
+                if match is None:
+                    continue
+                number = match.lastindex - 1
+                signature = signatures[number]
+                footer = signature.footer.search(
+                    data, match.end(),
+                    min(run_end, start + signature.max_size))
+                if footer is None:
+                    unterminated += 1
+                    continue
+                found.append((number, start, footer.end() - start))
+                # files embedded into the carved one are not carved
+                cluster = max(cluster, 2 + -(-(footer.end() -
+                                               data_area_start) //
+                                             cluster_size))
+    return found, unterminated
+
+
+def carve(fat_reader, image_path, output_dir=None,
+          workers=DEFAULT_WORKERS, signatures=SIGNATURES):
+    """
+    Returns CarveReport of the files found in the free clusters of the
+    image opened by fat_reader, writes them to output_dir if it is given
+    """
+    fat_reader._fat_image_file.flush()
+    cluster_size = fat_reader.get_cluster_size()
+    data_area_start = fat_reader.get_cluster_offset(2)
+    runs = fat_reader.get_free_cluster_runs()
+    report = CarveReport()
+    report.scanned_clusters = sum(amount for _, amount in runs)
+
+    found = list()
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(_carve_ranges, image_path,
+                                   data_area_start, cluster_size, task,
+                                   signatures)
+                   for task in split_runs(runs)]
+        for future in futures:
+            task_found, unterminated = future.result()
+            found += task_found
+            report.unterminated += unterminated
+    # a file may run from the clusters of one task into another one
+    end = 0
+    for number, offset, size in sorted(found, key=lambda item: item[1]):
+        if offset < end:
+            continue
+        end = offset + size
+        signature = signatures[number]
+        report.files.append(CarvedFile(
+            signature.name, signature.extension, offset, size,
+            (offset - data_area_start) // cluster_size + 2))
+
+    if output_dir is not None:
+        extract(fat_reader, report, output_dir)
+    return report
+
+
+def extract(fat_reader, report, output_dir):
+    """
+    Writes carved files of the report to the directory
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    for file in report.files:
+        file.output_path = os.path.join(output_dir, file.file_name)
+        with open(file.output_path, "wb") as output:
+            for start in range(0, file.size, READ_CHUNK_SIZE):
+                output.write(fat_reader.read_at(
+                    file.offset + start,
+                    min(READ_CHUNK_SIZE, file.size - start)))
@@ -0,0 +1,299 @@
+# !/usr/bin/env python3
+"""
+Defragmentation of FAT32 images: cluster chains of files and directories
+are moved into contiguous free runs.
+
+Every chain is moved so that the image stays consistent if the process
+is interrupted: content is copied to free clusters, the new chain is
+linked in the FAT, then the chain is switched with a single write (the
+directory entry or the FAT entry of the last cluster kept in place)
+and only after that the old clusters are freed. Interrupted move leaves
+lost clusters at most, which are freed by the lost clusters scan.
+"""
+import struct
+
+import fateditor
+
+CLUSTER_MASK = 0x0FFFFFFF
+FAT_EOF = 0x0FFFFFFF
+# clusters copied with one read and one write
+COPY_CHUNK_CLUSTERS = 256
+
+_DOT_ENTRY_NAME = b'.          '
+_DOT_DOT_ENTRY_NAME = b'..         '
+
+
+class FragmentationReport:
+    def __init__(self):
+        self.chains = 0
+        self.fragmented_chains = 0
+        self.extents = 0
+        self.clusters = 0
+
+    @property
+    def ratio(self):
+        """
+        Part of the chains consisting of more than one extent
+        """
+        return self.fragmented_chains / self.chains if self.chains else 0.0
+
+    def add_chain(self, extents):
+        self.chains += 1
+        self.extents += len(extents)
+        self.clusters += sum(length for _, length in extents)
+        if len(extents) > 1:
+            self.fragmented_chains += 1
+
+    def get_stats_str(self):
+        return "{:d} of {:d} chains fragmented ({:.2f}%), {:d} extents, " \
+               "{:d} clusters".format(self.fragmented_chains, self.chains,
+                                      self.ratio * 100, self.extents,
+                                      self.clusters)
+
+
+class _FreeRuns:
+    """
+    Runs of free clusters, adjacent runs are merged when freed
+    """
+
+    def __init__(self, runs):
+        self._runs = dict()
+        self._ends = dict()
+        for start, length in runs:
+            self._add(start, length)
+
+    def _add(self, start, length):
+        self._runs[start] = length
+        self._ends[start + length] = start
+
+    def length_at(self, start):
+        return self._runs.get(start, 0)
+
+    def find_best(self, length):
+        """
+        Returns start of the smallest run fitting length clusters or None
+        """
+        best = None
+        for start, run_length in self._runs.items():
+            if run_length >= length and \
+                    (best is None or run_length < self._runs[best]):
+                best = start
+                if run_length == length:
+                    break
+        return best
+
+    def take(self, start, length):
+        run_length = self._runs.pop(start)
+        del self._ends[start + run_length]
+        if run_length > length:
+            self._add(start + length, run_length - length)
+
+    def free(self, start, length):
+        if start in self._ends:
+            previous_start = self._ends.pop(start)
+            length += self._runs.pop(previous_start)
+            start = previous_start
+        end = start + length
+        if end in self._runs:
+            next_length = self._runs.pop(end)
+            del self._ends[end + next_length]
+            length += next_length
+        self._add(start, length)
+
+
+def _iter_chain_owners(root):
+    """
+    Yields files and directories having content, content of the directory
+    goes before the directory itself
+    """
+    stack = [(root, False)]
+    while stack:
+        file, is_visited = stack.pop()
+        if file.is_directory and not is_visited:
+            stack.append((file, True))
+            for child in reversed(file.content or ()):
+                stack.append((child, False))
+        elif file._start_cluster > 0:
+            yield file
+
+
+class Defragmenter:
+    def __init__(self, fat_editor):
+        self._editor = fat_editor
+        fat = fat_editor.read_fat_bytes(masked=True)
+        self._fat = fateditor.fat_bytes_to_table(fat)
+        self._free_runs = _FreeRuns(fat_editor.get_free_cluster_runs(fat))
+        # id of file -> first cluster of the moved chain, the tree itself
+        # is not changed by the dry run
+        self._planned_starts = dict()
+        self.moved_chains = 0
+        self.moved_clusters = 0
+        self.skipped_chains = 0
+        # the root directory is fragmented, but only its first extent may
+        # be continued in place: its cluster is stored in the boot sector
+        self.root_skipped = False
+
+    def _get_start_cluster(self, file):
+        return self._planned_starts.get(id(file), file._start_cluster)
+
+    def _get_chain(self, first_cluster):
+        chain = [first_cluster]
+        cluster = first_cluster
+        while len(chain) < len(self._fat):
+            cluster = self._fat[cluster] & CLUSTER_MASK
+            if not 2 <= cluster < len(self._fat):
+                break
+            chain.append(cluster)
+        return chain
+
+    def get_fragmentation(self, root):
+        report = FragmentationReport()
+        for file in _iter_chain_owners(root):
+            report.add_chain(fateditor.get_runs(
+                self._get_chain(self._get_start_cluster(file))))
+        return report
+
+    def defragment(self, root, dry_run=False):
+        """
+        Moves fragmented chains of the tree, with dry_run moves are only
+        planned (and counted) without writing to the image or changing
+        the tree
+        """
+        for file in _iter_chain_owners(root):
+            chain = self._get_chain(self._get_start_cluster(file))
+            move = self._plan_move(file, chain)
+            if move is None:
+                continue
+            kept_clusters, new_start = move
+            if not dry_run:
+                with self._editor.operation():
+                    self._move_chain(file, chain, kept_clusters, new_start)
+            self._update_fat_table(chain, kept_clusters, new_start)
+            if kept_clusters == 0:
+                if dry_run:
+                    self._planned_starts[id(file)] = new_start
+                else:
+                    file._start_cluster = new_start
+            self.moved_chains += 1
+            self.moved_clusters += len(chain) - kept_clusters
+
+    def _plan_move(self, file, chain):
+        """
+        Returns (amount of clusters kept in place, first cluster of the
+        new run) or None if the chain is not moved. Chains whose first
+        extent can be continued in place are completed after it,
+        others are moved to the smallest free run they fit.
+        """
+        runs = fateditor.get_runs(chain)
+        if len(runs) == 1:
+            return None
+        first_start, first_length = runs[0]
+        tail_length = len(chain) - first_length
+        if self._free_runs.length_at(first_start + first_length) >= \
+                tail_length:
+            self._free_runs.take(first_start + first_length, tail_length)
+            return first_length, first_start + first_length
+        if file.parent is None:
+            self.root_skipped = True
+            return None
+        new_start = self._free_runs.find_best(len(chain))
+        if new_start is None:
+            self.skipped_chains += 1
+            return None
+        self._free_runs.take(new_start, len(chain))
+        return 0, new_start
+
+    def _update_fat_table(self, chain, kept_clusters, new_start):
+        moved = chain[kept_clusters:]
+        new_end = new_start + len(moved)
+        for cluster in range(new_start, new_end - 1):
+            self._fat[cluster] = cluster + 1
+        self._fat[new_end - 1] = FAT_EOF
+        if kept_clusters > 0:
+            self._fat[chain[kept_clusters - 1]] = new_start
+        for cluster in moved:
+            self._fat[cluster] = 0
+        for start, length in fateditor.get_runs(sorted(moved)):
+            self._free_runs.free(start, length)
+
+    def _move_chain(self, file, chain, kept_clusters, new_start):
+        editor = self._editor
+        moved = chain[kept_clusters:]
+        new_clusters = range(new_start, new_start + len(moved))
+
+        # copy content to the free clusters
+        position = 0
+        for start, length in fateditor.get_runs(moved):
+            for chunk_start in range(0, length, COPY_CHUNK_CLUSTERS):
+                chunk_length = min(COPY_CHUNK_CLUSTERS, length - chunk_start)
+                data = editor._get_cluster_run_data(start + chunk_start,
+                                                    chunk_length)
+                if position == 0 and kept_clusters == 0 and \
+                        file.is_directory and \
+                        data[:len(_DOT_ENTRY_NAME)] == _DOT_ENTRY_NAME:
+                    data = bytearray(data)
+                    _set_entry_cluster(data, new_start)
+                    data = bytes(data)
+                editor._write_content_to_image(
+                    editor.get_cluster_offset(new_clusters[position]), data)
+                position += chunk_length
+
+        # link the new chain, then switch the file to it
+        editor._write_fat_values(new_start,
+                                 list(new_clusters[1:]) + [FAT_EOF])
+        if kept_clusters > 0:
+            editor._write_fat_values(chain[kept_clusters - 1], [new_start])
+        else:
+            self._write_entry_cluster(file._entry_start, new_start)
+
+        if file.is_directory:
+            self._relocate_directory_content(file, moved, new_start,
+                                             kept_clusters == 0)
+
+        for start, length in fateditor.get_runs(moved):
+            editor._write_fat_values(start, [0] * length)
+
+    def _relocate_directory_content(self, directory, moved, new_start,
+                                    is_start_moved):
+        cluster_size = self._editor.get_cluster_size()
+        new_clusters = dict(zip(moved, range(new_start,
+                                             new_start + len(moved))))
+        for file in directory.content:
+            cluster = (file._entry_start - self._editor._data_area_start) \
+                // cluster_size + 2
+            if cluster in new_clusters:
+                file._entry_start += (new_clusters[cluster] - cluster) * \
+                    cluster_size
+            if is_start_moved and file.is_directory and \
+                    file._start_cluster > 0:
+                self._write_entry_cluster(
+                    self._editor.get_cluster_offset(file._start_cluster)
+                    + fateditor.BYTES_PER_DIR_ENTRY, new_start,
+                    _DOT_DOT_ENTRY_NAME)
+
+    def _write_entry_cluster(self, entry_start, cluster, expected_name=None):
+        image_file = self._editor._fat_image_file
+        image_file.seek(entry_start)
+        entry = bytearray(image_file.read(fateditor.BYTES_PER_DIR_ENTRY))
+        if expected_name is not None and \
+                entry[:len(expected_name)] != expected_name:
+            return
+        _set_entry_cluster(entry, cluster)
+        self._editor._write_content_to_image(entry_start, bytes(entry))
+
+
+def _set_entry_cluster(entry, cluster):
+    struct.pack_into('<H', entry, 20, cluster >> 16)
+    struct.pack_into('<H', entry, 26, cluster & 0xFFFF)
+
+
+def defragment(fat_editor, root, dry_run=False):
+    """
+    Defragments the image, returns fragmentation reports before and after
+    and the defragmenter with the amount of moved chains and clusters
+    """
+    defragmenter = Defragmenter(fat_editor)
+    before = defragmenter.get_fragmentation(root)
+    defragmenter.defragment(root, dry_run)
+    after = defragmenter.get_fragmentation(root)
+    return before, after, defragmenter
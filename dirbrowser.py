@@ -1,19 +1,35 @@
 # !/usr/bin/env python3
+import codecs
+import csv
+import datetime
+import json
 import os
 import platform
 import re
+import shlex
 import shutil
 import subprocess
+import sys
 
+import bytes_parsers
 import fsobjects
-from bytes_parsers import BytesParser
+import nameindex
 
-HEX_COMMAND_USAGE = 'hex <file> <line length>'
+HEX_COMMAND_USAGE = 'hex <file> <line length> [options]'
 CP_TO_EXT_USAGE = "copyToExternal <image path> <external path>"
 TYPE_USAGE = 'type [encoding (ascii by default)] <file>'
+SEARCH_USAGE = 'search <pattern> [options]'
 
 DATETIME_FORMAT = "%d.%m.%Y %H:%M:%S"
 
+OUTPUT_BUFFER_SIZE = 2 ** 16
+
+DIR_OUTPUT_TEXT = "text"
+DIR_OUTPUT_NDJSON = "ndjson"
+DIR_OUTPUT_CSV = "csv"
+DIR_CSV_COLUMNS = ["path", "short_name", "type", "size", "attributes",
+                   "created", "modified", "accessed", "first_cluster"]
+
 
 def dispose_temp_files():
     if os.path.isdir("temp"):
@@ -71,17 +87,264 @@ def _is_valid_char_for_file_name(char):
     return ord(char) > 31 and char not in _PROHIBITED_NAME_CHARS
 
 
-def print_dir_content(directory, names_only, recursive):
-    for file in directory.content:
-        if names_only:
-            print(file.name)
+class OutputBuffer:
+    """
+    Collects output and writes it to stdout in large chunks
+    """
+
+    def __init__(self, buffer_size=OUTPUT_BUFFER_SIZE):
+        self._buffer_size = buffer_size
+        self._parts = list()
+        self._size = 0
+
+    def write(self, s):
+        self._parts.append(s)
+        self._size += len(s)
+        if self._size >= self._buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._parts:
+            sys.stdout.write("".join(self._parts))
+            self._parts.clear()
+            self._size = 0
+
+
+class _CachedDateFormatter:
+    """
+    Formats raw FAT dates and times, identical values are formatted once
+    """
+
+    def __init__(self):
+        self._cache = dict()
+
+    def format_datetime(self, date_value, time_value, fmt=None):
+        key = (date_value, time_value, fmt)
+        formatted = self._cache.get(key)
+        if formatted is None:
+            date_time = fsobjects.decode_datetime(date_value, time_value)
+            formatted = self._cache[key] = date_time.strftime(fmt) \
+                if fmt else date_time.isoformat()
+        return formatted
+
+    def format_date(self, date_value):
+        key = (date_value, None, None)
+        formatted = self._cache.get(key)
+        if formatted is None:
+            formatted = self._cache[key] = \
+                fsobjects.decode_date(date_value).isoformat()
+        return formatted
+
+
+def _get_file_record(file, dates):
+    return {
+        "path": file.get_absolute_path(),
+        "short_name": file.short_name,
+        "type": "directory" if file.is_directory else "file",
+        "size": file._size_bytes,
+        "attributes": file.attributes,
+        "created": dates.format_datetime(file._create_date,
+                                         file._create_time),
+        "modified": dates.format_datetime(file._change_date,
+                                          file._change_time),
+        "accessed": dates.format_date(file._last_open_date),
+        "first_cluster": file._start_cluster
+    }
+
+
+def print_dir_content(directory, names_only, recursive,
+                      output_format=DIR_OUTPUT_TEXT):
+    output = OutputBuffer()
+    dates = _CachedDateFormatter()
+    csv_writer = None
+    if output_format == DIR_OUTPUT_CSV:
+        csv_writer = csv.DictWriter(output, DIR_CSV_COLUMNS,
+                                    lineterminator="\n")
+        csv_writer.writeheader()
+
+    for file in directory.iter_tree(recursive):
+        if output_format == DIR_OUTPUT_NDJSON:
+            output.write(json.dumps(_get_file_record(file, dates),
+                                    ensure_ascii=False) + "\n")
+        elif csv_writer is not None:
+            csv_writer.writerow(_get_file_record(file, dates))
+        elif names_only:
+            output.write(file.name + "\n")
         else:
-            print(
-                file.change_datetime.strftime(DATETIME_FORMAT) + "    " +
+            output.write(
+                dates.format_datetime(file._change_date, file._change_time,
+                                      DATETIME_FORMAT) + "    " +
                 ("directory    " if file.is_directory else "   file      ")
-                + file.name)
-        if file.is_directory and recursive:
-            print_dir_content(file, names_only, recursive)
+                + file.name + "\n")
+    output.flush()
+
+
+def iter_hex_blocks(chunks, line_len):
+    """
+    Formats stream of byte chunks as hex lines of line_len bytes,
+    yields one text block per chunk
+    """
+    tail = b''
+    for chunk in chunks:
+        if tail:
+            chunk = tail + chunk
+        full_lines_end = len(chunk) - len(chunk) % line_len
+        tail = chunk[full_lines_end:]
+        if full_lines_end:
+            yield '\n'.join(chunk[start:start + line_len].hex(' ')
+                            for start in
+                            range(0, full_lines_end, line_len)) + '\n'
+    if tail:
+        yield tail.hex(' ') + '\n'
+
+
+_hex_option_regex = re.compile(r"\s+--(offset|length|head|tail)\s+(\S+)")
+
+
+def _parse_hex_options(args):
+    options = dict()
+
+    def parse_option(match):
+        try:
+            value = int(match.group(2), 0)
+        except ValueError as e:
+            raise DirectoryBrowserError(
+                "--" + match.group(1) + " format error: " + str(e))
+        if value < 0:
+            raise DirectoryBrowserError(
+                "--" + match.group(1) + " cannot be negative!")
+        options[match.group(1)] = value
+        return ""
+
+    return _hex_option_regex.sub(parse_option, args), options
+
+
+def get_hex_range(size, line_len, offset=0, length=None, head=None,
+                  tail=None):
+    """
+    Returns (offset, length) of the file part to print in hex
+    """
+    start = min(offset, size)
+    end = size if length is None else min(size, start + length)
+    if tail is not None:
+        lines = -(-(end - start) // line_len)
+        start += max(0, lines - tail) * line_len
+    if head is not None:
+        end = min(end, start + head * line_len)
+    return start, end - start
+
+
+def iter_decoded_text(chunks, encoding=None):
+    """
+    Decodes stream of byte chunks, chunks are decoded as ASCII with
+    non-ASCII bytes replaced if encoding is None
+    """
+    if encoding is None:
+        for chunk in chunks:
+            yield bytes_parsers.decode_ascii_replace_errors(chunk)
+        return
+    decoder = codecs.getincrementaldecoder(encoding)(errors="strict")
+    for chunk in chunks:
+        yield decoder.decode(chunk)
+    yield decoder.decode(b'', final=True)
+
+
+_ATTRIBUTE_LETTERS = {
+    'r': fsobjects.READ_ONLY,
+    'h': fsobjects.HIDDEN,
+    's': fsobjects.SYSTEM,
+    'v': fsobjects.VOLUME_ID,
+    'd': fsobjects.DIRECTORY,
+    'a': fsobjects.ARCHIVE
+}
+
+
+def _parse_search_date(value):
+    try:
+        return datetime.datetime.strptime(value, "%d.%m.%Y").date()
+    except ValueError:
+        raise DirectoryBrowserError(
+            'Wrong date "' + value + '", expected dd.mm.yyyy')
+
+
+def _parse_search_size(value):
+    try:
+        size = int(value, 0)
+    except ValueError:
+        raise DirectoryBrowserError('Wrong size "' + value + '"')
+    if size < 0:
+        raise DirectoryBrowserError("Size cannot be negative!")
+    return size
+
+
+def _parse_search_attributes(value):
+    attributes = 0
+    for letter in value.lower():
+        if letter not in _ATTRIBUTE_LETTERS:
+            raise DirectoryBrowserError('Unknown attribute "' + letter + '"')
+        attributes |= _ATTRIBUTE_LETTERS[letter]
+    return attributes
+
+
+def parse_search_args(args):
+    """
+    Returns (pattern, is regex, filter) parsed from search command args
+    """
+    try:
+        tokens = shlex.split(args)
+    except ValueError as e:
+        raise DirectoryBrowserError(str(e))
+
+    pattern = None
+    regex = False
+    filters = list()
+    options = {
+        "--min-size": (_parse_search_size,
+                       lambda size: lambda file: not file.is_directory and
+                       file.size_bytes >= size),
+        "--max-size": (_parse_search_size,
+                       lambda size: lambda file: not file.is_directory and
+                       file.size_bytes <= size),
+        "--after": (_parse_search_date,
+                    lambda date: lambda file: file._change_date >=
+                    bytes_parsers.date_to_int(date)),
+        "--before": (_parse_search_date,
+                     lambda date: lambda file: file._change_date <=
+                     bytes_parsers.date_to_int(date)),
+        "--attr": (_parse_search_attributes,
+                   lambda attrs: lambda file: file.attributes & attrs == attrs)
+    }
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if token == "--regex":
+            regex = True
+        elif token in options:
+            if i + 1 >= len(tokens):
+                raise DirectoryBrowserError(token + " requires a value")
+            parse, make_filter = options[token]
+            filters.append(make_filter(parse(tokens[i + 1])))
+            i += 1
+        elif pattern is None:
+            pattern = token
+        else:
+            raise DirectoryBrowserError("Usage: " + SEARCH_USAGE)
+        i += 1
+    if pattern is None:
+        raise DirectoryBrowserError("Usage: " + SEARCH_USAGE)
+
+    def filter_(file):
+        return all(f(file) for f in filters)
+
+    return pattern, regex, filter_
+
+
+def _is_inside(file, directory):
+    while file is not None:
+        if file is directory:
+            return True
+        file = file.parent
+    return False
 
 
 def print_dir_help():
@@ -89,7 +352,9 @@ def print_dir_help():
         "dir - prints the content of current directory\n"
         "   /b - print only file names\n"
         "   /s - print files of directory and all"
-        " its subdirectories.\n")
+        " its subdirectories.\n"
+        "   /j - print files as JSON lines (NDJSON)\n"
+        "   /c - print files as CSV\n")
 
 
 def save_file_at_external(file, path, fat_reader):
@@ -104,11 +369,9 @@ def save_file_at_external(file, path, fat_reader):
             save_file_at_external(dir_file, path + "/" + dir_file.name,
                                   fat_reader)
     else:
-        file_content = file.get_file_content(fat_reader)
         try:
             with open(path, "wb") as system_file:
-                if file_content:
-                    system_file.write(file_content)
+                fat_reader.copy_file_content(file, system_file)
         except PermissionError:
             raise DirectoryBrowserError("Error: permission denied.")
 
@@ -160,11 +423,18 @@ def parse_file_args(args, amount=1):
 
 
 class DirectoryBrowser:
-    def __init__(self, fat_editor=None, root=None):
+    def __init__(self, fat_editor=None, root=None, read_only=False):
+        """
+        With read_only fat_editor may be a plain Fat32Reader, commands
+        changing the image are refused
+        """
         self.root = self.current = fat_editor.get_root_directory() \
             if root is None else root
         self._fat_editor = fat_editor
+        self.read_only = read_only
         self._int_running = False
+        self._temp_files = dict()
+        self._name_index = None
 
     def start_interactive_mode(self):
         self._int_running = True
@@ -179,14 +449,42 @@ class DirectoryBrowser:
                 raise
         dispose_temp_files()
 
+    def run_commands(self, commands, stop_on_error=False):
+        """
+        Runs commands one by one as if they were typed in the interactive
+        mode, skipping empty lines and lines starting with '#'.
+        Returns amount of failed commands.
+        """
+        failed = 0
+        self._int_running = True
+        try:
+            for command in commands:
+                command = command.strip()
+                if not command or command.startswith("#"):
+                    continue
+                try:
+                    self._process_command(*command.split(" ", 1))
+                except DirectoryBrowserError as e:
+                    print(e.message)
+                    failed += 1
+                    if stop_on_error:
+                        break
+                if not self._int_running:
+                    break
+        finally:
+            self._int_running = False
+            dispose_temp_files()
+        return failed
+
     _commands = dict()
 
     def _process_command(self, command, args_string=""):
         if command.lower() in self._commands:
             self._commands[command.lower()][0](self, args_string)
         else:
-            print('Wrong command. '
-                  'Print "help" to get list of available commands.')
+            raise DirectoryBrowserError(
+                'Wrong command. '
+                'Print "help" to get list of available commands.')
 
     # noinspection PyUnusedLocal
     @reg_command(_commands, "help", usage="help", desc="prints help")
@@ -257,11 +555,13 @@ class DirectoryBrowser:
                 ("Root" if self.current == self.root else "Current") +
                 " directory does not have a parent directory!")
 
-    @reg_command(_commands, "dir", usage='dir [/b] [/s]',
+    @reg_command(_commands, "dir", usage='dir [/b] [/s] [/j | /c]',
                  desc="prints the content of current directory",
                  keys=[("/b", "print only file names"),
                        ("/s",
-                        "print files of directory and all its subdirectories")]
+                        "print files of directory and all its subdirectories"),
+                       ("/j", "print files as JSON lines (NDJSON)"),
+                       ("/c", "print files as CSV")]
                  )
     def dir(self, args):
         flags = args.split(" ")
@@ -270,8 +570,14 @@ class DirectoryBrowser:
             return
         recursive = '/s' in flags or '-s' in flags
         names_only = '/b' in flags or '-b' in flags
-        print('"' + self.current.get_absolute_path() + '" content:')
-        print_dir_content(self.current, names_only, recursive)
+        if '/j' in flags or '-j' in flags:
+            output_format = DIR_OUTPUT_NDJSON
+        elif '/c' in flags or '-c' in flags:
+            output_format = DIR_OUTPUT_CSV
+        else:
+            output_format = DIR_OUTPUT_TEXT
+            print('"' + self.current.get_absolute_path() + '" content:')
+        print_dir_content(self.current, names_only, recursive, output_format)
 
     @reg_command(_commands, "info", usage="info <file>",
                  desc="prints info about the file")
@@ -318,15 +624,36 @@ class DirectoryBrowser:
         if file.is_directory:
             self.current = file
         else:
-            path = "temp" + file.get_absolute_path()
-            save_file_at_external(file, path, self._fat_editor)
+            path = self._extract_temp_file(file)
 
             system = platform.system()
             if system == 'Linux':
                 subprocess.call(["xdg-open", path])
             elif system == 'Windows':
                 os.startfile(path.replace("/", "\\"))
-        file.update_last_open_date()
+        if not self.read_only:
+            file.update_last_open_date()
+
+    def _extract_temp_file(self, file):
+        """
+        Saves file to the temp directory unless its copy extracted earlier
+        is still there and untouched, returns path to the copy
+        """
+        path = "temp" + file.get_absolute_path()
+        key = (file._start_cluster, file._size_bytes,
+               file._change_date, file._change_time)
+        extracted = self._temp_files.get(key)
+        if extracted is not None and extracted[0] == path:
+            try:
+                stat = os.stat(path)
+                if (stat.st_size, stat.st_mtime_ns) == extracted[1:]:
+                    return path
+            except OSError:
+                pass
+        save_file_at_external(file, path, self._fat_editor)
+        stat = os.stat(path)
+        self._temp_files[key] = (path, stat.st_size, stat.st_mtime_ns)
+        return path
 
     @reg_command(_commands, "type", usage=TYPE_USAGE,
                  desc='prints file content as if it were text file')
@@ -346,19 +673,33 @@ class DirectoryBrowser:
             raise DirectoryBrowserError('File "' + file_name + '" not found.')
         if file.is_directory:
             raise DirectoryBrowserError('"' + file_name + '" is a directory.')
-        bytes_parser = BytesParser(file.get_file_content(self._fat_editor))
         if len(args_splitted) == 1:
-            text = bytes_parser. \
-                parse_ascii_string_replace_errors(0, len(bytes_parser))
+            encoding = None
         else:
-            text = bytes_parser.parse_string(0, len(bytes_parser),
-                                             encoding=encoding)
-        print(text)
+            try:
+                codecs.lookup(encoding)
+            except LookupError:
+                raise DirectoryBrowserError(
+                    'Unknown encoding "' + encoding + '".')
+        try:
+            for text in iter_decoded_text(
+                    file.iter_file_content(self._fat_editor), encoding):
+                sys.stdout.write(text)
+        except UnicodeError as e:
+            print()
+            raise DirectoryBrowserError("Decoding error: " + str(e))
+        print()
 
     @reg_command(_commands, "hex",
                  usage=HEX_COMMAND_USAGE,
-                 desc='prints file content as bytes in hex form')
+                 desc='prints file content as bytes in hex form',
+                 keys=[("--offset <n>", "start from the n-th byte"),
+                       ("--length <n>", "print at most n bytes"),
+                       ("--head <n>", "print only first n lines"),
+                       ("--tail <n>", "print only last n lines")]
+                 )
     def hex(self, args):
+        args, options = _parse_hex_options(args)
         args_splitted = args.rsplit(" ", maxsplit=1)
         if len(args_splitted) != 2:
             raise DirectoryBrowserError('Usage: ' + HEX_COMMAND_USAGE)
@@ -377,25 +718,60 @@ class DirectoryBrowser:
             raise DirectoryBrowserError('File "' + args + '" not found.')
         if file.is_directory:
             raise DirectoryBrowserError('"' + args + '" is a directory.')
-        byte_content = file.get_file_content(self._fat_editor)
-        for start in range(0, len(byte_content), line_len):
-            line = ""
-            for part in range(start, min(start + line_len, len(byte_content))):
-                if not len(line) == 0:
-                    line += " "
-                line += format(byte_content[part], '02x')
-            print(line)
+        offset, length = get_hex_range(file.size_bytes, line_len, **options)
+        for block in iter_hex_blocks(
+                file.iter_file_content(self._fat_editor, offset, length),
+                line_len):
+            sys.stdout.write(block)
+
+    @reg_command(_commands, "find", usage=SEARCH_USAGE,
+                 desc="same as search")
+    @reg_command(_commands, "search", usage=SEARCH_USAGE,
+                 desc="searches current directory and its subdirectories "
+                      "for files which names match the glob pattern",
+                 keys=[("--regex", "pattern is a regular expression"),
+                       ("--min-size <n>", "only files of at least n bytes"),
+                       ("--max-size <n>", "only files of at most n bytes"),
+                       ("--after <dd.mm.yyyy>", "changed on or after date"),
+                       ("--before <dd.mm.yyyy>", "changed on or before date"),
+                       ("--attr <rhsvda>", "only files with all the given "
+                                           "attributes")]
+                 )
+    def search(self, args):
+        pattern, regex, filter_ = parse_search_args(args)
+        if self._name_index is None:
+            self._name_index = nameindex.NameIndex.from_tree(self.root)
+
+        if self.current is not self.root:
+            current = self.current
+
+            def predicate(file):
+                return _is_inside(file.parent, current) and filter_(file)
+        else:
+            predicate = filter_
+
+        try:
+            found = [file.get_absolute_path() for file in
+                     self._name_index.search(pattern, regex, predicate)]
+        except re.error as e:
+            raise DirectoryBrowserError("Pattern error: " + str(e))
+        if found:
+            sys.stdout.write("\n".join(found) + "\n")
+        print("Files found: {:d}".format(len(found)))
 
     @reg_command(_commands, "copyToImage",
                  usage="copyToImage <external path> <image path>",
                  desc="copy file from external path to image")
     def copy_to_image(self, args):
         external_path, image_path = parse_file_args(args, 2)
+        if self.read_only:
+            raise DirectoryBrowserError("Image is opened read-only.")
 
         try:
             current = self.current.get_absolute_path() if self.current != self.root else "."
             self._fat_editor.write_to_image(external_path, image_path)
             self.root = self.current = self._fat_editor.get_root_directory()
+            self._name_index = None
             self.change_directory(current)
         except Exception as e:
             raise DirectoryBrowserError(str(e))
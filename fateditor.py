@@ -1,16 +1,39 @@
 # !/usr/bin/env python3
+import array
+import contextlib
 import datetime
 import itertools
 import math
 import os
 import pathlib
+import re
+import struct
+import sys
+import threading
 
+import blockcache
 import dirbrowser
 import fsobjects
+import journal
+import perfstats
 from bytes_parsers import FileBytesParser, BytesParser
 
 BYTES_PER_DIR_ENTRY = 32
+# creation time (ms, time, date), last access date, first cluster (high),
+# modification time and date, first cluster (low), file size
+_DIR_ENTRY_INFO = struct.Struct('<BHHHHHHHI')
 BYTES_PER_FAT32_ENTRY = 4
+# clears reserved upper bits of the last byte of FAT entry
+_FAT_MASK_TABLE = bytes(byte & 0x0F for byte in range(256))
+_ZERO_BYTES_RUN = re.compile(rb'\x00+')
+DEFAULT_READ_AHEAD_SIZE = 2 ** 20
+# clusters allocated and written at once by the streamed writes
+WRITE_BLOCK_CLUSTERS = 256
+# when the editor flushes written data to the image file
+FLUSH_PER_WRITE = "per-write"
+FLUSH_PER_OPERATION = "per-operation"
+FLUSH_ON_CLOSE = "on-close"
+FLUSH_POLICIES = (FLUSH_PER_WRITE, FLUSH_PER_OPERATION, FLUSH_ON_CLOSE)
 
 DEBUG_MODE = False
 
@@ -30,17 +53,6 @@ def parse_file_first_cluster_number(entry_parser):
     return format_fat_address(cluster_number)
 
 
-def parse_creation_datetime(entry_parser):
-    try:
-        creation_time_millis = entry_parser.parse_int_unsigned(13, 1)
-        creation_datetime = entry_parser.parse_time_date(14)
-        creation_datetime += datetime.timedelta(
-            milliseconds=creation_time_millis)
-    except ValueError:
-        return None
-    return creation_datetime
-
-
 def get_lfn_part(entry_bytes):
     debug("get_lfn_part: ")
     debug("\thex: " + BytesParser(entry_bytes).hex_readable(0,
@@ -68,26 +80,28 @@ def parse_file_info(entry_parser, long_file_name_buffer=""):
         ('.' + extension_part) if not is_directory else "")
     debug("\tshort_name: " + short_name)
 
-    creation_datetime = parse_creation_datetime(entry_parser)
+    (creation_time_millis, creation_time, creation_date, last_access_date,
+     _, last_modification_time, last_modification_date, _,
+     file_size_bytes) = _DIR_ENTRY_INFO.unpack(
+        entry_parser.get_bytes(13, _DIR_ENTRY_INFO.size))
 
-    try:
-        last_access_date = entry_parser.parse_date(18)
-    except ValueError:
-        last_access_date = None
-    try:
-        last_modification_datetime = entry_parser.parse_time_date(22)
-    except ValueError:
-        last_modification_datetime = None
+    return fsobjects.File.from_raw(short_name,
+                                   long_file_name_buffer,
+                                   attributes,
+                                   creation_time_millis,
+                                   creation_time,
+                                   creation_date,
+                                   last_access_date,
+                                   last_modification_time,
+                                   last_modification_date,
+                                   file_size_bytes)
 
-    file_size_bytes = entry_parser.parse_int_unsigned(0 + 28, 4)
 
-    return fsobjects.File(short_name,
-                          long_file_name_buffer,
-                          attributes,
-                          creation_datetime,
-                          last_access_date,
-                          last_modification_datetime,
-                          file_size_bytes)
+def fat_bytes_to_table(fat_bytes):
+    entries = array.array('I', fat_bytes)
+    if sys.byteorder != 'little':
+        entries.byteswap()
+    return entries
 
 
 def validate_fs_info(fs_info_bytes):
@@ -132,24 +146,54 @@ class Fat32Reader:
     used_clusters = dict()
     errors_found = 0
     errors_repaired = 0
+    # list gathering (directory, position, entry) of the deleted entries
+    # while directories are parsed, see undelete.py
+    deleted_entries = None
 
     def __init__(self, fat_image_file,
                  print_scan_info=False,
-                 silent_scan=False):
+                 silent_scan=False,
+                 cache_size=blockcache.DEFAULT_CACHE_SIZE,
+                 read_ahead_size=DEFAULT_READ_AHEAD_SIZE,
+                 stats=None,
+                 block_cache=None):
+        """
+        block_cache replaces the own cache of cache_size bytes, e.g. with
+        a namespace of the cache shared by several images
+        """
         self.silent_scan = silent_scan
         self.valid = True
+        self.block_cache = blockcache.BlockCache(cache_size) \
+            if block_cache is None else block_cache
+        self.read_ahead_size = read_ahead_size
+        self.stats = perfstats.NULL_STATS if stats is None else stats
 
         self._print_scan_info = print_scan_info
         self._fat_image_file = fat_image_file
-        self._read_fat32_boot_sector()
-        self._read_and_validate_fs_info()
-        self._validate_fat(do_raise=not print_scan_info)
-        self._parse_data_area()
+        # serializes read_at where os.pread is not available (Windows)
+        self._read_lock = threading.Lock()
+        with self.stats.timer("open"):
+            self._read_fat32_boot_sector()
+            self._read_and_validate_fs_info()
+            self._validate_fat(do_raise=not print_scan_info)
+            self._parse_data_area()
 
     def scan_info(self, s, **kwargs):
         if self._print_scan_info and not self.silent_scan:
             print(s, **kwargs)
 
+    def close(self):
+        """
+        Reader has nothing to write, the image file is closed by its owner
+        """
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
     def _parse_data_area(self):
         self._data_area_start = self._sectors_to_bytes(self.reserved_sectors
                                                        + self.fat_amount
@@ -218,6 +262,21 @@ class Fat32Reader:
         self._fat_image_file.seek(start)
         return self._fat_image_file.read(length)
 
+    def read_at(self, offset, length):
+        """
+        Returns length bytes of the image from the offset, may be called
+        from several threads: os.pread does not use the shared position
+        of the image file, without it seek and read are done under a lock
+        """
+        if hasattr(os, "pread"):
+            return os.pread(self._fat_image_file.fileno(), length, offset)
+        return self._read_at_locked(offset, length)
+
+    def _read_at_locked(self, offset, length):
+        with self._read_lock:
+            self._fat_image_file.seek(offset)
+            return self._fat_image_file.read(length)
+
     def _cluster_slice(self, start_cluster, end_cluster=None):
         if end_cluster is None:
             end_cluster = start_cluster + 1
@@ -238,6 +297,54 @@ class Fat32Reader:
         start, end = self._get_fat_start_end_sectors(fat_number)
         return self._sector_slice(start, end)
 
+    def get_clusters_amount(self):
+        """
+        Returns amount of clusters in the data area (FAT may describe more)
+        """
+        data_area_sectors = self.total_sectors - \
+            self._data_area_start // self.bytes_per_sector
+        return data_area_sectors // self.sectors_per_cluster
+
+    def read_fat_bytes(self, masked=False):
+        """
+        Returns bytes of the active FAT entries for all the clusters of the
+        data area, with masked=True reserved upper bits are cleared
+        """
+        start, _ = self._get_active_fat_start_end_sectors()
+        self._fat_image_file.seek(self._sectors_to_bytes(start))
+        entries_amount = self.get_clusters_amount() + 2
+        fat = self._fat_image_file.read(
+            entries_amount * BYTES_PER_FAT32_ENTRY)
+        if masked:
+            fat = bytearray(fat)
+            fat[3::BYTES_PER_FAT32_ENTRY] = \
+                fat[3::BYTES_PER_FAT32_ENTRY].translate(_FAT_MASK_TABLE)
+            fat = bytes(fat)
+        return fat
+
+    def read_fat_table(self, masked=False):
+        """
+        Returns entries of the active FAT for all the clusters of the data
+        area as array
+        """
+        return fat_bytes_to_table(self.read_fat_bytes(masked))
+
+    def get_free_cluster_runs(self, masked_fat_bytes=None):
+        """
+        Returns list of (first cluster, clusters amount) runs of free
+        clusters, found as runs of zero bytes in the FAT
+        """
+        if masked_fat_bytes is None:
+            masked_fat_bytes = self.read_fat_bytes(masked=True)
+        runs = list()
+        for match in _ZERO_BYTES_RUN.finditer(
+                masked_fat_bytes, 2 * BYTES_PER_FAT32_ENTRY):
+            first_cluster = -(-match.start() // BYTES_PER_FAT32_ENTRY)
+            end_cluster = match.end() // BYTES_PER_FAT32_ENTRY
+            if end_cluster > first_cluster:
+                runs.append((first_cluster, end_cluster - first_cluster))
+        return runs
+
     def get_root_directory(self):
         if self.log_clusters_usage or self.log_clusters_usage_adv:
             for cluster in self._get_cluster_chain(
@@ -245,25 +352,35 @@ class Fat32Reader:
                 self.used_clusters[cluster] = True
         root = fsobjects.File("", "", fsobjects.DIRECTORY, None, None, None,
                               0, self.root_catalog_first_cluster)
-        root.content = self._parse_dir_files(
-            self.get_data_from_cluster_chain(self.root_catalog_first_cluster),
-            root)
+        with self.stats.timer("tree_parse"):
+            root.content = self._parse_dir_files(
+                self.get_data_from_cluster_chain(
+                    self.root_catalog_first_cluster),
+                root)
         return root
 
-    def _parse_dir_files(self, data, directory):
+    def _parse_dir_files(self, data, directory, recursive=True):
         files = list()
         long_file_name_buffer = ""
         lfn_checksum_buffer = -1
-        for start in range(0, len(data) - BYTES_PER_DIR_ENTRY,
+        chain = None
+        entries_parsed = 0
+        for start in range(0, len(data) - BYTES_PER_DIR_ENTRY + 1,
                            BYTES_PER_DIR_ENTRY):
-            debug('long_file_name_buffer = "' + long_file_name_buffer + '"')
-            debug('lfn_checksum_buffer = ' + str(lfn_checksum_buffer))
+            if DEBUG_MODE:
+                debug('long_file_name_buffer = "' +
+                      long_file_name_buffer + '"')
+                debug('lfn_checksum_buffer = ' + str(lfn_checksum_buffer))
             entry_bytes = data[start:start + BYTES_PER_DIR_ENTRY]
             if entry_bytes[0] == 0x00:
                 # directory has no more entries
                 break
+            entries_parsed += 1
             if entry_bytes[0] == 0xE5:
                 # unused entry
+                if self.deleted_entries is not None:
+                    self.deleted_entries.append(
+                        (directory, start, entry_bytes))
                 continue
             if entry_bytes[0] == 0x05:
                 entry_bytes = b'\xe5' + entry_bytes[1:]
@@ -287,26 +404,18 @@ class Fat32Reader:
                 try:
                     file = self._parse_file_entry(entry_parser,
                                                   long_file_name_buffer,
-                                                  lfn_checksum_buffer)
+                                                  lfn_checksum_buffer,
+                                                  recursive)
                     requires_size_check = self.repair_file_size_mode and \
                                           not file.is_directory
                     requires_cluster_usage_logging = \
                         self.log_clusters_usage \
                         or self.log_clusters_usage_adv
-                    if requires_cluster_usage_logging or \
-                            requires_size_check:
-                        cluster_size = self.get_cluster_size()
-                        cluster_seq_num = start // cluster_size
-                        entry_start_in_cluster = start % cluster_size
+                    if chain is None:
                         chain = self._get_cluster_chain(
                             directory._start_cluster)
-                        cluster_num = \
-                            chain[
-                                cluster_seq_num]
-                        start_bytes, _ = \
-                            self._get_cluster_start_end_relative_to_data_start(
-                                cluster_num)
-                        entry_start = start_bytes + entry_start_in_cluster + self._data_area_start
+                    entry_start = file._entry_start = \
+                        self._get_dir_entry_start(chain, start)
                     if requires_cluster_usage_logging:
                         self._log_file_clusters_usage(file=file,
                                                       entry_start=entry_start)
@@ -321,14 +430,26 @@ class Fat32Reader:
                 files.append(file)
                 long_file_name_buffer = ""
                 lfn_checksum_buffer = -1
-                debug(file.get_attributes_str())
+                if DEBUG_MODE:
+                    debug(file.get_attributes_str())
+        self.stats.add("dir_entries_parsed", entries_parsed)
         return files
 
+    def _get_dir_entry_start(self, dir_cluster_chain, entry_pos):
+        cluster_seq_num, entry_start_in_cluster = divmod(
+            entry_pos, self.get_cluster_size())
+        start_bytes, _ = self._get_cluster_start_end_relative_to_data_start(
+            dir_cluster_chain[cluster_seq_num])
+        return self._data_area_start + start_bytes + entry_start_in_cluster
+
     def _parse_file_entry(self, entry_parser,
                           long_file_name_buffer,
-                          lfn_checksum):
-        debug("parse_file_entry: ")
-        debug("\thex: " + entry_parser.hex_readable(0, BYTES_PER_DIR_ENTRY))
+                          lfn_checksum,
+                          recursive=True):
+        if DEBUG_MODE:
+            debug("parse_file_entry: ")
+            debug("\thex: " +
+                  entry_parser.hex_readable(0, BYTES_PER_DIR_ENTRY))
 
         file = parse_file_info(entry_parser, long_file_name_buffer)
 
@@ -340,7 +461,7 @@ class Fat32Reader:
                               file.short_name == "." else
                               "parent directory."))
 
-        if long_file_name_buffer:
+        if long_file_name_buffer and DEBUG_MODE:
             checksum = fsobjects.get_short_name_checksum(file.short_name)
             if checksum != lfn_checksum:
                 debug("Warning: file short name checksum {:d} is not equal to "
@@ -349,15 +470,11 @@ class Fat32Reader:
                 debug("File short name checksum {:d} is equal to "
                       "LFN checksum {:d}".format(checksum, lfn_checksum))
 
-        name = "directory" if file.is_directory else "file"
-        debug("Parsing content for " + name + ' "' + file.name + '" ...')
-        file.content = self._parse_file_content(entry_parser, file)
-        debug(
-            "Parsing content for " + name + ' "' + file.name + '" completed')
+        file.content = self._parse_file_content(entry_parser, file, recursive)
 
         return file
 
-    def _parse_file_content(self, entry_parser, file):
+    def _parse_file_content(self, entry_parser, file, recursive=True):
         first_cluster = file._start_cluster = \
             parse_file_first_cluster_number(entry_parser)
 
@@ -365,16 +482,36 @@ class Fat32Reader:
             debug("EMPTY")
             return list() if file.is_directory else None
 
-        return None if not file.is_directory else \
+        return None if not file.is_directory or not recursive else \
             self._parse_dir_files(
                 self.get_data_from_cluster_chain(first_cluster), file
             )
 
+    def _get_sector(self, sector):
+        key = ('s', sector)
+        data = self.block_cache.get(key)
+        if data is None:
+            with self.stats.timer("sector_read"):
+                data = self._sector_slice(sector)
+            self.stats.add("bytes_read", len(data))
+            if self.block_cache.enabled:
+                self.block_cache.put(key, data)
+        return data
+
     def _get_data(self, cluster):
+        key = ('c', cluster)
+        data = self.block_cache.get(key)
+        if data is not None:
+            return data
         parser = FileBytesParser(self._fat_image_file, self._data_area_start)
         start, end = self._get_cluster_start_end_relative_to_data_start(
             cluster)
-        data = parser.get_bytes_end(start, end)
+        with self.stats.timer("cluster_read"):
+            data = parser.get_bytes_end(start, end)
+        self.stats.add("clusters_read")
+        self.stats.add("bytes_read", len(data))
+        if self.block_cache.enabled:
+            self.block_cache.put(key, data)
         if DEBUG_MODE:
             debug("Getting data from cluster " + str(cluster) + ": ")
             debug("\tCluster start: " + str(self._data_area_start + start))
@@ -390,17 +527,96 @@ class Fat32Reader:
         return start, end
 
     def get_data_from_cluster_chain(self, first_cluster):
+        return b''.join(self.iter_data_from_cluster_chain(first_cluster))
+
+    def get_read_ahead_clusters(self):
+        return max(1, self.read_ahead_size // self.get_cluster_size())
+
+    def iter_data_from_cluster_chain(self, first_cluster, skip_clusters=0):
+        """
+        Yields content of the cluster chain, starting skip_clusters clusters
+        into it. While the chain goes sequentially on disk the next clusters
+        are read ahead in one read, the window doubles on every sequential
+        read up to the read-ahead size and falls back to one cluster when
+        the chain jumps.
+        """
         current_cluster = first_cluster
-        data = bytes()
-        cluster_chain = str(first_cluster)
-        while True:
-            data += self._get_data(current_cluster)
+        for _ in range(skip_clusters):
             try:
                 current_cluster = self._get_next_file_cluster(current_cluster)
-                cluster_chain += "-" + str(current_cluster)
             except EOFError:
-                debug("Cluster chain: " + cluster_chain)
-                return data
+                return
+        max_window = self.get_read_ahead_clusters()
+        window = 1
+        run_start = current_cluster
+        run_length = 1
+        while True:
+            try:
+                next_cluster = self._get_next_file_cluster(current_cluster)
+            except EOFError:
+                next_cluster = None
+            is_sequential = next_cluster == current_cluster + 1
+            if is_sequential and run_length < window:
+                current_cluster = next_cluster
+                run_length += 1
+                continue
+
+            yield self._get_cluster_run_data(run_start, run_length)
+            if next_cluster is None:
+                return
+            window = min(window * 2, max_window) if is_sequential else 1
+            run_start = current_cluster = next_cluster
+            run_length = 1
+
+    def _get_cluster_run_data(self, first_cluster, clusters_amount):
+        """
+        Returns content of the consecutive clusters, cached clusters are
+        taken from the cache and the runs between them are read at once
+        """
+        if clusters_amount == 1:
+            return self._get_data(first_cluster)
+        if not self.block_cache.enabled:
+            return self._read_cluster_run(first_cluster, clusters_amount)
+        end_cluster = first_cluster + clusters_amount
+        parts = list()
+        missing_start = None
+        for cluster in range(first_cluster, end_cluster):
+            data = self.block_cache.get(('c', cluster))
+            if data is None:
+                if missing_start is None:
+                    missing_start = cluster
+                continue
+            if missing_start is not None:
+                parts.append(self._read_cluster_run(
+                    missing_start, cluster - missing_start))
+                missing_start = None
+            parts.append(data)
+        if missing_start is not None:
+            parts.append(self._read_cluster_run(missing_start,
+                                                end_cluster - missing_start))
+        return b''.join(parts)
+
+    def _read_cluster_run(self, first_cluster, clusters_amount):
+        """
+        Reads consecutive clusters with one read and puts them to the cache
+        """
+        debug("Reading ahead clusters {:d}-{:d}".format(
+            first_cluster, first_cluster + clusters_amount - 1))
+        start, _ = self._get_cluster_start_end_relative_to_data_start(
+            first_cluster)
+        with self.stats.timer("cluster_run_read"):
+            self._fat_image_file.seek(self._data_area_start + start)
+            data = self._fat_image_file.read(
+                clusters_amount * self.get_cluster_size())
+        self.stats.add("clusters_read", clusters_amount)
+        self.stats.add("bytes_read", len(data))
+        if self.block_cache.enabled:
+            cluster_size = self.get_cluster_size()
+            for number in range(clusters_amount):
+                self.block_cache.put(
+                    ('c', first_cluster + number),
+                    data[number * cluster_size:(number + 1) * cluster_size])
+        return data
 
     def _get_next_file_cluster(self, prev_cluster):
         table_value = self.get_fat_value(prev_cluster)
@@ -431,13 +647,47 @@ class Fat32Reader:
             prev_fat = fat
 
     def get_fat_value(self, cluster):
+        self.stats.add("fat_lookups")
         active_fat_start, _ = self._get_active_fat_start_end_sectors()
-        fat_parser = FileBytesParser(self._fat_image_file,
-                                     active_fat_start * self.bytes_per_sector)
-
-        value_start = cluster * BYTES_PER_FAT32_ENTRY
+        sector, value_start = divmod(cluster * BYTES_PER_FAT32_ENTRY,
+                                     self.bytes_per_sector)
+        sector_parser = BytesParser(self._get_sector(active_fat_start + sector))
         return format_fat_address(
-            fat_parser.parse_int_unsigned(value_start, BYTES_PER_FAT32_ENTRY))
+            sector_parser.parse_int_unsigned(value_start,
+                                             BYTES_PER_FAT32_ENTRY))
+
+    def _update_cached_blocks(self, start, content):
+        if not self.block_cache.enabled or not content:
+            return
+        end = start + len(content)
+
+        sector_size = self.bytes_per_sector
+        for sector in range(start // sector_size,
+                            (end - 1) // sector_size + 1):
+            self._update_cached_block(('s', sector), sector * sector_size,
+                                      start, content)
+
+        if end > self._data_area_start:
+            cluster_size = self.get_cluster_size()
+            data_start = max(start, self._data_area_start) - \
+                self._data_area_start
+            data_end = end - self._data_area_start
+            for cluster in range(data_start // cluster_size + 2,
+                                 (data_end - 1) // cluster_size + 3):
+                cluster_start, _ = \
+                    self._get_cluster_start_end_relative_to_data_start(
+                        cluster)
+                self._update_cached_block(
+                    ('c', cluster), self._data_area_start + cluster_start,
+                    start, content)
+
+    def _update_cached_block(self, key, block_start, start, content):
+        if key not in self.block_cache:
+            return
+        if start >= block_start:
+            self.block_cache.update(key, start - block_start, content)
+        else:
+            self.block_cache.update(key, 0, content[block_start - start:])
 
     def get_cluster_size(self):
         return self.sectors_per_cluster * self.bytes_per_sector
@@ -453,6 +703,85 @@ class Fat32Reader:
                 break
         return cluster_chain
 
+    def get_cluster_extents(self, first_cluster):
+        """
+        Returns cluster chain as list of (first cluster, clusters amount)
+        runs of consecutive clusters
+        """
+        extents = list()
+        run_start = prev_cluster = None
+        for cluster in self._get_cluster_chain(first_cluster):
+            if prev_cluster is not None and cluster == prev_cluster + 1:
+                prev_cluster = cluster
+                continue
+            if run_start is not None:
+                extents.append((run_start, prev_cluster - run_start + 1))
+            run_start = prev_cluster = cluster
+        extents.append((run_start, prev_cluster - run_start + 1))
+        return extents
+
+    def get_cluster_offset(self, cluster):
+        start, _ = self._get_cluster_start_end_relative_to_data_start(cluster)
+        return self._data_area_start + start
+
+    def copy_file_content(self, file, system_file):
+        """
+        Writes content of the file to the opened system file. Extents
+        are copied inside the kernel (os.copy_file_range) where it is
+        possible, otherwise content is streamed through memory.
+        """
+        if file._size_bytes == 0 or file.is_directory:
+            return
+        if hasattr(os, "copy_file_range"):
+            start = system_file.tell()
+            try:
+                self._copy_extents_in_kernel(file, system_file)
+                return
+            except (OSError, ValueError, AttributeError):
+                debug("In-kernel copy failed, copying through memory")
+                system_file.seek(start)
+                system_file.truncate()
+        for chunk in file.iter_file_content(self):
+            system_file.write(chunk)
+
+    def _copy_extents_in_kernel(self, file, system_file):
+        # data written through the buffer must be visible to the kernel
+        self._fat_image_file.flush()
+        source_fd = self._fat_image_file.fileno()
+        system_file.flush()
+        target_fd = system_file.fileno()
+        for offset, extent_remaining in self.get_file_byte_ranges(file):
+            while extent_remaining > 0:
+                copied = os.copy_file_range(source_fd, target_fd,
+                                            extent_remaining,
+                                            offset_src=offset)
+                if copied == 0:
+                    raise OSError("Unexpected end of the image")
+                offset += copied
+                extent_remaining -= copied
+        system_file.seek(0, os.SEEK_END)
+
+    def get_file_byte_ranges(self, file):
+        """
+        Returns list of (offset in the image, length) of the file content
+        extents, e.g. to be read by read_at without the shared position
+        of the image file
+        """
+        if file.is_directory or file._size_bytes <= 0 or \
+                file._start_cluster < 2:
+            return list()
+        cluster_size = self.get_cluster_size()
+        ranges = list()
+        remaining = file._size_bytes
+        for first_cluster, clusters_amount in \
+                self.get_cluster_extents(file._start_cluster):
+            length = min(remaining, clusters_amount * cluster_size)
+            ranges.append((self.get_cluster_offset(first_cluster), length))
+            remaining -= length
+            if remaining == 0:
+                break
+        return ranges
+
     def _repair_file_size(self, file, start):
         pass
 
@@ -460,6 +789,40 @@ class Fat32Reader:
         pass
 
 
+def get_runs(clusters):
+    """
+    Returns list of (first cluster, clusters amount) runs of consecutive
+    clusters of the list
+    """
+    runs = list()
+    for cluster in clusters:
+        if runs and runs[-1][0] + runs[-1][1] == cluster:
+            runs[-1] = (runs[-1][0], runs[-1][1] + 1)
+        else:
+            runs.append((cluster, 1))
+    return runs
+
+
+def _iter_blocks(chunks, block_size):
+    """
+    Regroups byte chunks into blocks of block_size bytes (the last one
+    may be shorter)
+    """
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= block_size:
+            yield bytes(buffer[:block_size])
+            del buffer[:block_size]
+    if buffer:
+        yield bytes(buffer)
+
+
+def _check_flush_policy(flush_policy):
+    if flush_policy not in FLUSH_POLICIES:
+        raise ValueError("Unknown flush policy: " + str(flush_policy))
+
+
 def is_cluster_reserved(cluster_fat_value):
     return 0xFFFFFF0 >= cluster_fat_value >= 0xFFFFFF6
 
@@ -469,6 +832,94 @@ def is_cluster_bad(cluster_fat_value):
 
 
 class Fat32Editor(Fat32Reader):
+    def __init__(self, fat_image_file, *args, journal_path=None,
+                 flush_policy=FLUSH_PER_WRITE, **kwargs):
+        """
+        With journal_path writes of every operation are committed through
+        the write-ahead journal, committed journal left by an interrupted
+        run is replayed first. flush_policy is one of FLUSH_POLICIES.
+        """
+        _check_flush_policy(flush_policy)
+        self.flush_policy = flush_policy
+        self.journal = None
+        self._operation_depth = 0
+        self._is_fs_info_dirty = False
+        if journal_path is not None:
+            fat_image_file = self.journal = journal.JournaledFile(
+                fat_image_file, journal_path, self._is_unreferenced_area)
+        super().__init__(fat_image_file, *args, **kwargs)
+
+    @contextlib.contextmanager
+    def operation(self):
+        """
+        Groups writes of one logical operation, with the journal they are
+        committed (or rolled back on error) at the end of the outermost
+        operation
+        """
+        is_outermost = self._operation_depth == 0
+        if is_outermost and self.journal is not None:
+            self.flush_fs_info()
+            self.journal.begin()
+        self._operation_depth += 1
+        try:
+            yield self
+        except BaseException:
+            if is_outermost and self.journal is not None:
+                self.journal.rollback()
+                self.block_cache.clear()
+                self._read_and_validate_fs_info()
+                self._is_fs_info_dirty = False
+            raise
+        finally:
+            self._operation_depth -= 1
+        if is_outermost:
+            self._end_operation()
+
+    def _end_operation(self):
+        self.flush_fs_info()
+        if self.journal is not None:
+            with self.stats.timer("commit"):
+                self.journal.commit()
+        if self.flush_policy == FLUSH_PER_OPERATION:
+            self._flush()
+
+    @contextlib.contextmanager
+    def use_flush_policy(self, flush_policy):
+        """
+        Switches flush policy inside the block, written data is flushed
+        when the block is left
+        """
+        _check_flush_policy(flush_policy)
+        previous_policy = self.flush_policy
+        self.flush_policy = flush_policy
+        try:
+            yield self
+        finally:
+            self.flush_policy = previous_policy
+            self._flush()
+
+    def _flush(self):
+        with self.stats.timer("flush"):
+            self._fat_image_file.flush()
+
+    def _is_unreferenced_area(self, start, length):
+        """
+        Tells whether all the clusters of the area are free
+        in the committed FAT
+        """
+        if start < self._data_area_start:
+            return False
+        cluster_size = self.get_cluster_size()
+        first_cluster = (start - self._data_area_start) // cluster_size + 2
+        last_cluster = (start + length - 1 - self._data_area_start) \
+            // cluster_size + 2
+        active_fat_start, _ = self._get_active_fat_start_end_sectors()
+        entries = fat_bytes_to_table(self.journal.read_committed(
+            self._sectors_to_bytes(active_fat_start)
+            + first_cluster * BYTES_PER_FAT32_ENTRY,
+            (last_cluster - first_cluster + 1) * BYTES_PER_FAT32_ENTRY))
+        return not any(format_fat_address(entry) for entry in entries)
+
     def _write_fat_value(self, cluster, value):
         reserved = self.get_fat_value(cluster) & 0xF0000000
         self._write_fat_bytes(cluster,
@@ -478,6 +929,30 @@ class Fat32Editor(Fat32Reader):
                                   byteorder='little'
                               ))
 
+    def _write_fat_values(self, first_cluster, values):
+        """
+        Writes values to the consecutive FAT entries starting from
+        first_cluster with one write per FAT copy
+        """
+        active_fat_start, _ = self._get_active_fat_start_end_sectors()
+        offset = first_cluster * BYTES_PER_FAT32_ENTRY
+        self._fat_image_file.seek(self._sectors_to_bytes(active_fat_start)
+                                  + offset)
+        entries = array.array('I')
+        entries.frombytes(self._fat_image_file.read(
+            len(values) * BYTES_PER_FAT32_ENTRY))
+        if sys.byteorder != 'little':
+            entries.byteswap()
+        for i, value in enumerate(values):
+            entries[i] = (entries[i] & 0xF0000000) | (value & 0x0FFFFFFF)
+        if sys.byteorder != 'little':
+            entries.byteswap()
+        for i in range(self.fat_amount):
+            fat_start, _ = self._get_fat_start_end_sectors(i)
+            self._write_content_to_image(
+                self._sectors_to_bytes(fat_start) + offset,
+                entries.tobytes())
+
     def _write_eof_fat_value(self, cluster):
         self._write_fat_value(cluster, 0x0FFFFFFF)
 
@@ -500,32 +975,45 @@ class Fat32Editor(Fat32Reader):
             raise ValueError("Cluster amount cannot be negative!")
         if clusters_amount == 0:
             return list()
+        self.stats.add("allocations")
+        self.stats.add("clusters_allocated", clusters_amount)
+
+        entries_amount = self.get_clusters_amount() + 2
+        if self._free_clusters < 0 or \
+                not 2 <= self._first_free_cluster < entries_amount:
+            self._recompute_fs_info()
 
         free_clusters = list()
-        start_sector, end_sector = self._get_active_fat_start_end_sectors()
-        fat = self._sector_slice(start_sector, end_sector)
+        start_sector, _ = self._get_active_fat_start_end_sectors()
+        fat = self._sector_slice(
+            start_sector, start_sector + math.ceil(
+                entries_amount * BYTES_PER_FAT32_ENTRY / self.bytes_per_sector))
         fat_parser = BytesParser(fat)
 
         empty_fat_value = b'\x00' * BYTES_PER_FAT32_ENTRY
-        for i in range(self._first_free_cluster * BYTES_PER_FAT32_ENTRY,
-                       len(fat), BYTES_PER_FAT32_ENTRY):
-            if clusters_amount == 0:
-                self._first_free_cluster = i // BYTES_PER_FAT32_ENTRY
-                self._update_first_free_cluster()
-                self._decrease_free_clusters_amount_by(required)
-                break
-            value = fat_parser.get_bytes(i, BYTES_PER_FAT32_ENTRY)
-            debug("Looking to cluster #" + str(
-                i // BYTES_PER_FAT32_ENTRY) + ", content: " + str(value) + (
-                      " != " if value != empty_fat_value else " == ") + str(
-                empty_fat_value))
+        # from the next free cluster hint to the end, then from the start
+        for cluster in itertools.chain(
+                range(self._first_free_cluster, entries_amount),
+                range(2, self._first_free_cluster)):
+            value = fat_parser.get_bytes(cluster * BYTES_PER_FAT32_ENTRY,
+                                         BYTES_PER_FAT32_ENTRY)
+            if DEBUG_MODE:
+                debug("Looking to cluster #" + str(cluster) +
+                      ", content: " + str(value) +
+                      (" != " if value != empty_fat_value else " == ") +
+                      str(empty_fat_value))
             if value == empty_fat_value:
-                free_clusters.append(i // BYTES_PER_FAT32_ENTRY)
+                free_clusters.append(cluster)
                 clusters_amount -= 1
+                if clusters_amount == 0:
+                    break
         if clusters_amount > 0:
             raise ValueError("Have not found enough free clusters "
                              "(Required: {}, Found: {})."
                              .format(required, required - clusters_amount))
+        self._first_free_cluster = free_clusters[-1] + 1
+        self._free_clusters = max(0, self._free_clusters - required)
+        self._is_fs_info_dirty = True
         return free_clusters
 
     def write_to_image(self, external_path, internal_path,
@@ -536,6 +1024,10 @@ class Fat32Editor(Fat32Reader):
         path = pathlib.Path(external_path)
         if not path.exists():
             raise FileNotFoundError(str(path) + " not found.")
+        with self.operation():
+            return self._write_to_image(path, internal_path, directory)
+
+    def _write_to_image(self, path, internal_path, directory):
 
         if directory is None:
             directory = find_directory(self.get_root_directory(),
@@ -546,7 +1038,7 @@ class Fat32Editor(Fat32Reader):
         attributes = fsobjects.DIRECTORY if path.is_dir() else 0
 
         creation_datetime, last_access_date, modification_datetime = \
-            get_time_stamps(external_path)
+            get_time_stamps(str(path))
 
         file = fsobjects.File(
             long_name=name,
@@ -571,23 +1063,109 @@ class Fat32Editor(Fat32Reader):
 
         return file
 
+    def write_stream_to_image(self, name, chunks, directory,
+                              create_datetime=None, last_open_date=None,
+                              change_datetime=None) -> fsobjects.File:
+        """
+        Writes file with content given by iterable of byte chunks (e.g.
+        content of a file of another image) to the directory, returns File
+        """
+        with self.operation():
+            file = self._create_file(name, directory, 0, create_datetime,
+                                     last_open_date, change_datetime)
+            file._start_cluster, file._size_bytes = \
+                self._write_chunks(chunks)
+            self._append_content_to_dir(directory,
+                                        file.to_directory_entries())
+            return file
+
+    def create_directory(self, name, directory, create_datetime=None,
+                         last_open_date=None,
+                         change_datetime=None) -> fsobjects.File:
+        """
+        Creates empty directory in the directory, returns File
+        """
+        with self.operation():
+            file = self._create_file(name, directory, fsobjects.DIRECTORY,
+                                     create_datetime, last_open_date,
+                                     change_datetime)
+            self._init_directory_content(file)
+            self._append_content_to_dir(directory,
+                                        file.to_directory_entries())
+            return file
+
+    @staticmethod
+    def _create_file(name, directory, attributes, create_datetime,
+                     last_open_date, change_datetime):
+        file = fsobjects.File(
+            long_name=name,
+            short_name=fsobjects.get_short_name(name, directory=directory),
+            create_datetime=create_datetime,
+            change_datetime=change_datetime,
+            last_open_date=last_open_date,
+            attributes=attributes)
+        file.parent = directory
+        return file
+
+    def _init_directory_content(self, file):
+        """
+        Allocates the first cluster of the new directory and writes its
+        "." and ".." entries
+        """
+        file.content = list()
+        file._start_cluster = self._write_content_and_get_first_cluster(
+            bytes(self.get_cluster_size()))
+        file._size_bytes = 0
+
+        self._append_content_to_dir(file, file.to_directory_entries(
+            is_dot_self_entry=True))
+        if file.parent:
+            self._append_content_to_dir(file,
+                                        file.parent.to_directory_entries(
+                                            is_dot_parent_entry=True))
+
+    def _write_chunks(self, chunks):
+        """
+        Writes content given by chunks to free clusters, WRITE_BLOCK_CLUSTERS
+        at a time with one write per run of consecutive clusters, returns
+        (first cluster, size in bytes), first cluster is 0 for no content
+        """
+        cluster_size = self.get_cluster_size()
+        block_size = cluster_size * WRITE_BLOCK_CLUSTERS
+        first_cluster = last_cluster = 0
+        size_bytes = 0
+        for block in _iter_blocks(chunks, block_size):
+            size_bytes += len(block)
+            clusters = self._find_free_clusters(
+                math.ceil(len(block) / cluster_size))
+            position = 0
+            for run_start, run_length in get_runs(clusters):
+                run_end = position + run_length * cluster_size
+                self._write_content_to_image(
+                    self.get_cluster_offset(run_start),
+                    block[position:run_end])
+                position = run_end
+                next_cluster = clusters[position // cluster_size] \
+                    if position < len(block) else 0x0FFFFFFF
+                self._write_fat_values(
+                    run_start, list(range(run_start + 1,
+                                          run_start + run_length))
+                    + [next_cluster])
+            if last_cluster > 0:
+                self._write_fat_values(last_cluster, [clusters[0]])
+            else:
+                first_cluster = clusters[0]
+            last_cluster = clusters[-1]
+        return first_cluster, size_bytes
+
     def _write_external_file_content(self, external_path, file):
         cluster_size = self.get_cluster_size()
         clusters = list()
         size_bytes = 0
         ext_path_abs = str(external_path.absolute())
         if external_path.is_dir():
-            file.content = list()
-            first_cluster = file._start_cluster = \
-                self._write_content_and_get_first_cluster(bytes(cluster_size))
-            file._size_bytes = 0
-
-            self._append_content_to_dir(file, file.to_directory_entries(
-                is_dot_self_entry=True))
-            if file.parent:
-                self._append_content_to_dir(file,
-                                            file.parent.to_directory_entries(
-                                                is_dot_parent_entry=True))
+            self._init_directory_content(file)
+            first_cluster = file._start_cluster
 
             for name in os.listdir(ext_path_abs):
                 path = os.path.join(ext_path_abs, name)
@@ -665,9 +1243,14 @@ class Fat32Editor(Fat32Reader):
         return clusters[0]
 
     def _write_content_to_image(self, start, content):
-        self._fat_image_file.seek(start)
-        self._fat_image_file.write(content)
-        self._fat_image_file.flush()
+        with self.stats.timer("write"):
+            self._fat_image_file.seek(start)
+            self._fat_image_file.write(content)
+        self.stats.add("writes")
+        self.stats.add("bytes_written", len(content))
+        if self.flush_policy == FLUSH_PER_WRITE:
+            self._flush()
+        self._update_cached_blocks(start, content)
 
     def _append_content_to_dir(self, directory, entries):
         for entry, start in zip(entries,
@@ -678,7 +1261,6 @@ class Fat32Editor(Fat32Reader):
     def _find_dir_empty_entries(self, directory, amount_required):
         if amount_required <= 0:
             raise ValueError("Amount must be positive")
-        fat_parser = FileBytesParser(self._fat_image_file)
         clusters = self._get_cluster_chain(directory._start_cluster)
 
         entries_start = list()
@@ -687,15 +1269,17 @@ class Fat32Editor(Fat32Reader):
         for cluster_num in clusters:
             start, end = self._get_cluster_start_end_relative_to_data_start(
                 cluster_num)
+            cluster_data = self._get_data(cluster_num)
             for entry_start in range(data_start + start, data_start + end,
                                      BYTES_PER_DIR_ENTRY):
-                entry_bytes = fat_parser.get_bytes(entry_start, 1)
+                entry_pos = entry_start - data_start - start
                 if DEBUG_MODE:
                     print("CLuster " + str(cluster_num) +
                           ": Looking for empty entry in " +
-                          fat_parser.hex_readable(entry_start,
-                                                  BYTES_PER_DIR_ENTRY))
-                if entry_bytes[0] == 0x00 or entry_bytes[0] == 0xE5:
+                          BytesParser(cluster_data).hex_readable(
+                              entry_pos, BYTES_PER_DIR_ENTRY))
+                if cluster_data[entry_pos] == 0x00 or \
+                        cluster_data[entry_pos] == 0xE5:
                     entries_start.append(entry_start)
                     debug("Found!")
                     if len(entries_start) == amount_required:
@@ -751,24 +1335,39 @@ class Fat32Editor(Fat32Reader):
 
         return first_appended_cluster
 
-    def _update_first_free_cluster(self):
+    def _recompute_fs_info(self):
+        """
+        Counts free clusters and finds the first one in the FAT, used when
+        FS Info values are unknown (-1) or invalid
+        """
+        runs = self.get_free_cluster_runs()
+        self._free_clusters = sum(length for _, length in runs)
+        self._first_free_cluster = runs[0][0] if runs else 2
+        self._is_fs_info_dirty = True
+
+    def flush_fs_info(self):
+        """
+        Writes free clusters amount and next free cluster kept in memory
+        to FS Info sector if they were changed
+        """
+        if not self._is_fs_info_dirty:
+            return
         fs_info_start = self._sectors_to_bytes(self._fs_info_sector)
-        self._fat_image_file.seek(fs_info_start + 0x1e8)
-        self._fat_image_file.write(
-            int.to_bytes(self._first_free_cluster, length=4,
+        self._write_content_to_image(
+            fs_info_start + 0x1e8,
+            int.to_bytes(self._free_clusters & 0xFFFFFFFF, length=4,
+                         byteorder='little') +
+            int.to_bytes(self._first_free_cluster & 0xFFFFFFFF, length=4,
                          byteorder='little'))
+        self._is_fs_info_dirty = False
+        self.stats.add("fs_info_writes")
 
-    def _decrease_free_clusters_amount_by(self, amount):
-        if self._free_clusters > 0:
-            self._free_clusters -= amount
-            self._update_free_clusters_amount()
-
-    def _update_free_clusters_amount(self):
-        fs_info_start = self._sectors_to_bytes(self._fs_info_sector)
-        self._write_content_to_image(fs_info_start + 0x1e8,
-                                     int.to_bytes(self._free_clusters,
-                                                  length=4,
-                                                  byteorder='little'))
+    def close(self):
+        """
+        Writes changes kept in memory to the image
+        """
+        self.flush_fs_info()
+        self._flush()
 
     def scandisk(self, find_lost_sectors, find_intersecting_chains,
                  check_files_size):
@@ -780,6 +1379,11 @@ class Fat32Editor(Fat32Reader):
         self.repair_file_size_mode = check_files_size
         self.errors_found = 0
         self.errors_repaired = 0
+        self.used_clusters = dict()
+        with self.stats.timer("scandisk"), self.operation():
+            self._scandisk()
+
+    def _scandisk(self):
         self.get_root_directory()
         if self.log_clusters_usage:
             self.scan_for_lost_clusters()
@@ -833,13 +1437,12 @@ class Fat32Editor(Fat32Reader):
                         start_custer_number_bytes = int.to_bytes(
                             prev_cluster,
                             length=4, byteorder='big')
-                        self._fat_image_file.seek(entry_start + 20)
-                        self._fat_image_file.write(
+                        self._write_content_to_image(
+                            entry_start + 20,
                             start_custer_number_bytes[1::-1])
-                        self._fat_image_file.seek(entry_start + 26)
-                        self._fat_image_file.write(
+                        self._write_content_to_image(
+                            entry_start + 26,
                             start_custer_number_bytes[4:1:-1])
-                        self._fat_image_file.flush()
                     else:
                         prev_cluster = self.append_cluster_to_file(
                             prev_cluster, data_to_copy)
@@ -902,6 +1505,10 @@ class Fat32Editor(Fat32Reader):
                 used_clusters += 1
             cluster_number += 1
         total_clusters = free_clusters + bad_clusters + reserved_clusters + used_clusters
+        if self.errors_repaired > 0:
+            self._free_clusters = sum(
+                length for _, length in self.get_free_cluster_runs())
+            self._is_fs_info_dirty = True
 
         free_clusters_part = free_clusters / total_clusters * 100
         used_clusters_part = used_clusters / total_clusters * 100
@@ -0,0 +1,377 @@
+# !/usr/bin/env python3
+"""
+Generator of FAT32 images: writes boot sector, FS Info sector and FAT
+copies to a sparse image file of any size and fills it with generated
+files and directories with controlled entry counts and fragmentation.
+"""
+import argparse
+import array
+import datetime
+import math
+import struct
+import sys
+
+import fsobjects
+
+BYTES_PER_SECTOR = 512
+RESERVED_SECTORS = 32
+FS_INFO_SECTOR = 1
+BOOT_SECTOR_COPY_SECTOR = 6
+ROOT_CLUSTER = 2
+FAT_MEDIA = 0x0FFFFFF8
+FAT_EOF = 0x0FFFFFFF
+# clusters amount below which the volume is FAT16 by the specification,
+# smaller images are still readable by the reader
+MIN_FAT32_CLUSTERS = 65525
+
+DEFAULT_CLUSTER_SIZE = 4096
+DEFAULT_FAT_AMOUNT = 2
+DEFAULT_DATETIME = datetime.datetime(2017, 7, 14, 20, 24, 10)
+CLUSTER_SIZES = tuple(BYTES_PER_SECTOR * 2 ** i for i in range(8))
+
+
+class ImageBuilder:
+    """
+    Lays out files and directories cluster by cluster in a sparse image
+    file, FAT and directories are written by finish(). Only the used part
+    of the FAT is kept in memory and written, the rest of the image stays
+    a hole.
+    """
+
+    def __init__(self, image_file, size_bytes,
+                 cluster_size=DEFAULT_CLUSTER_SIZE,
+                 fat_amount=DEFAULT_FAT_AMOUNT,
+                 volume_label="NO NAME"):
+        if cluster_size not in CLUSTER_SIZES:
+            raise ValueError("Cluster size must be one of " +
+                             ", ".join(str(size) for size in CLUSTER_SIZES))
+        self._image_file = image_file
+        self.cluster_size = cluster_size
+        self.fat_amount = fat_amount
+        self.volume_label = volume_label
+        self.sectors_per_cluster = cluster_size // BYTES_PER_SECTOR
+        self.total_sectors = size_bytes // BYTES_PER_SECTOR
+        if self.total_sectors > 0xFFFFFFFF:
+            raise ValueError("Image is too big")
+        self.sectors_per_fat = math.ceil(
+            ((self.total_sectors - RESERVED_SECTORS)
+             // self.sectors_per_cluster + 2) * 4 / BYTES_PER_SECTOR)
+        self.clusters_amount = (self.total_sectors - RESERVED_SECTORS
+                                - fat_amount * self.sectors_per_fat) \
+            // self.sectors_per_cluster
+        if self.clusters_amount < 16:
+            raise ValueError("Image is too small")
+        self._data_area_start = (RESERVED_SECTORS + fat_amount
+                                 * self.sectors_per_fat) * BYTES_PER_SECTOR
+
+        self.fat = array.array('I', [FAT_MEDIA, FAT_EOF, FAT_EOF])
+        self._next_free_cluster = ROOT_CLUSTER + 1
+
+        self.root = fsobjects.File("", "", fsobjects.DIRECTORY,
+                                   DEFAULT_DATETIME, DEFAULT_DATETIME.date(),
+                                   DEFAULT_DATETIME, 0, ROOT_CLUSTER)
+        self.root.content = list()
+
+        image_file.seek(0)
+        image_file.truncate(0)
+        image_file.truncate(self.total_sectors * BYTES_PER_SECTOR)
+
+    @property
+    def free_clusters(self):
+        return self.clusters_amount + 2 - len(self.fat) + \
+            self.fat[ROOT_CLUSTER:].count(0)
+
+    def _allocate(self, clusters_amount, fragments=1):
+        """
+        Returns clusters_amount clusters split into fragments runs,
+        runs are separated by one free cluster
+        """
+        fragments = max(1, min(fragments, clusters_amount))
+        gaps = fragments - 1
+        start = self._next_free_cluster
+        end = start + clusters_amount + gaps
+        if end > self.clusters_amount + 2:
+            raise ValueError("Not enough free clusters in the image")
+        self._next_free_cluster = end
+        self.fat.extend(array.array('I', bytes(4 * (end - len(self.fat)))))
+
+        clusters = list()
+        run_start = start
+        for fragment in range(fragments):
+            run_length = clusters_amount // fragments + \
+                (1 if fragment < clusters_amount % fragments else 0)
+            clusters += range(run_start, run_start + run_length)
+            run_start += run_length + 1
+        return clusters
+
+    def _link(self, clusters):
+        for cluster, next_cluster in zip(clusters, clusters[1:]):
+            self.fat[cluster] = next_cluster
+        self.fat[clusters[-1]] = FAT_EOF
+
+    def _new_file(self, directory, short_name, long_name, attributes=0,
+                  size_bytes=0):
+        file = fsobjects.File(short_name, long_name, attributes,
+                              DEFAULT_DATETIME, DEFAULT_DATETIME.date(),
+                              DEFAULT_DATETIME, size_bytes, 0)
+        directory.content.append(file)
+        return file
+
+    def add_directory(self, directory, short_name, long_name=""):
+        new_directory = self._new_file(directory, short_name, long_name,
+                                       fsobjects.DIRECTORY)
+        new_directory.content = list()
+        new_directory.parent = directory
+        return new_directory
+
+    def add_file(self, directory, short_name, long_name="", size_bytes=0,
+                 fragments=1):
+        """
+        Adds file which content is split into fragments cluster runs
+        """
+        file = self._new_file(directory, short_name, long_name, 0,
+                              size_bytes)
+        clusters_amount = math.ceil(size_bytes / self.cluster_size)
+        if clusters_amount > 0:
+            self._write_file(file, self._allocate(clusters_amount, fragments))
+        return file
+
+    def add_files_interleaved(self, directory, names, size_bytes):
+        """
+        Adds files of the same size which clusters alternate on disk,
+        so every file is fragmented into single cluster extents
+        """
+        files = [self._new_file(directory, short_name, long_name, 0,
+                                size_bytes)
+                 for short_name, long_name in names]
+        clusters_per_file = math.ceil(size_bytes / self.cluster_size)
+        if clusters_per_file == 0:
+            return files
+        clusters = self._allocate(clusters_per_file * len(files))
+        for i, file in enumerate(files):
+            self._write_file(file, clusters[i::len(files)])
+        return files
+
+    def _write_file(self, file, clusters):
+        file._start_cluster = clusters[0]
+        self._link(clusters)
+        block = get_file_block(file, self.cluster_size)
+        run_start = 0
+        for i in range(1, len(clusters) + 1):
+            if i < len(clusters) and clusters[i] == clusters[i - 1] + 1:
+                continue
+            self._image_file.seek(self._get_cluster_offset(clusters[run_start]))
+            run_length = i - run_start
+            for chunk_start in range(0, run_length, 256):
+                self._image_file.write(
+                    block * min(256, run_length - chunk_start))
+            run_start = i
+
+    def _get_cluster_offset(self, cluster):
+        return self._data_area_start + \
+            (cluster - ROOT_CLUSTER) * self.cluster_size
+
+    def _get_entries(self, directory):
+        entries = list()
+        if directory is not self.root:
+            entries += directory.to_directory_entries(is_dot_self_entry=True)
+            entries += directory.parent.to_directory_entries(
+                is_dot_parent_entry=True)
+        for file in directory.content:
+            entries += file.to_directory_entries()
+        return entries
+
+    def _allocate_directories(self):
+        directories = [self.root]
+        while directories:
+            directory = directories.pop()
+            entries_amount = len(directory.content) + 2
+            for file in directory.content:
+                if fsobjects.requires_lfn(file.name):
+                    entries_amount += len(fsobjects.to_lfn_parts(file.name))
+                if file.is_directory:
+                    directories.append(file)
+            # one more entry so the list is always terminated by zero entry
+            clusters_amount = math.ceil((entries_amount + 1) * 32
+                                        / self.cluster_size)
+            if directory is self.root:
+                clusters = [ROOT_CLUSTER]
+                if clusters_amount > 1:
+                    clusters += self._allocate(clusters_amount - 1)
+            else:
+                clusters = self._allocate(clusters_amount)
+            directory._start_cluster = clusters[0]
+            self._link(clusters)
+
+    def _write_directories(self):
+        directories = [self.root]
+        while directories:
+            directory = directories.pop()
+            content = b''.join(self._get_entries(directory))
+            cluster = directory._start_cluster
+            for start in range(0, len(content), self.cluster_size):
+                self._image_file.seek(self._get_cluster_offset(cluster))
+                self._image_file.write(content[start:start
+                                               + self.cluster_size])
+                cluster = self.fat[cluster]
+            directories += [file for file in directory.content
+                            if file.is_directory]
+
+    def finish(self):
+        self._allocate_directories()
+        self._write_directories()
+
+        boot_sector = self._get_boot_sector()
+        fs_info = self._get_fs_info()
+        for copy_start in (0, BOOT_SECTOR_COPY_SECTOR):
+            self._image_file.seek(copy_start * BYTES_PER_SECTOR)
+            self._image_file.write(boot_sector)
+            self._image_file.seek((copy_start + FS_INFO_SECTOR)
+                                  * BYTES_PER_SECTOR)
+            self._image_file.write(fs_info)
+
+        fat = self.fat
+        if sys.byteorder != 'little':
+            fat = array.array('I', fat)
+            fat.byteswap()
+        for i in range(self.fat_amount):
+            self._image_file.seek((RESERVED_SECTORS + i * self.sectors_per_fat)
+                                  * BYTES_PER_SECTOR)
+            self._image_file.write(fat.tobytes())
+        self._image_file.flush()
+
+    def _get_boot_sector(self):
+        boot_sector = bytearray(BYTES_PER_SECTOR)
+        boot_sector[0:3] = b'\xeb\x58\x90'
+        boot_sector[3:11] = b'FAT32EXP'
+        struct.pack_into('<HBHBHHBHHHII', boot_sector, 0x0b,
+                         BYTES_PER_SECTOR, self.sectors_per_cluster,
+                         RESERVED_SECTORS, self.fat_amount, 0, 0, 0xF8, 0,
+                         63, 255, 0, self.total_sectors)
+        struct.pack_into('<IHHIHH', boot_sector, 0x24, self.sectors_per_fat,
+                         0, 0, ROOT_CLUSTER, FS_INFO_SECTOR,
+                         BOOT_SECTOR_COPY_SECTOR)
+        label = self.volume_label.upper().encode("ascii")[:11].ljust(11)
+        struct.pack_into('<BBBI11s8s', boot_sector, 0x40, 0x80, 0, 0x29,
+                         0x12345678, label, b'FAT32   ')
+        boot_sector[510:512] = b'\x55\xaa'
+        return bytes(boot_sector)
+
+    def _get_fs_info(self):
+        fs_info = bytearray(BYTES_PER_SECTOR)
+        fs_info[0:4] = b'\x52\x52\x61\x41'
+        fs_info[0x1e4:0x1e8] = b'\x72\x72\x41\x61'
+        try:
+            first_free_cluster = self.fat.index(0, ROOT_CLUSTER)
+        except ValueError:
+            first_free_cluster = len(self.fat)
+        struct.pack_into('<II', fs_info, 0x1e8, self.free_clusters,
+                         first_free_cluster)
+        fs_info[0x1fc:0x200] = b'\x00\x00\x55\xaa'
+        return bytes(fs_info)
+
+
+def get_file_block(file, cluster_size):
+    """
+    Returns cluster-sized block the generated file content consists of
+    """
+    pattern = (file.name + "\n").encode("utf-8")
+    return (pattern * (cluster_size // len(pattern) + 1))[:cluster_size]
+
+
+def get_file_content(file, cluster_size):
+    clusters_amount = math.ceil(file.size_bytes / cluster_size)
+    return (get_file_block(file, cluster_size)
+            * clusters_amount)[:file.size_bytes]
+
+
+def fill_tree(builder, files_amount=0, directories_amount=0, depth=1,
+              file_size=0, fragments=1, long_names_part=0.0):
+    """
+    Adds directories (up to depth levels deep) and files spread over
+    them round robin. Every file is split into fragments runs,
+    long_names_part of the files get names requiring LFN entries.
+    """
+    directories = [builder.root]
+    parents = [(builder.root, 0)]
+    for i in range(directories_amount):
+        parent, level = parents[i % len(parents)]
+        directory = builder.add_directory(parent, "D{:07d}".format(i),
+                                          "directory {:d}".format(i))
+        directories.append(directory)
+        if level + 1 < depth:
+            parents.append((directory, level + 1))
+
+    for i in range(files_amount):
+        directory = directories[i % len(directories)]
+        if int((i + 1) * long_names_part) > int(i * long_names_part):
+            builder.add_file(directory, "L{:07d}.BIN".format(i),
+                             "long file name {:d}.bin".format(i),
+                             file_size, fragments)
+        else:
+            builder.add_file(directory, "F{:07d}.BIN".format(i), "",
+                             file_size, fragments)
+
+
+def create_image(path, size_bytes, cluster_size=DEFAULT_CLUSTER_SIZE,
+                 **fill_parameters):
+    """
+    Creates image file filled by fill_tree, returns the builder
+    """
+    with open(path, "w+b") as image_file:
+        builder = ImageBuilder(image_file, size_bytes, cluster_size)
+        fill_tree(builder, **fill_parameters)
+        builder.finish()
+    return builder
+
+
+def main():
+    parsed_args = parse_args()
+    try:
+        builder = create_image(
+            parsed_args.image_path, parsed_args.size * 2 ** 20,
+            parsed_args.cluster_size,
+            files_amount=parsed_args.files,
+            directories_amount=parsed_args.directories,
+            depth=parsed_args.depth,
+            file_size=parsed_args.file_size * 1024,
+            fragments=parsed_args.fragments,
+            long_names_part=parsed_args.long_names)
+    except (ValueError, OSError) as e:
+        print("Error: " + str(e))
+        return 1
+    print('Image "{}" created: {:d} clusters, {:d} free.'.format(
+        parsed_args.image_path, builder.clusters_amount,
+        builder.free_clusters))
+    if builder.clusters_amount < MIN_FAT32_CLUSTERS:
+        print("Warning: less than {:d} clusters, other tools may treat "
+              "the image as FAT16.".format(MIN_FAT32_CLUSTERS))
+    return 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Generates FAT32 image filled with files")
+    parser.add_argument("image_path", help="Path of the created image")
+    parser.add_argument("--size", type=int, default=64, metavar="MIB",
+                        help="Image size, the file is created sparse")
+    parser.add_argument("--cluster-size", type=int,
+                        default=DEFAULT_CLUSTER_SIZE, choices=CLUSTER_SIZES)
+    parser.add_argument("--files", type=int, default=0,
+                        help="Amount of files")
+    parser.add_argument("--directories", type=int, default=0,
+                        help="Amount of directories")
+    parser.add_argument("--depth", type=int, default=1,
+                        help="Maximal nesting level of directories")
+    parser.add_argument("--file-size", type=int, default=4, metavar="KIB",
+                        help="Size of every file")
+    parser.add_argument("--fragments", type=int, default=1,
+                        help="Amount of cluster runs every file is split to")
+    parser.add_argument("--long-names", type=float, default=0.0,
+                        metavar="PART",
+                        help="Part of files with long names (0..1)")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,6 +2,7 @@
 import datetime
 import itertools
 import re
+import struct
 
 import bytes_parsers
 
@@ -38,9 +39,39 @@ def get_size_str(size):
     return short_str + bytes_str
 
 
+# undecodable (e.g. zero) FAT dates are shown as the start of the FAT
+# epoch, so decoding the same entry always gives the same value
+UNKNOWN_DATE = datetime.date(1980, 1, 1)
+UNKNOWN_DATETIME = datetime.datetime.combine(UNKNOWN_DATE, datetime.time())
+
+
+def decode_datetime(date_value, time_value, millis=0):
+    try:
+        return datetime.datetime.combine(
+            bytes_parsers.int_to_date(date_value),
+            bytes_parsers.int_to_time(time_value)
+        ) + datetime.timedelta(milliseconds=millis)
+    except ValueError:
+        return UNKNOWN_DATETIME
+
+
+def decode_date(date_value):
+    try:
+        return bytes_parsers.int_to_date(date_value)
+    except ValueError:
+        return UNKNOWN_DATE
+
+
 class File:
-    content = None
-    parent = None
+    """
+    Dates and times are kept as raw 16-bit FAT values and are decoded
+    only when accessed, the long name is kept only if it differs from
+    the short one.
+    """
+    __slots__ = ('short_name', '_long_name', 'attributes', 'content',
+                 'parent', '_size_bytes', '_start_cluster', '_entry_start',
+                 '_create_millis', '_create_time', '_create_date',
+                 '_last_open_date', '_change_time', '_change_date')
 
     def __init__(self,
                  short_name,
@@ -54,6 +85,9 @@ class File:
         self.short_name = short_name
         self.long_name = long_name
         self.attributes = attributes
+        self.content = None
+        self.parent = None
+        self._entry_start = -1
         if create_datetime is None:
             create_datetime = datetime.datetime.now()
         self.create_datetime = create_datetime
@@ -68,6 +102,68 @@ class File:
         self._size_bytes = size_bytes
         self._start_cluster = start_cluster
 
+    @classmethod
+    def from_raw(cls, short_name, long_name, attributes,
+                 create_millis, create_time, create_date,
+                 last_open_date, change_time, change_date,
+                 size_bytes=0, start_cluster=-1):
+        """
+        Creates file from the raw values of the directory entry
+        """
+        file = cls.__new__(cls)
+        file.short_name = short_name
+        file._long_name = long_name if long_name != short_name else None
+        file.attributes = attributes
+        file.content = None
+        file.parent = None
+        file._entry_start = -1
+        file._create_millis = create_millis
+        file._create_time = create_time
+        file._create_date = create_date
+        file._last_open_date = last_open_date
+        file._change_time = change_time
+        file._change_date = change_date
+        file._size_bytes = size_bytes
+        file._start_cluster = start_cluster
+        return file
+
+    @property
+    def long_name(self):
+        return self.short_name if self._long_name is None else self._long_name
+
+    @long_name.setter
+    def long_name(self, long_name):
+        self._long_name = long_name if long_name != self.short_name else None
+
+    @property
+    def create_datetime(self):
+        return decode_datetime(self._create_date, self._create_time,
+                                self._create_millis)
+
+    @create_datetime.setter
+    def create_datetime(self, create_datetime):
+        self._create_time = bytes_parsers.time_to_int(create_datetime.time())
+        self._create_date = bytes_parsers.date_to_int(create_datetime.date())
+        self._create_millis = create_datetime.second % 2 * 1000 + \
+            create_datetime.microsecond // 1000
+
+    @property
+    def last_open_date(self):
+        return decode_date(self._last_open_date)
+
+    @last_open_date.setter
+    def last_open_date(self, last_open_date):
+        self._last_open_date = bytes_parsers.date_to_int(last_open_date)
+
+    @property
+    def change_datetime(self):
+        return decode_datetime(self._change_date, self._change_time)
+
+    @change_datetime.setter
+    def change_datetime(self, change_datetime):
+        self._change_time = bytes_parsers.time_to_int(change_datetime.time())
+        self._change_date = bytes_parsers.date_to_int(change_datetime.date())
+
     @property
     def is_read_only(self):
         return bool(self.attributes & READ_ONLY)
@@ -110,9 +206,12 @@ class File:
         return self.short_name == other.short_name \
                and self.long_name == other.long_name \
                and self.attributes == other.attributes \
-               and self.create_datetime == other.create_datetime \
-               and self.last_open_date == other.last_open_date \
-               and self.change_datetime == other.change_datetime \
+               and self._create_date == other._create_date \
+               and self._create_time == other._create_time \
+               and self._create_millis == other._create_millis \
+               and self._last_open_date == other._last_open_date \
+               and self._change_date == other._change_date \
+               and self._change_time == other._change_time \
                and self._size_bytes == other._size_bytes
 
     def _eq_debug(self, other):
@@ -164,12 +263,54 @@ class File:
                 hierarchy[file.name] = file.get_dir_hierarchy()
         return hierarchy
 
+    def iter_tree(self, recursive=True):
+        """
+        Yields files of the directory depth-first, every directory goes
+        right before its content (only the content of the directory
+        itself unless recursive)
+        """
+        iterators = [iter(self.content or ())]
+        while iterators:
+            file = next(iterators[-1], None)
+            if file is None:
+                iterators.pop()
+                continue
+            yield file
+            if recursive and file.is_directory:
+                iterators.append(iter(file.content or ()))
+
     def get_file_content(self, fat_reader):
         content = fat_reader.get_data_from_cluster_chain(self._start_cluster)
         if self._size_bytes >= 0:
             return content[:self._size_bytes]
         return content
 
+    def iter_file_content(self, fat_reader, offset=0, length=None):
+        """
+        Yields file content (or its part of the given length starting at
+        offset) chunk by chunk without reading the clusters before offset
+        """
+        end = self._size_bytes if self._size_bytes >= 0 else None
+        if length is not None:
+            end = offset + length if end is None else min(end,
+                                                          offset + length)
+        if end is not None and offset >= end:
+            return
+
+        skip_clusters = offset // fat_reader.get_cluster_size()
+        position = skip_clusters * fat_reader.get_cluster_size()
+        for chunk in fat_reader.iter_data_from_cluster_chain(
+                self._start_cluster, skip_clusters):
+            chunk_end = position + len(chunk)
+            if end is not None and chunk_end > end:
+                chunk = chunk[:end - position]
+            if position < offset:
+                chunk = chunk[offset - position:]
+            yield chunk
+            if end is not None and chunk_end >= end:
+                return
+            position = chunk_end
+
     def to_directory_entries(self, is_dot_self_entry=False,
                              is_dot_parent_entry=False):
         entries = list()
@@ -208,12 +349,10 @@ class File:
         return entries
 
     def _write_dates(self, file_info_entry):
-        file_info_entry[14:14 + 4] = \
-            bytes_parsers.datetime_to_bytes(self.create_datetime)
-        file_info_entry[18:18 + 2] = \
-            bytes_parsers.date_to_bytes(self.last_open_date)
-        file_info_entry[22:22 + 4] = \
-            bytes_parsers.datetime_to_bytes(self.change_datetime)
+        struct.pack_into('<HHH', file_info_entry, 14, self._create_time,
+                         self._create_date, self._last_open_date)
+        struct.pack_into('<HH', file_info_entry, 22, self._change_time,
+                         self._change_date)
 
     def _write_size(self, file_info_entry):
         if not self.is_directory:
@@ -330,10 +469,10 @@ def to_lfn_parts(name, checksum=0):
                 part[pos + 1] = name_bytes[i + 1]
                 i += 2
             elif i == len(name_bytes):
-                part[pos:pos + 1] = b'\x00\x00'
+                part[pos:pos + 2] = b'\x00\x00'
                 i += 2
             else:
-                part[pos:pos + 1] = b'\xff\xff'
+                part[pos:pos + 2] = b'\xff\xff'
                 i += 2
 
         part[0] = part_number if i < len(name_bytes) else 0x40 + part_number
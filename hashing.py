@@ -0,0 +1,182 @@
+# !/usr/bin/env python3
+"""
+Content digests of all the files of the image and groups of files with
+duplicate content. Extents of every file are streamed once with
+Fat32Reader.read_at (no shared file position where os.pread exists),
+files are hashed in a thread pool. Digests
+can be cached in the tree index keyed by first cluster and size, they
+are dropped when the index is rebuilt for the changed image.
+"""
+import concurrent.futures
+import hashlib
+import os
+
+import treeindex
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+DEFAULT_ALGORITHM = "sha256"
+DEFAULT_WORKERS = min(8, os.cpu_count() or 1)
+READ_CHUNK_SIZE = 2 ** 20
+# xxhash algorithms and digest sizes of their blake2b replacements used
+# when xxhash is not installed
+XXHASH_ALGORITHMS = {"xxh64": 8, "xxh3_64": 8,
+                     "xxh128": 16, "xxh3_128": 16}
+
+
+def get_algorithm_name(algorithm):
+    """
+    Returns name of the algorithm actually used, it differs from the
+    requested one if the algorithm is replaced by blake2b
+    """
+    if algorithm in XXHASH_ALGORITHMS and xxhash is None:
+        return "blake2b-{:d}".format(XXHASH_ALGORITHMS[algorithm] * 8)
+    return algorithm
+
+
+def new_hash(algorithm):
+    if algorithm in XXHASH_ALGORITHMS:
+        if xxhash is None:
+            return hashlib.blake2b(
+                digest_size=XXHASH_ALGORITHMS[algorithm])
+        return getattr(xxhash, algorithm)()
+    try:
+        return hashlib.new(algorithm)
+    except ValueError:
+        raise ValueError("Unknown hash algorithm: " + algorithm)
+
+
+def get_file_digest(fat_reader, file, algorithm=DEFAULT_ALGORITHM,
+                    byte_ranges=None):
+    """
+    Returns digest of the file content, byte_ranges of the file are found
+    by the caller when several files are hashed in parallel (the FAT is
+    read with the shared position of the image file)
+    """
+    if byte_ranges is None:
+        byte_ranges = fat_reader.get_file_byte_ranges(file)
+    file_hash = new_hash(algorithm)
+    for offset, length in byte_ranges:
+        for chunk_start in range(0, length, READ_CHUNK_SIZE):
+            file_hash.update(fat_reader.read_at(
+                offset + chunk_start,
+                min(READ_CHUNK_SIZE, length - chunk_start)))
+    return file_hash.digest()
+
+
+class HashReport:
+    def __init__(self, algorithm):
+        self.algorithm = algorithm
+        # (path, size, digest)
+        self.files = list()
+        self.hashed_files = 0
+        self.hashed_bytes = 0
+        self.cached_files = 0
+        # (size, paths) of the files with equal content, the largest
+        # waste first
+        self.duplicates = list()
+
+    @property
+    def wasted_bytes(self):
+        return sum(size * (len(paths) - 1) for size, paths in self.duplicates)
+
+    def to_dict(self, top=None):
+        return {
+            "algorithm": self.algorithm,
+            "files": [{"path": path, "size": size, "digest": digest.hex()}
+                      for path, size, digest in self.files],
+            "hashed_files": self.hashed_files,
+            "hashed_bytes": self.hashed_bytes,
+            "cached_files": self.cached_files,
+            "wasted_bytes": self.wasted_bytes,
+            "duplicates": [{"size": size, "paths": paths}
+                           for size, paths in self.duplicates[:top]],
+        }
+
+    def get_report_str(self, top=None):
+        lines = ["{}  {}".format(digest.hex(), path)
+                 for path, _, digest in self.files]
+        lines.append("Duplicate groups: {:d}, wasted {:d} bytes "
+                     "({}, {:d} files hashed, {:d} bytes read, {:d} files "
+                     "from cache):".format(
+                         len(self.duplicates), self.wasted_bytes,
+                         self.algorithm, self.hashed_files,
+                         self.hashed_bytes, self.cached_files))
+        for size, paths in self.duplicates[:top]:
+            lines.append("\t{:d} bytes x {:d}:".format(size, len(paths)))
+            lines += ["\t\t" + path for path in paths]
+        return "\n".join(lines)
+
+
+def hash_image(fat_reader, root, algorithm=DEFAULT_ALGORITHM,
+               workers=DEFAULT_WORKERS, index_path=None):
+    """
+    Returns HashReport of the files of the tree. With index_path digests
+    cached in the index are reused and new ones are saved to it, if the
+    index is up to date with the image.
+    """
+    algorithm_name = get_algorithm_name(algorithm)
+    # unknown algorithm fails before anything is read
+    new_hash(algorithm)
+    report = HashReport(algorithm_name)
+    index = treeindex.read_index(index_path) if index_path else None
+    if index is not None and \
+            index.fingerprint != treeindex.get_fingerprint(fat_reader):
+        # digests of the changed image are not reused or saved
+        index = None
+    cached = index.digests if index is not None else dict()
+
+    files = sorted(((file.get_absolute_path(), file)
+                    for file in root.iter_tree()
+                    if not file.is_directory),
+                   key=lambda item: item[0])
+    digests = dict()
+    keys = dict()
+    for path, file in files:
+        key = (algorithm_name, max(0, file._start_cluster),
+               file._size_bytes)
+        keys[path] = key
+        if key in digests:
+            continue
+        if key in cached:
+            digests[key] = cached[key]
+            report.cached_files += 1
+        elif file._size_bytes <= 0 or file._start_cluster < 2:
+            digests[key] = new_hash(algorithm).digest()
+        else:
+            digests[key] = None
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        futures = dict()
+        for path, file in files:
+            key = keys[path]
+            if digests[key] is None and key not in futures:
+                futures[key] = executor.submit(
+                    get_file_digest, fat_reader, file, algorithm,
+                    fat_reader.get_file_byte_ranges(file))
+                report.hashed_files += 1
+                report.hashed_bytes += file._size_bytes
+        for key, future in futures.items():
+            digests[key] = future.result()
+
+    groups = dict()
+    for path, file in files:
+        key = keys[path]
+        report.files.append((path, file._size_bytes, digests[key]))
+        if file._size_bytes > 0:
+            groups.setdefault((digests[key], file._size_bytes),
+                              dict()).setdefault(key, list()).append(path)
+    # files sharing the clusters (cross-linked) waste nothing
+    report.duplicates = sorted(
+        ((size, [paths[0] for paths in chains.values()])
+         for (_, size), chains in groups.items() if len(chains) > 1),
+        key=lambda group: (-group[0] * (len(group[1]) - 1), group[1]))
+
+    if index is not None and report.hashed_files > 0:
+        treeindex.save_digests(index_path, index, {
+            key: digest for key, digest in digests.items()
+            if key not in cached and key[1] >= 2})
+    return report
@@ -0,0 +1,177 @@
+# !/usr/bin/env python3
+"""
+Difference of two FAT32 images (or two snapshots of the same one).
+Trees are compared by paths and directory entry metadata first, content
+is compared only for files whose size is equal but metadata differs (or
+for all the files of equal size if asked). Content is compared by hashes
+of its blocks (clusters of the image with smaller clusters), computed in
+a thread pool reading the images with Fat32Reader.read_at.
+"""
+import concurrent.futures
+import hashlib
+import os
+
+BLOCK_DIGEST_SIZE = 16
+DEFAULT_WORKERS = min(8, os.cpu_count() or 1)
+# clusters read at once by one read_at
+READ_CHUNK_CLUSTERS = 256
+
+
+class DiffReport:
+    def __init__(self):
+        self.added = list()
+        self.removed = list()
+        # (path, changed blocks) of the files with changed content
+        self.modified = list()
+        # files with equal content and changed directory entry
+        self.metadata_changed = list()
+        self.compared_files = 0
+        self.hashed_blocks = 0
+
+    @property
+    def has_differences(self):
+        return bool(self.added or self.removed or self.modified or
+                    self.metadata_changed)
+
+    def sort(self):
+        self.added.sort()
+        self.removed.sort()
+        self.modified.sort()
+        self.metadata_changed.sort()
+
+    def to_dict(self):
+        return {
+            "added": self.added,
+            "removed": self.removed,
+            "modified": [{"path": path, "changed_blocks": blocks}
+                         for path, blocks in self.modified],
+            "metadata_changed": self.metadata_changed,
+            "compared_files": self.compared_files,
+            "hashed_blocks": self.hashed_blocks,
+        }
+
+    def get_report_str(self):
+        lines = ["A " + path for path in self.added]
+        lines += ["D " + path for path in self.removed]
+        lines += ["M {} ({:d} blocks changed)".format(path, blocks)
+                  if blocks >= 0 else "M " + path
+                  for path, blocks in self.modified]
+        lines += ["T " + path for path in self.metadata_changed]
+        lines.append("Added: {:d}, removed: {:d}, modified: {:d}, "
+                     "metadata changed: {:d} ({:d} files compared by "
+                     "content, {:d} blocks hashed)".format(
+                         len(self.added), len(self.removed),
+                         len(self.modified), len(self.metadata_changed),
+                         self.compared_files, self.hashed_blocks))
+        return "\n".join(lines)
+
+
+def flatten_tree(root):
+    """
+    Returns dict of absolute path -> file of the tree, paths of the
+    directories end with "/"
+    """
+    return {file.get_absolute_path() + ("/" if file.is_directory else ""):
+            file for file in root.iter_tree()}
+
+
+def is_metadata_equal(file, other_file):
+    """
+    Compares raw values of the directory entries, so undecodable dates
+    are compared as they are stored
+    """
+    return file._size_bytes == other_file._size_bytes and \
+        file.attributes == other_file.attributes and \
+        file._change_date == other_file._change_date and \
+        file._change_time == other_file._change_time and \
+        file._create_date == other_file._create_date and \
+        file._create_time == other_file._create_time and \
+        file._create_millis == other_file._create_millis
+
+
+def get_block_hashes(fat_reader, file, block_size, byte_ranges=None):
+    """
+    Returns list of digests of the file content blocks, the image is read
+    with read_at, so the hashes of several files may be computed
+    in parallel once their byte_ranges are found (the FAT is read with
+    the shared position of the image file)
+    """
+    if byte_ranges is None:
+        byte_ranges = fat_reader.get_file_byte_ranges(file)
+    chunk_size = max(block_size,
+                     fat_reader.get_cluster_size() * READ_CHUNK_CLUSTERS)
+    hashes = list()
+    for offset, length in byte_ranges:
+        for chunk_start in range(0, length, chunk_size):
+            data = fat_reader.read_at(offset + chunk_start,
+                                      min(chunk_size, length - chunk_start))
+            for block_start in range(0, len(data), block_size):
+                hashes.append(hashlib.blake2b(
+                    data[block_start:block_start + block_size],
+                    digest_size=BLOCK_DIGEST_SIZE).digest())
+    return hashes
+
+
+def _count_changed_blocks(old_reader, old_file, old_ranges, new_reader,
+                          new_file, new_ranges, block_size):
+    """
+    Returns (changed blocks, hashed blocks) of the files of equal size
+    """
+    old_hashes = get_block_hashes(old_reader, old_file, block_size,
+                                  old_ranges)
+    new_hashes = get_block_hashes(new_reader, new_file, block_size,
+                                  new_ranges)
+    changed = sum(1 for old_hash, new_hash in zip(old_hashes, new_hashes)
+                  if old_hash != new_hash)
+    return changed, len(old_hashes) + len(new_hashes)
+
+
+def diff(old_reader, new_reader, compare_content=False,
+         workers=DEFAULT_WORKERS, old_root=None, new_root=None):
+    """
+    Returns DiffReport of the changes from the old image to the new one.
+    With compare_content content of the files with equal metadata is
+    compared too. Roots of the images are parsed unless they are given.
+    """
+    if old_root is None:
+        old_root = old_reader.get_root_directory()
+    if new_root is None:
+        new_root = new_reader.get_root_directory()
+    old_files = flatten_tree(old_root)
+    new_files = flatten_tree(new_root)
+    block_size = min(old_reader.get_cluster_size(),
+                     new_reader.get_cluster_size())
+
+    report = DiffReport()
+    compared = list()
+    for path, file in new_files.items():
+        old_file = old_files.get(path)
+        if old_file is None:
+            report.added.append(path)
+        elif file.is_directory:
+            # changes of the directory show up as changes of its content
+            continue
+        elif old_file.size_bytes != file.size_bytes:
+            report.modified.append((path, -1))
+        else:
+            is_equal = is_metadata_equal(old_file, file)
+            if compare_content or not is_equal:
+                compared.append((path, old_file, file, is_equal))
+    report.removed = [path for path in old_files if path not in new_files]
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        futures = [(path, is_equal, executor.submit(
+            _count_changed_blocks, old_reader, old_file,
+            old_reader.get_file_byte_ranges(old_file), new_reader, file,
+            new_reader.get_file_byte_ranges(file), block_size))
+            for path, old_file, file, is_equal in compared]
+        for path, is_equal, future in futures:
+            changed, hashed = future.result()
+            report.compared_files += 1
+            report.hashed_blocks += hashed
+            if changed > 0:
+                report.modified.append((path, changed))
+            elif not is_equal:
+                report.metadata_changed.append(path)
+    report.sort()
+    return report
@@ -0,0 +1,250 @@
+# !/usr/bin/env python3
+"""
+Write-ahead (redo) journal of the image edits kept in a sidecar file.
+
+Writes of a transaction are kept in memory (pages of the image) and are
+visible to reads through JournaledFile. On commit the pages are written
+to the journal with a commit record and synced, then applied to the
+image. A journal left by a crash is replayed on the next open if its
+commit record is complete, otherwise it is discarded and the image
+stays as it was before the transaction.
+
+Writes to the areas which are not referenced by the committed image
+(e.g. content of the newly allocated clusters) go to the image directly
+and are synced before the commit record, like the ordered data mode
+of the journaling file systems.
+"""
+import os
+import struct
+import zlib
+
+JOURNAL_FILE_SUFFIX = ".journal"
+JOURNAL_MAGIC = b'FAT32JNL'
+JOURNAL_VERSION = 1
+PAGE_SIZE = 4096
+
+# magic, version
+_HEADER = struct.Struct('<8sH')
+# record type, image offset, data length (records amount and checksum
+# of the records for the commit record)
+_RECORD = struct.Struct('<BQI')
+RECORD_PAGE = 1
+RECORD_COMMIT = 2
+
+
+def get_journal_path(image_path):
+    return image_path + JOURNAL_FILE_SUFFIX
+
+
+class JournalError(Exception):
+    def __init__(self, message='', *args):
+        super().__init__(message, *args)
+        self.message = message
+
+
+class JournaledFile:
+    """
+    File-like wrapper of the image file, see the module description.
+    is_unreferenced(offset, length) tells whether the area may be written
+    directly during the transaction.
+    """
+
+    def __init__(self, image_file, journal_path, is_unreferenced=None):
+        self._file = image_file
+        self._journal_path = journal_path
+        self.is_unreferenced = is_unreferenced
+        self._pages = dict()
+        self._has_direct_writes = False
+        self._position = 0
+        self.in_transaction = False
+        self.commits = 0
+        self.recovered_pages = self._recover()
+
+    def _recover(self):
+        """
+        Replays committed journal left by the previous run, returns amount
+        of replayed pages
+        """
+        try:
+            with open(self._journal_path, "rb") as journal:
+                data = journal.read()
+        except FileNotFoundError:
+            return 0
+        pages = _parse_journal(data)
+        if pages:
+            self._apply(pages)
+        os.remove(self._journal_path)
+        return len(pages)
+
+    def begin(self):
+        if self.in_transaction:
+            raise JournalError("Transaction is already started")
+        self.in_transaction = True
+
+    def commit(self):
+        if not self.in_transaction:
+            raise JournalError("There is no transaction to commit")
+        self.in_transaction = False
+        if self._has_direct_writes:
+            self._sync_file(self._file)
+            self._has_direct_writes = False
+        if not self._pages:
+            return
+        pages = [(page_number * PAGE_SIZE, bytes(page))
+                 for page_number, page in sorted(self._pages.items())]
+        self._write_journal(pages)
+        self._apply(pages)
+        self._pages.clear()
+        os.remove(self._journal_path)
+        self.commits += 1
+
+    def _write_journal(self, pages):
+        records = list()
+        for offset, page in pages:
+            records.append(_RECORD.pack(RECORD_PAGE, offset, len(page)))
+            records.append(page)
+        records = b''.join(records)
+        with open(self._journal_path, "wb") as journal:
+            journal.write(_HEADER.pack(JOURNAL_MAGIC, JOURNAL_VERSION))
+            journal.write(records)
+            journal.write(_RECORD.pack(RECORD_COMMIT, len(pages),
+                                       zlib.crc32(records)))
+            self._sync_file(journal)
+
+    def _apply(self, pages):
+        for offset, page in pages:
+            self._file.seek(offset)
+            self._file.write(page)
+        self._sync_file(self._file)
+
+    def rollback(self):
+        """
+        Discards writes of the transaction. Direct writes are left,
+        they are not referenced by the image.
+        """
+        self.in_transaction = False
+        self._has_direct_writes = False
+        self._pages.clear()
+
+    @staticmethod
+    def _sync_file(file):
+        file.flush()
+        os.fsync(file.fileno())
+
+    def _get_page(self, page_number):
+        page = self._pages.get(page_number)
+        if page is None:
+            self._file.seek(page_number * PAGE_SIZE)
+            page = self._pages[page_number] = \
+                bytearray(self._file.read(PAGE_SIZE))
+        return page
+
+    def _iter_page_parts(self, start, length):
+        """
+        Yields (page number, start in page, end in page, position in data)
+        """
+        position = 0
+        while position < length:
+            page_number, page_start = divmod(start + position, PAGE_SIZE)
+            page_end = min(PAGE_SIZE, page_start + length - position)
+            yield page_number, page_start, page_end, position
+            position += page_end - page_start
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self._file.seek(0, os.SEEK_END)
+        self._position = offset
+        return offset
+
+    def tell(self):
+        return self._position
+
+    def read(self, size=-1):
+        self._file.seek(self._position)
+        data = self._file.read(size)
+        if self._pages and data:
+            data = bytearray(data)
+            for page_number, page_start, page_end, position in \
+                    self._iter_page_parts(self._position, len(data)):
+                page = self._pages.get(page_number)
+                if page is not None:
+                    data[position:position + page_end - page_start] = \
+                        page[page_start:page_end]
+            data = bytes(data)
+        self._position += len(data)
+        return data
+
+    def write(self, data):
+        if not self.in_transaction:
+            self._file.seek(self._position)
+            written = self._file.write(data)
+        elif self.is_unreferenced is not None and \
+                self.is_unreferenced(self._position, len(data)):
+            self._file.seek(self._position)
+            written = self._file.write(data)
+            self._has_direct_writes = True
+            self._update_pages(data)
+        else:
+            for page_number, page_start, page_end, position in \
+                    self._iter_page_parts(self._position, len(data)):
+                page = self._get_page(page_number)
+                page[page_start:page_end] = \
+                    data[position:position + page_end - page_start]
+            written = len(data)
+        self._position += written
+        return written
+
+    def _update_pages(self, data):
+        for page_number, page_start, page_end, position in \
+                self._iter_page_parts(self._position, len(data)):
+            page = self._pages.get(page_number)
+            if page is not None:
+                page[page_start:page_end] = \
+                    data[position:position + page_end - page_start]
+
+    def read_committed(self, offset, length):
+        """
+        Reads the image bypassing writes of the current transaction
+        """
+        self._file.seek(offset)
+        return self._file.read(length)
+
+    def flush(self):
+        if not self.in_transaction:
+            self._file.flush()
+
+    def fileno(self):
+        return self._file.fileno()
+
+    @property
+    def pending_pages(self):
+        return len(self._pages)
+
+
+def _parse_journal(data):
+    """
+    Returns list of (offset, page) of the committed journal or empty list
+    if the journal is incomplete or damaged
+    """
+    if len(data) < _HEADER.size:
+        return list()
+    magic, version = _HEADER.unpack_from(data, 0)
+    if magic != JOURNAL_MAGIC or version != JOURNAL_VERSION:
+        return list()
+    pos = _HEADER.size
+    pages = list()
+    while pos + _RECORD.size <= len(data):
+        record_type, offset, length = _RECORD.unpack_from(data, pos)
+        if record_type == RECORD_COMMIT:
+            records = data[_HEADER.size:pos]
+            if offset == len(pages) and zlib.crc32(records) == length:
+                return pages
+            return list()
+        if record_type != RECORD_PAGE:
+            return list()
+        pos += _RECORD.size
+        pages.append((offset, data[pos:pos + length]))
+        pos += length
+    return list()
@@ -1,9 +1,21 @@
 # !/usr/bin/env python3
 import argparse
+import json
 import platform
+import sys
 from pathlib import Path
 
+import analytics
+import blockcache
+import carving
+import defrag
 import fateditor
+import hashing
+import imagediff
+import journal
+import perfstats
+import treeindex
+import undelete
 from dirbrowser import DirectoryBrowser
 
 
@@ -25,19 +37,93 @@ def main():
         print('File "' + image_file_name + '" not found.')
         return
 
+    read_only = parsed_args.read_only or parsed_args.diff is not None or \
+        parsed_args.hash is not None or parsed_args.undelete is not None \
+        or parsed_args.carve is not None
+    index_path = None
+    if parsed_args.index or parsed_args.index_path:
+        index_path = parsed_args.index_path or \
+                     treeindex.get_index_path(image_file_name)
     try:
-        with open(image_file_name, "r+b") as fi:
-            f = fateditor.Fat32Editor(fi, scandisk)
-            if f.valid:
-                print("Image successfully parsed.")
-            if scandisk:
-                f.scandisk(
-                    find_lost_clusters,
-                    find_intersecting_chains,
-                    check_files_size
-                )
+        with open(image_file_name, "rb" if read_only else "r+b") as fi:
+            stats = perfstats.Stats() if parsed_args.stats else None
+            options = dict(
+                cache_size=parsed_args.cache_size * blockcache.BYTES_PER_MIB,
+                read_ahead_size=parsed_args.read_ahead * 1024,
+                stats=stats)
+            if read_only:
+                f = fateditor.Fat32Reader(fi, **options)
             else:
-                DirectoryBrowser(fat_editor=f).start_interactive_mode()
+                journal_path = journal.get_journal_path(image_file_name) \
+                    if parsed_args.journal else None
+                f = fateditor.Fat32Editor(fi, scandisk,
+                                          journal_path=journal_path,
+                                          flush_policy=parsed_args.flush,
+                                          **options)
+            try:
+                if not read_only and f.journal is not None and \
+                        f.journal.recovered_pages:
+                    print("Journal replayed: {:d} pages restored.".format(
+                        f.journal.recovered_pages))
+                if f.valid and not parsed_args.json:
+                    print("Image successfully parsed.")
+                if parsed_args.analyze:
+                    report = analytics.analyze(f, f.get_root_directory(),
+                                               parsed_args.top)
+                    if parsed_args.json:
+                        print(json.dumps(report.to_dict(), indent=2,
+                                         ensure_ascii=False))
+                    else:
+                        print(report.get_report_str())
+                elif parsed_args.diff is not None:
+                    if run_diff(f, parsed_args.diff, parsed_args.content,
+                                parsed_args.json):
+                        return 1
+                elif parsed_args.hash is not None:
+                    root = f.get_root_directory() if index_path is None \
+                        else treeindex.get_root_directory(f, index_path)
+                    report = hashing.hash_image(f, root, parsed_args.hash,
+                                                index_path=index_path)
+                    if parsed_args.json:
+                        print(json.dumps(report.to_dict(parsed_args.top),
+                                         indent=2, ensure_ascii=False))
+                    else:
+                        print(report.get_report_str(parsed_args.top))
+                elif parsed_args.undelete is not None:
+                    run_undelete(f, parsed_args.undelete, parsed_args.json)
+                elif parsed_args.carve is not None:
+                    report = carving.carve(f, image_file_name,
+                                           parsed_args.carve or None)
+                    if parsed_args.json:
+                        print(json.dumps(report.to_dict(), indent=2,
+                                         ensure_ascii=False))
+                    else:
+                        print(report.get_report_str())
+                elif parsed_args.defrag:
+                    run_defragmentation(f, parsed_args.dry_run)
+                elif scandisk:
+                    f.scandisk(
+                        find_lost_clusters,
+                        find_intersecting_chains,
+                        check_files_size
+                    )
+                else:
+                    root = None
+                    if index_path is not None:
+                        root = treeindex.get_root_directory(f, index_path)
+                    browser = DirectoryBrowser(fat_editor=f, root=root,
+                                               read_only=read_only)
+                    commands = get_batch_commands(parsed_args)
+                    if commands is None:
+                        browser.start_interactive_mode()
+                    elif browser.run_commands(commands,
+                                              parsed_args.stop_on_error) > 0:
+                        return 1
+            finally:
+                f.close()
+                if stats is not None:
+                    print(stats.get_stats_str())
+                    print(f.block_cache.get_stats_str())
     except fateditor.FATReaderError as e:
         print("Error: " + e.message)
         return
@@ -57,6 +143,72 @@ def main():
             print('File "' + image_file_name + '" not found.')
 
 
+def run_defragmentation(fat_editor, dry_run):
+    before, after, defragmenter = defrag.defragment(
+        fat_editor, fat_editor.get_root_directory(), dry_run)
+    print("Before: " + before.get_stats_str())
+    print("{} {:d} chains ({:d} clusters), {:d} chains skipped "
+          "(no free run fits them)".format(
+              "Planned moves of" if dry_run else "Moved",
+              defragmenter.moved_chains, defragmenter.moved_clusters,
+              defragmenter.skipped_chains))
+    if defragmenter.root_skipped:
+        print("Root directory is fragmented and not relocatable")
+    print("After: " + after.get_stats_str())
+
+
+def run_diff(fat_reader, other_image_path, compare_content, as_json):
+    """
+    Prints changes from the image to the other one, returns whether
+    there are any
+    """
+    with open(other_image_path, "rb") as other_file:
+        other_reader = fateditor.Fat32Reader(
+            other_file, cache_size=fat_reader.block_cache.max_bytes,
+            read_ahead_size=fat_reader.read_ahead_size)
+        report = imagediff.diff(fat_reader, other_reader, compare_content)
+    if as_json:
+        print(json.dumps(report.to_dict(), indent=2, ensure_ascii=False))
+    else:
+        print(report.get_report_str())
+    return report.has_differences
+
+
+def run_undelete(fat_reader, output_dir, as_json):
+    """
+    Prints deleted entries of the image, recovers them to the output
+    directory if it is given
+    """
+    report = undelete.scan(fat_reader)
+    if as_json:
+        print(json.dumps(report.to_dict(), indent=2, ensure_ascii=False))
+    else:
+        print(report.get_report_str())
+    if output_dir:
+        recovered = undelete.recover_all(fat_reader, report, output_dir)
+        if not as_json:
+            for path, output_path in recovered:
+                print('Recovered "' + path + '" to "' + output_path + '"')
+
+
+def get_batch_commands(parsed_args):
+    """
+    Returns list of commands to run in batch mode or None if the browser
+    should be started in the interactive mode
+    """
+    if parsed_args.batch is None and not parsed_args.command:
+        return None
+    commands = list()
+    if parsed_args.batch == '-':
+        commands += sys.stdin.read().splitlines()
+    elif parsed_args.batch is not None:
+        with open(parsed_args.batch, encoding="utf-8") as script:
+            commands += script.read().splitlines()
+    if parsed_args.command:
+        commands += parsed_args.command
+    return commands
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Open FAT32 image")
 
@@ -75,8 +227,100 @@ def parse_args():
     parser.add_argument("-z", "--size",
                         action="store_true",
                         help="Scan, find and repair incorrect files' size")
-    return parser.parse_args()
+    parser.add_argument("-a", "--analyze", action="store_true",
+                        help="Print space usage and fragmentation report")
+    parser.add_argument("--top", type=int, default=analytics.DEFAULT_TOP,
+                        metavar="N",
+                        help="Length of the top lists of the report")
+    parser.add_argument("--json", action="store_true",
+                        help="Print the report as JSON")
+    parser.add_argument("-d", "--defrag", action="store_true",
+                        help="Defragment files and directories")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="With --defrag only plan the moves")
+    parser.add_argument("-b", "--batch", metavar="SCRIPT",
+                        help="Run browser commands from the script file "
+                             "('-' for stdin) and exit")
+    parser.add_argument("-c", "--command", action="append", metavar="COMMAND",
+                        help="Run browser command and exit, can be repeated "
+                             "(commands run after the batch script)")
+    parser.add_argument("--stop-on-error", action="store_true",
+                        help="Stop batch run on the first failed command")
+    parser.add_argument("--stats", action="store_true",
+                        help="Collect timing statistics of image access "
+                             "and print them on exit")
+    parser.add_argument("--cache-size", type=int, metavar="MIB",
+                        default=blockcache.DEFAULT_CACHE_SIZE //
+                        blockcache.BYTES_PER_MIB,
+                        help="Size of the sector/cluster cache in MiB, "
+                             "0 disables the cache")
+    parser.add_argument("--index", action="store_true",
+                        help="Load directory tree from the index file, "
+                             "rebuilding it if the image has changed")
+    parser.add_argument("--index-path", metavar="PATH",
+                        help="Path to the index file (implies --index), "
+                             "<image path>" + treeindex.INDEX_FILE_SUFFIX +
+                             " by default")
+    parser.add_argument("--read-ahead", type=int, metavar="KIB",
+                        default=fateditor.DEFAULT_READ_AHEAD_SIZE // 1024,
+                        help="Maximum read-ahead window for sequential "
+                             "cluster chains in KiB, 0 disables read-ahead")
+    parser.add_argument("--journal", action="store_true",
+                        help="Commit every edit through the write-ahead "
+                             "journal <image path>" +
+                             journal.JOURNAL_FILE_SUFFIX + ", journal left "
+                             "by an interrupted run is replayed on open")
+    parser.add_argument("--flush", choices=fateditor.FLUSH_POLICIES,
+                        default=fateditor.FLUSH_PER_WRITE,
+                        help="When written data is flushed to the image: "
+                             "after every write, after every operation "
+                             "(file import, repair, chain move) or on exit")
+    parser.add_argument("--diff", metavar="OTHER_IMAGE",
+                        help="Print files added, removed and modified "
+                             "in the other image (exit code 1 if there "
+                             "are any), both images are opened read-only")
+    parser.add_argument("--content", action="store_true",
+                        help="With --diff compare content of the files "
+                             "with equal size and directory entries too")
+    parser.add_argument("--hash", nargs="?", metavar="ALGORITHM",
+                        const=hashing.DEFAULT_ALGORITHM,
+                        help="Print digests of all the files (sha256 by "
+                             "default, any hashlib algorithm or xxh64, "
+                             "xxh3_64, xxh128, which fall back to blake2b "
+                             "without xxhash) and the largest groups of "
+                             "duplicates (--top), digests are cached in the "
+                             "index with --index")
+    parser.add_argument("--undelete", nargs="?", metavar="OUTPUT_DIR",
+                        const="",
+                        help="List deleted files and whether their content "
+                             "is still free, with OUTPUT_DIR recover them "
+                             "to the directory (the image is opened "
+                             "read-only)")
+    parser.add_argument("--carve", nargs="?", metavar="OUTPUT_DIR",
+                        const="",
+                        help="Find JPEG, PNG, PDF and ZIP files in the free "
+                             "clusters by their signatures, with OUTPUT_DIR "
+                             "extract them to the directory (the image is "
+                             "opened read-only)")
+    parser.add_argument("-r", "--read-only", action="store_true",
+                        help="Open the image for reading only (no write "
+                             "permission needed, safe for parallel "
+                             "readers), commands changing the image are "
+                             "refused")
+    parsed_args = parser.parse_args()
+    if parsed_args.read_only and (
+            parsed_args.scandisk or parsed_args.intersections or
+            parsed_args.lost_clusters or parsed_args.size or
+            parsed_args.defrag or parsed_args.journal):
+        parser.error("scan, repair, defragmentation and journal options "
+                     "cannot be used with --read-only")
+    if parsed_args.hash is not None:
+        try:
+            hashing.new_hash(parsed_args.hash)
+        except ValueError as e:
+            parser.error(str(e))
+    return parsed_args
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,66 @@
+# !/usr/bin/env python3
+import bisect
+import fnmatch
+import re
+
+_GLOB_SPECIAL_CHARS = re.compile(r"[*?\[]")
+
+
+class NameIndex:
+    """
+    Sorted array of case-folded long and short names of the files.
+    Glob patterns with a literal prefix are answered by a binary search
+    for the prefix, other patterns and regexes scan the names only.
+    """
+
+    def __init__(self, files=()):
+        entries = list()
+        for file in files:
+            name = file.name.casefold()
+            entries.append((name, file))
+            short_name = file.short_name.casefold()
+            if short_name != name:
+                entries.append((short_name, file))
+        entries.sort(key=lambda entry: entry[0])
+        self._names = [name for name, _ in entries]
+        self._files = [file for _, file in entries]
+
+    @classmethod
+    def from_tree(cls, root):
+        return cls(root.iter_tree())
+
+    def _iter_range(self, prefix):
+        start = bisect.bisect_left(self._names, prefix)
+        for i in range(start, len(self._names)):
+            if not self._names[i].startswith(prefix):
+                break
+            yield self._names[i], self._files[i]
+
+    def _iter_matches(self, pattern, regex=False):
+        if regex:
+            compiled = re.compile(pattern, re.IGNORECASE)
+            candidates = zip(self._names, self._files)
+            return (file for name, file in candidates
+                    if compiled.search(name))
+
+        pattern = pattern.casefold()
+        prefix = _GLOB_SPECIAL_CHARS.split(pattern, maxsplit=1)[0]
+        compiled = re.compile(fnmatch.translate(pattern), re.DOTALL)
+        return (file for name, file in self._iter_range(prefix)
+                if compiled.match(name))
+
+    def search(self, pattern, regex=False, predicate=None):
+        """
+        Yields files which long or short name matches glob pattern
+        (or regex), each file only once
+        """
+        found = set()
+        for file in self._iter_matches(pattern, regex):
+            if id(file) in found:
+                continue
+            found.add(id(file))
+            if predicate is None or predicate(file):
+                yield file
+
+    def __len__(self):
+        return len(self._names)
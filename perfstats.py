@@ -0,0 +1,91 @@
+# !/usr/bin/env python3
+import time
+from collections import OrderedDict
+
+
+class Stats:
+    """
+    Counters and timers of the reader and editor hot paths.
+    Counters are plain sums (FAT lookups, bytes read...), timers keep
+    amount of calls and total time spent.
+    """
+    enabled = True
+
+    def __init__(self):
+        self.counters = OrderedDict()
+        self.timers = OrderedDict()
+
+    def add(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_time(self, name, seconds):
+        calls, total = self.timers.get(name, (0, 0.0))
+        self.timers[name] = (calls + 1, total + seconds)
+
+    def timer(self, name):
+        return _Timer(self, name)
+
+    def to_dict(self):
+        return {
+            "counters": dict(self.counters),
+            "timers": {name: {"calls": calls, "seconds": total}
+                       for name, (calls, total) in self.timers.items()}
+        }
+
+    def get_stats_str(self):
+        lines = ["Statistics:"]
+        for name, value in self.counters.items():
+            lines.append("\t{}: {:d}".format(name, value))
+        for name, (calls, total) in self.timers.items():
+            lines.append("\t{}: {:d} calls, {:.6f} s ({:.3f} ms per call)"
+                         .format(name, calls, total, total / calls * 1000))
+        return "\n".join(lines)
+
+
+class NullStats:
+    """
+    Stats which are not collected, used when instrumentation is off
+    """
+    enabled = False
+
+    def add(self, name, value=1):
+        pass
+
+    def add_time(self, name, seconds):
+        pass
+
+    def timer(self, name):
+        return _NULL_TIMER
+
+    def to_dict(self):
+        return {"counters": {}, "timers": {}}
+
+    def get_stats_str(self):
+        return "Statistics are not collected"
+
+
+class _Timer:
+    def __init__(self, stats, name):
+        self._stats = stats
+        self._name = name
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stats.add_time(self._name, time.perf_counter() - self._start)
+        return False
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+NULL_STATS = NullStats()
@@ -0,0 +1,139 @@
+# !/usr/bin/env python3
+"""
+Several images opened in one job. Readers and editors of the images share
+one block cache (sectors of the FAT and clusters), so the memory budget
+is split between the images by LRU according to their use. Files and
+directories are copied between the images by streaming cluster extents
+from the reader of one image to the editor of another.
+"""
+from collections import OrderedDict
+
+import blockcache
+import dirbrowser
+import fateditor
+import fsobjects
+
+DEFAULT_CACHE_SIZE = 64 * blockcache.BYTES_PER_MIB
+
+
+class SessionError(Exception):
+    def __init__(self, message='', *args):
+        super().__init__(message, *args)
+        self.message = message
+
+
+class Session:
+    def __init__(self, cache_size=DEFAULT_CACHE_SIZE,
+                 read_ahead_size=fateditor.DEFAULT_READ_AHEAD_SIZE,
+                 stats=None):
+        self.block_cache = blockcache.BlockCache(cache_size)
+        self.read_ahead_size = read_ahead_size
+        self.stats = stats
+        # name -> (image file, reader or editor)
+        self._images = OrderedDict()
+
+    def open(self, image_path, name=None, read_only=False, **editor_options):
+        """
+        Opens the image (with Fat32Reader if read_only, otherwise with
+        Fat32Editor getting editor_options), returns the reader or editor
+        """
+        name = image_path if name is None else name
+        if name in self._images:
+            raise SessionError('Image "' + name + '" is already opened.')
+        image_file = open(image_path, "rb" if read_only else "r+b")
+        options = dict(read_ahead_size=self.read_ahead_size,
+                       stats=self.stats,
+                       block_cache=self.block_cache.namespace(name))
+        try:
+            if read_only:
+                reader = fateditor.Fat32Reader(image_file, **options)
+            else:
+                options.update(editor_options)
+                reader = fateditor.Fat32Editor(image_file, **options)
+        except BaseException:
+            image_file.close()
+            raise
+        self._images[name] = (image_file, reader)
+        return reader
+
+    def __getitem__(self, name):
+        return self._images[name][1]
+
+    def __contains__(self, name):
+        return name in self._images
+
+    @property
+    def names(self):
+        return list(self._images)
+
+    def close_image(self, name):
+        image_file, reader = self._images.pop(name)
+        try:
+            reader.close()
+            reader.block_cache.clear()
+        finally:
+            image_file.close()
+
+    def close(self):
+        while self._images:
+            self.close_image(next(iter(self._images)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def copy(self, source_name, source_path, target_name, target_path,
+             source_root=None, target_root=None) -> fsobjects.File:
+        """
+        Copies file or directory (recursively) at source_path of one image
+        to the directory at target_path of another one, returns the copy.
+        Roots of the images are parsed unless they are given.
+        """
+        source = self[source_name]
+        target = self[target_name]
+        if not isinstance(target, fateditor.Fat32Editor):
+            raise SessionError('Image "' + target_name +
+                               '" is opened read-only.')
+        file = _find(source, source_path, source_root)
+        directory = _find(target, target_path, target_root)
+        if not directory.is_directory:
+            raise SessionError('"' + target_path + '" is not a directory.')
+        with target.operation():
+            return copy_file(source, file, target, directory)
+
+
+def _find(reader, path, root=None):
+    if root is None:
+        root = reader.get_root_directory()
+    path = path.replace("\\", "/").strip("/")
+    file = root if path in ("", ".") else dirbrowser.find(path, root)
+    if file is None:
+        raise SessionError('"' + path + '" not found.')
+    return file
+
+
+def copy_file(source, file, target, directory):
+    """
+    Copies file or directory (recursively) read by source reader to the
+    directory of target editor, returns the copy. Content of the root is
+    copied to the directory itself.
+    """
+    if file.parent is None:
+        for child in file.content or ():
+            copy_file(source, child, target, directory)
+        return directory
+    timestamps = (file.create_datetime, file.last_open_date,
+                  file.change_datetime)
+    if file.is_directory:
+        copy = target.create_directory(file.name, directory, *timestamps)
+        for child in file.content or ():
+            copy_file(source, child, target, copy)
+    else:
+        copy = target.write_stream_to_image(
+            file.name, file.iter_file_content(source), directory,
+            *timestamps)
+    if directory.content is not None:
+        directory.content.append(copy)
+    return copy
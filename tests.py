@@ -1,11 +1,33 @@
 # !/usr/bin/env python3
+import asyncio
+import concurrent.futures
+import contextlib
 import datetime
+import hashlib
+import io
+import json
 import os
+import tempfile
 import unittest
+import zipfile
 
+import analytics
+import asyncreader
+import blockcache
+import carving
+import defrag
 import dirbrowser
 import fateditor
+import fatgen
 import fsobjects
+import hashing
+import imagediff
+import journal
+import nameindex
+import perfstats
+import session
+import treeindex
+import undelete
 from bytes_parsers import BytesParser
 
 TEST_IMAGE_ARCHIVE_URL = "https://github.com/Leoltron/FAT32Explorer/raw/master/TEST-IMAGE.zip"
@@ -32,6 +54,18 @@ class FileTests(unittest.TestCase):
         folder2.parent = folder1
         self.assertEqual(folder2.get_absolute_path(), "root/Folder1/Folder2")
 
+    def test_iter_tree(self):
+        root = fsobjects.File("root", "root", fsobjects.DIRECTORY)
+        folder = fsobjects.File("Folder", "Folder", fsobjects.DIRECTORY)
+        empty = fsobjects.File("Empty", "Empty", fsobjects.DIRECTORY)
+        first = fsobjects.File("First", "First")
+        second = fsobjects.File("Second", "Second")
+        root.content = [folder, second]
+        folder.content = [first, empty]
+        self.assertEqual(list(root.iter_tree()),
+                         [folder, first, empty, second])
+        self.assertEqual(list(root.iter_tree(False)), [folder, second])
+
     def test_size_format_byte(self):
         file = fsobjects.File("file", "file", size_bytes=1)
         self.assertEqual("1 byte", file.get_size_str())
@@ -77,6 +111,30 @@ class FileTests(unittest.TestCase):
         file = fsobjects.File("file", "file")
         self.assertEqual("no attributes", file.get_attributes_str())
 
+    def test_no_instance_dict(self):
+        file = fsobjects.File("file", "file")
+        self.assertFalse(hasattr(file, "__dict__"))
+
+    def test_raw_dates(self):
+        # 17:35:54 29.07.2017
+        file = fsobjects.File.from_raw("FILE.TXT", "", 0, 76, 0x8C7B, 0x4AFD,
+                                       0x4AFD, 0x8C7B, 0x4AFD, 10, 5)
+        self.assertEqual(file.create_datetime,
+                         datetime.datetime(2017, 7, 29, 17, 35, 54, 76000))
+        self.assertEqual(file.last_open_date, datetime.date(2017, 7, 29))
+        self.assertEqual(file.change_datetime,
+                         datetime.datetime(2017, 7, 29, 17, 35, 54))
+        file.change_datetime = datetime.datetime(2000, 1, 1, 12, 12, 12)
+        self.assertEqual(file.to_directory_entries()[-1][22:26],
+                         b'\x86\x61\x21\x28')
+
+    def test_zero_dates(self):
+        file = fsobjects.File.from_raw("FILE.TXT", "", 0, 0, 0, 0, 0, 0, 0)
+        self.assertEqual(file.create_datetime, file.create_datetime)
+        self.assertEqual(file.create_datetime, fsobjects.UNKNOWN_DATETIME)
+        self.assertEqual(file.change_datetime, fsobjects.UNKNOWN_DATETIME)
+        self.assertEqual(file.last_open_date, fsobjects.UNKNOWN_DATE)
+
 
 class BytesParserTests(unittest.TestCase):
     def test_parse_int_simple(self):
@@ -111,6 +169,11 @@ class BytesParserTests(unittest.TestCase):
         parser = BytesParser("Hello, world!".encode(encoding=ASCII))
         self.assertEqual("world!", parser.parse_string(7, 6, encoding=ASCII))
 
+    def test_parse_ascii_replace_errors(self):
+        parser = BytesParser(b'a\x80b\xffc')
+        self.assertEqual("a?b?c",
+                         parser.parse_ascii_string_replace_errors(0, 5, "?"))
+
     def test_parse_time_start(self):  # 1:25:00
         # [0010000000001011]
         parser = BytesParser(b'\x20\x0b')
@@ -148,6 +211,38 @@ class BytesParserTests(unittest.TestCase):
                          parser.parse_date(5))
 
 
+class BlockCacheTests(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = blockcache.BlockCache(max_bytes=8)
+        cache.put(1, b'1111')
+        cache.put(2, b'2222')
+        cache.get(1)
+        cache.put(3, b'3333')
+        self.assertIn(1, cache)
+        self.assertNotIn(2, cache)
+        self.assertIn(3, cache)
+        self.assertEqual(cache.size_bytes, 8)
+
+    def test_hits_misses(self):
+        cache = blockcache.BlockCache()
+        self.assertIsNone(cache.get(1))
+        cache.put(1, b'data')
+        self.assertEqual(cache.get(1), b'data')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_update(self):
+        cache = blockcache.BlockCache()
+        cache.put(1, b'abcdef')
+        cache.update(1, 4, b'XYZ')
+        self.assertEqual(cache.get(1), b'abcdXY')
+
+    def test_disabled(self):
+        cache = blockcache.BlockCache(max_bytes=0)
+        cache.put(1, b'data')
+        self.assertFalse(cache.enabled)
+        self.assertIsNone(cache.get(1))
+
+
 class FatReaderStaticTests(unittest.TestCase):
     def test_file_parse(self):
         file_expected = fsobjects.File('SHORT.TXT', '', fsobjects.ARCHIVE,
@@ -223,6 +318,233 @@ class FatReaderTests(unittest.TestCase):
             f.scandisk(True, True, True)
             self.assert_test_image(f)
 
+    def test_stats(self):
+        stats = perfstats.Stats()
+        with open(get_test_image_path(), "rb") as fi:
+            f = fateditor.Fat32Reader(fi, stats=stats)
+            f.get_root_directory()
+        self.assertGreater(stats.counters["fat_lookups"], 0)
+        self.assertGreater(stats.counters["dir_entries_parsed"], 0)
+        self.assertGreater(stats.counters["bytes_read"], 0)
+        self.assertEqual(stats.timers["open"][0], 1)
+        self.assertEqual(stats.timers["tree_parse"][0], 1)
+        self.assertIn("fat_lookups", stats.to_dict()["counters"])
+
+    def test_async_reader(self):
+        async def read(fat_reader):
+            async with asyncreader.AsyncFat32Reader(fat_reader) as reader:
+                names = [f.name for f in await reader.list_dir("/Folder1")]
+                stat = await reader.stat("Folder1/SHORT.TXT")
+                stream = await reader.open("/Folder1/SHORT.TXT")
+                head = await stream.read(10)
+                content = head + b''.join([chunk async for chunk in stream])
+                return names, stat, content
+
+        with open(get_test_image_path(), "rb") as fi:
+            f = fateditor.Fat32Reader(fi)
+            names, stat, content = asyncio.run(read(f))
+            self.assertEqual(sorted(names), ["Astaf.txt", "SHORT.TXT"])
+            self.assertEqual(len(content), stat.size_bytes)
+            self.assertEqual(content, stat.get_file_content(f))
+
+    def test_async_reader_executor(self):
+        async def read(fat_reader, executor):
+            async with asyncreader.AsyncFat32Reader(fat_reader,
+                                                    executor) as reader:
+                streams = [await reader.open(path)
+                           for path in ("Folder1/Astaf.txt",
+                                        "Folder1/SHORT.TXT",
+                                        "VXlZSvgG0z0.jpg")]
+                contents = await asyncio.gather(
+                    *[stream.read() for stream in streams])
+                return [stream.file for stream in streams], contents
+
+        with open(get_test_image_path(), "rb") as fi, \
+                concurrent.futures.ThreadPoolExecutor(4) as executor:
+            f = fateditor.Fat32Reader(fi, cache_size=0, read_ahead_size=0)
+            files, contents = asyncio.run(read(f, executor))
+            for file, content in zip(files, contents):
+                self.assertEqual(content, file.get_file_content(f))
+
+    def test_image_no_cache(self):
+        with open(get_test_image_path(), "rb") as fi:
+            f = fateditor.Fat32Editor(fi, silent_scan=True, cache_size=0)
+            self.assert_test_image(f)
+            self.assertEqual(len(f.block_cache), 0)
+
+    def test_image_cache_hits(self):
+        with open(get_test_image_path(), "rb") as fi:
+            f = fateditor.Fat32Reader(fi)
+            file = dirbrowser.find("Folder1/Astaf.txt",
+                                   f.get_root_directory())
+            content = file.get_file_content(f)
+            hits = f.block_cache.hits
+            self.assertEqual(file.get_file_content(f), content)
+            self.assertGreater(f.block_cache.hits, hits)
+
+    def test_read_ahead(self):
+        with open(get_test_image_path(), "rb") as fi:
+            f = fateditor.Fat32Reader(fi, cache_size=0, read_ahead_size=0)
+            file = dirbrowser.find("VXlZSvgG0z0.jpg", f.get_root_directory())
+            expected = file.get_file_content(f)
+            f.read_ahead_size = 64 * f.get_cluster_size()
+            chunks = list(file.iter_file_content(f))
+            self.assertLess(len(chunks), len(f._get_cluster_chain(
+                file._start_cluster)))
+            self.assertEqual(b''.join(chunks), expected)
+
+    def test_read_ahead_cache(self):
+        with open(get_test_image_path(), "rb") as fi:
+            stats = perfstats.Stats()
+            f = fateditor.Fat32Reader(fi, stats=stats)
+            file = dirbrowser.find("VXlZSvgG0z0.jpg", f.get_root_directory())
+            chain = f._get_cluster_chain(file._start_cluster)
+            # one cluster in the middle of the run is cached beforehand
+            f.block_cache.clear()
+            f._get_data(chain[len(chain) // 2])
+            clusters_read = stats.counters["clusters_read"]
+            expected = file.get_file_content(f)
+            self.assertEqual(stats.counters["clusters_read"] - clusters_read,
+                             len(chain) - 1)
+            self.assertEqual(file.get_file_content(f), expected)
+            self.assertEqual(stats.counters["clusters_read"] - clusters_read,
+                             len(chain) - 1)
+
+    def test_read_at(self):
+        with open(get_test_image_path(), "rb") as fi:
+            f = fateditor.Fat32Reader(fi)
+            file = dirbrowser.find("VXlZSvgG0z0.jpg", f.get_root_directory())
+            expected = file.get_file_content(f)
+            (offset, length), = f.get_file_byte_ranges(file)
+            with concurrent.futures.ThreadPoolExecutor(4) as executor:
+                for read in f.read_at, f._read_at_locked:
+                    parts = executor.map(
+                        lambda start: read(offset + start,
+                                           min(1000, length - start)),
+                        range(0, length, 1000))
+                    self.assertEqual(b''.join(parts), expected)
+
+    def test_tree_index(self):
+        index_path = get_test_image_path() + treeindex.INDEX_FILE_SUFFIX
+        with open(get_test_image_path(), "rb") as fi:
+            f = fateditor.Fat32Reader(fi)
+            expected = f.get_root_directory()
+            built = treeindex.get_root_directory(f, index_path)
+            loaded = treeindex.get_root_directory(f, index_path)
+            for root in built, loaded:
+                self.assertEqual(root.get_dir_hierarchy(),
+                                 expected.get_dir_hierarchy())
+                file = dirbrowser.find("Folder1/SHORT.TXT", root)
+                self.assertEqual(file, dirbrowser.find("Folder1/SHORT.TXT",
+                                                       expected))
+                self.assertEqual(file.get_file_content(f),
+                                 dirbrowser.find("Folder1/SHORT.TXT", expected)
+                                 .get_file_content(f))
+
+    def test_tree_index_rebuild(self):
+        with open(get_test_image_path(), "rb") as fi:
+            f = fateditor.Fat32Reader(fi)
+            root, directory_hashes = treeindex.build_tree(f)
+            index_path = get_test_image_path() + ".stale.idx"
+            treeindex.write_index(index_path, bytes(16), root,
+                                  directory_hashes)
+            rebuilt = treeindex.get_root_directory(f, index_path)
+            self.assertEqual(rebuilt.get_dir_hierarchy(),
+                             root.get_dir_hierarchy())
+            self.assertEqual(treeindex.read_index(index_path).fingerprint,
+                             treeindex.get_fingerprint(f))
+
+    def test_tree_index_subdirectory_change(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "generated.img")
+            index_path = treeindex.get_index_path(path)
+            fatgen.create_image(path, 8 * 2 ** 20, 512, files_amount=4,
+                                directories_amount=1, file_size=1000)
+            with open(path, "r+b") as fi:
+                f = fateditor.Fat32Reader(fi)
+                root = treeindex.get_root_directory(f, index_path)
+                stats = perfstats.Stats()
+                f = fateditor.Fat32Reader(fi, stats=stats)
+                loaded = treeindex.get_root_directory(f, index_path)
+                # loaded from the index without reading the directories
+                self.assertNotIn("clusters_read", stats.counters)
+                self.assertEqual(loaded.get_dir_hierarchy(),
+                                 root.get_dir_hierarchy())
+                file = next(file for file in root.iter_tree()
+                            if file.parent.parent is not None)
+                # size repaired in place, FAT and root are not changed
+                fi.seek(file._entry_start + 28)
+                fi.write(int.to_bytes(10, 4, byteorder='little'))
+            # modification time may not change within a short interval
+            image_stat = os.stat(path)
+            os.utime(path, ns=(image_stat.st_atime_ns,
+                               image_stat.st_mtime_ns + 10 ** 9))
+
+            with open(path, "rb") as fi:
+                f = fateditor.Fat32Reader(fi)
+                root = treeindex.get_root_directory(f, index_path)
+                self.assertEqual(dirbrowser.find(
+                    file.get_absolute_path().strip("/"), root).size_bytes, 10)
+                loaded = treeindex.get_root_directory(f, index_path)
+                self.assertEqual(loaded.get_dir_hierarchy(),
+                                 root.get_dir_hierarchy())
+
+                # only the directory with changed chain is read again
+                root, directory_hashes = treeindex.build_tree(f)
+                directory = next(file for file in root.content
+                                 if file.is_directory)
+                directory_hashes[id(directory)] = \
+                    (directory_hashes[id(directory)][0], 0)
+                treeindex.write_index(index_path,
+                                      treeindex.get_fingerprint(f), root,
+                                      directory_hashes)
+                stats = perfstats.Stats()
+                f = fateditor.Fat32Reader(fi, stats=stats)
+                loaded = treeindex.get_root_directory(f, index_path)
+                self.assertEqual(stats.counters["clusters_read"], len(
+                    f._get_cluster_chain(directory._start_cluster)))
+                self.assertEqual(loaded.get_dir_hierarchy(),
+                                 root.get_dir_hierarchy())
+
+    def test_file_content_range(self):
+        with open(get_test_image_path(), "rb") as fi:
+            f = fateditor.Fat32Reader(fi, read_ahead_size=0)
+            file = dirbrowser.find("VXlZSvgG0z0.jpg", f.get_root_directory())
+            content = file.get_file_content(f)
+            cluster_size = f.get_cluster_size()
+            for offset, length in ((0, 10), (cluster_size - 5, 10),
+                                   (3 * cluster_size, cluster_size),
+                                   (len(content) - 7, 100)):
+                self.assertEqual(
+                    b''.join(file.iter_file_content(f, offset, length)),
+                    content[offset:offset + length])
+
+    def test_copy_file_content(self):
+        with open(get_test_image_path(), "rb") as fi:
+            f = fateditor.Fat32Reader(fi)
+            file = dirbrowser.find("VXlZSvgG0z0.jpg", f.get_root_directory())
+            extents = f.get_cluster_extents(file._start_cluster)
+            self.assertEqual(sum(amount for _, amount in extents),
+                             len(f._get_cluster_chain(file._start_cluster)))
+            with tempfile.TemporaryFile() as system_file:
+                f.copy_file_content(file, system_file)
+                system_file.seek(0)
+                self.assertEqual(system_file.read(), file.get_file_content(f))
+
+    def test_open_reuses_temp_file(self):
+        with open(get_test_image_path(), "rb") as fi:
+            browser = dirbrowser.DirectoryBrowser(fateditor.Fat32Reader(fi))
+            file = browser.find("Folder1/SHORT.TXT")
+            try:
+                path = browser._extract_temp_file(file)
+                os.utime(path, ns=(0, 0))
+                browser._temp_files[next(iter(browser._temp_files))] = \
+                    (path, file.size_bytes, 0)
+                self.assertEqual(browser._extract_temp_file(file), path)
+                self.assertEqual(os.stat(path).st_mtime_ns, 0)
+            finally:
+                dirbrowser.dispose_temp_files()
+
     def assert_test_image(self, test_image_file):
         names = test_image_file.get_root_directory().get_dir_hierarchy()
         self.assertEqual(names,
@@ -320,6 +642,131 @@ class DirectoryBrowserTests(unittest.TestCase):
 
         self.assertEqual(db.current, d1)
 
+    def test_decoded_text_ascii(self):
+        text = dirbrowser.iter_decoded_text([b'ab\xff', b'c'])
+        self.assertEqual("".join(text), "ab\u2592c")
+
+    def test_decoded_text_split_char(self):
+        data = "Файл".encode("utf-8")
+        text = dirbrowser.iter_decoded_text([data[:3], data[3:]], "utf-8")
+        self.assertEqual("".join(text), "Файл")
+
+    def test_print_dir_content_recursive(self):
+        d = fsobjects.File("DIR", "", fsobjects.DIRECTORY)
+        d1 = fsobjects.File("DIR1", "", fsobjects.DIRECTORY)
+        d1.parent = d
+        d.content = [d1, fsobjects.File("", "File.txt")]
+        d1.content = list(generate_files_from_names(["File1.txt"]))
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            dirbrowser.print_dir_content(d, True, True)
+        self.assertEqual(output.getvalue(), "DIR1\nFile1.txt\nFile.txt\n")
+
+    def test_run_commands(self):
+        d = fsobjects.File("DIR", "", fsobjects.DIRECTORY)
+        d.content = list(generate_files_from_names(["File1.txt"]))
+        db = dirbrowser.DirectoryBrowser(root=d)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            failed = db.run_commands(["# comment", "", "dir /b",
+                                      "wrong", "quit", "dir /b"])
+        self.assertEqual(failed, 1)
+        self.assertEqual(output.getvalue().count("File1.txt"), 1)
+        self.assertIn("Wrong command", output.getvalue())
+
+    def test_read_only(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "generated.img")
+            fatgen.create_image(path, 8 * 2 ** 20, 512, files_amount=2)
+            with open(path, "rb") as fi:
+                with fateditor.Fat32Reader(fi) as f:
+                    db = dirbrowser.DirectoryBrowser(fat_editor=f,
+                                                     read_only=True)
+                    output = io.StringIO()
+                    with contextlib.redirect_stdout(output):
+                        failed = db.run_commands(
+                            ["copyToImage " + path + " .", "dir /b"])
+            self.assertEqual(failed, 1)
+            self.assertIn("read-only", output.getvalue())
+
+    def test_print_dir_content_ndjson(self):
+        d = fsobjects.File("DIR", "", fsobjects.DIRECTORY)
+        file = fsobjects.File("FILE.TXT", "File.txt", size_bytes=10,
+                              change_datetime=datetime.datetime(2017, 7, 14,
+                                                                20, 24, 10))
+        file.parent = d
+        d.content = [file]
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            dirbrowser.print_dir_content(d, False, False,
+                                         dirbrowser.DIR_OUTPUT_NDJSON)
+        record = json.loads(output.getvalue())
+        self.assertEqual(record["path"], "DIR/File.txt")
+        self.assertEqual(record["size"], 10)
+        self.assertEqual(record["modified"], "2017-07-14T20:24:10")
+
+    def test_hex_blocks(self):
+        blocks = dirbrowser.iter_hex_blocks([b'\x00\x01\x02', b'\xab\xcd'], 2)
+        self.assertEqual("".join(blocks), "00 01\n02 ab\ncd\n")
+
+    def test_hex_range(self):
+        self.assertEqual(dirbrowser.get_hex_range(100, 16), (0, 100))
+        self.assertEqual(dirbrowser.get_hex_range(100, 16, head=2), (0, 32))
+        self.assertEqual(dirbrowser.get_hex_range(100, 16, tail=2), (80, 20))
+        self.assertEqual(dirbrowser.get_hex_range(100, 16, offset=90,
+                                                  length=20), (90, 10))
+
+
+class NameIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.root = fsobjects.File("", "", fsobjects.DIRECTORY)
+        self.folder = fsobjects.File("FOLDER", "Folder", fsobjects.DIRECTORY)
+        self.folder.parent = self.root
+        self.root.content = [self.folder,
+                             fsobjects.File("README.TXT", "readme.txt",
+                                            size_bytes=100)]
+        self.folder.content = [fsobjects.File("PHOTO~1.JPG", "Photo 1.jpg",
+                                              size_bytes=5000),
+                               fsobjects.File("NOTES.TXT", "Notes.txt",
+                                              fsobjects.HIDDEN)]
+        for file in self.folder.content:
+            file.parent = self.folder
+        self.index = nameindex.NameIndex.from_tree(self.root)
+
+    def search_names(self, pattern, regex=False):
+        return sorted(file.name for file in self.index.search(pattern, regex))
+
+    def test_glob(self):
+        self.assertEqual(self.search_names("*.txt"),
+                         ["Notes.txt", "readme.txt"])
+
+    def test_glob_prefix_case_insensitive(self):
+        self.assertEqual(self.search_names("PHOTO*"), ["Photo 1.jpg"])
+
+    def test_short_name(self):
+        self.assertEqual(self.search_names("photo~1.*"), ["Photo 1.jpg"])
+
+    def test_regex(self):
+        self.assertEqual(self.search_names(r"^(readme|notes)\.", True),
+                         ["Notes.txt", "readme.txt"])
+
+    def test_browser_search_filters(self):
+        db = dirbrowser.DirectoryBrowser(root=self.root)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            db.search('* --min-size 1000')
+            db.search('"*.txt" --attr h')
+            db.change_directory("Folder")
+            db.search('readme.txt')
+        self.assertEqual(output.getvalue().splitlines(),
+                         ["/Folder/Photo 1.jpg", "Files found: 1",
+                          "/Folder/Notes.txt", "Files found: 1",
+                          "Files found: 0"])
+
+    def test_search_wrong_option(self):
+        with self.assertRaises(dirbrowser.DirectoryBrowserError):
+            dirbrowser.parse_search_args("* --after yesterday")
+
 
 class WriterTests(unittest.TestCase):
     def test_lfn_encoding(self):
@@ -327,6 +774,7 @@ class WriterTests(unittest.TestCase):
         parts = fsobjects.to_lfn_parts(name)
         actual = ""
         for part in parts:
+            self.assertEqual(len(part), fateditor.BYTES_PER_DIR_ENTRY)
             actual = fateditor.get_lfn_part(part)[0] + actual
         self.assertEqual(actual, name)
 
@@ -336,5 +784,584 @@ class WriterTests(unittest.TestCase):
         self.assertEqual(short_name, "QWERTY~1.PNG")
 
 
+class GeneratedImageTestCase(unittest.TestCase):
+    """
+    Base of the tests working with images generated in a temporary
+    directory
+    """
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = temp_dir.name
+
+    def create_image(self, name="generated.img", cluster_size=512,
+                     size_bytes=8 * 2 ** 20, **fill_parameters):
+        """
+        Returns path and builder of the image generated in the temporary
+        directory
+        """
+        path = os.path.join(self.temp_dir, name)
+        builder = fatgen.create_image(path, size_bytes, cluster_size,
+                                      **fill_parameters)
+        return path, builder
+
+    def create_external_file(self, content, name="IMPORT.BIN"):
+        """
+        Returns path of the host file with the content to be imported
+        """
+        path = os.path.join(self.temp_dir, name)
+        with open(path, "wb") as external_file:
+            external_file.write(content)
+        return path
+
+
+class EditorTests(GeneratedImageTestCase):
+    def test_journaled_import(self):
+        path, _ = self.create_image(files_amount=2)
+        journal_path = journal.get_journal_path(path)
+        external_path = self.create_external_file(bytes(range(256)) * 20)
+
+        with open(path, "r+b") as fi:
+            f = fateditor.Fat32Editor(fi, journal_path=journal_path)
+            free_clusters = f._free_clusters
+            root = f.get_root_directory()
+            with self.assertRaises(RuntimeError):
+                with f.operation():
+                    f.write_to_image(external_path, "", root)
+                    raise RuntimeError()
+            self.assertEqual(f._free_clusters, free_clusters)
+            self.assertEqual(len(f.get_root_directory().content), 2)
+            f.write_to_image(external_path, "", root)
+            self.assertEqual(f.journal.commits, 1)
+        self.assertFalse(os.path.exists(journal_path))
+
+        with open(path, "rb") as fi:
+            f = fateditor.Fat32Reader(fi, cache_size=0)
+            root = f.get_root_directory()
+            self.assertEqual(len(root.content), 3)
+            file = root.content[-1]
+            self.assertEqual(file.name, "IMPORT.BIN")
+            self.assertEqual(b''.join(file.iter_file_content(f)),
+                             bytes(range(256)) * 20)
+
+    def test_deferred_fs_info(self):
+        path, builder = self.create_image(files_amount=2)
+        external_path = self.create_external_file(bytes(512 * 10))
+
+        free_clusters = builder.free_clusters
+        for is_unknown in False, True:
+            with open(path, "r+b") as fi:
+                f = fateditor.Fat32Editor(fi, stats=perfstats.Stats())
+                if is_unknown:
+                    fi.seek(f._sectors_to_bytes(f._fs_info_sector)
+                            + 0x1e8)
+                    fi.write(b'\xff' * 8)
+                    f = fateditor.Fat32Editor(fi, stats=perfstats.Stats())
+                    self.assertEqual(f._free_clusters, -1)
+                f.write_to_image(external_path, "",
+                                 f.get_root_directory())
+                self.assertEqual(f.stats.counters["allocations"], 10)
+                self.assertEqual(f.stats.counters["fs_info_writes"], 1)
+                f.close()
+                self.assertEqual(f.stats.counters["fs_info_writes"], 1)
+
+            with open(path, "rb") as fi:
+                f = fateditor.Fat32Reader(fi, cache_size=0)
+                self.assertEqual(
+                    f._free_clusters,
+                    sum(length for _, length in
+                        f.get_free_cluster_runs()))
+                self.assertEqual(f._first_free_cluster,
+                                 f.get_free_cluster_runs()[0][0])
+                free_clusters -= 10
+                self.assertEqual(f._free_clusters, free_clusters)
+
+    def test_flush_policy(self):
+        path, _ = self.create_image(files_amount=2)
+        external_path = self.create_external_file(bytes(512 * 10))
+
+        flushes = dict()
+        for flush_policy in fateditor.FLUSH_POLICIES:
+            with open(path, "r+b") as fi:
+                with fateditor.Fat32Editor(
+                        fi, stats=perfstats.Stats(),
+                        flush_policy=flush_policy) as f:
+                    f.write_to_image(external_path, "",
+                                     f.get_root_directory())
+                    flushes[flush_policy] = f.stats.timers.get(
+                        "flush", (0, 0))[0]
+                    with f.use_flush_policy(fateditor.FLUSH_ON_CLOSE):
+                        f.write_to_image(external_path, "",
+                                         f.get_root_directory())
+                    self.assertEqual(f.flush_policy, flush_policy)
+        self.assertGreater(flushes[fateditor.FLUSH_PER_WRITE], 10)
+        self.assertEqual(flushes[fateditor.FLUSH_PER_OPERATION], 1)
+        self.assertEqual(flushes[fateditor.FLUSH_ON_CLOSE], 0)
+        with self.assertRaises(ValueError):
+            fateditor.Fat32Editor(io.BytesIO(), flush_policy="never")
+
+        with open(path, "rb") as fi:
+            f = fateditor.Fat32Reader(fi, cache_size=0)
+            self.assertEqual(len(f.get_root_directory().content), 8)
+
+
+class JournalTests(GeneratedImageTestCase):
+    def test_journal_recovery(self):
+        path = os.path.join(self.temp_dir, "image")
+        journal_path = journal.get_journal_path(path)
+        for is_complete in True, False:
+            with open(path, "wb") as fi:
+                fi.write(bytes(3 * journal.PAGE_SIZE))
+            with open(path, "r+b") as fi:
+                journaled_file = journal.JournaledFile(fi, journal_path)
+                journaled_file.begin()
+                journaled_file.seek(journal.PAGE_SIZE - 2)
+                journaled_file.write(b'data')
+                journaled_file.seek(journal.PAGE_SIZE - 2)
+                self.assertEqual(journaled_file.read(4), b'data')
+                self.assertEqual(journaled_file.read_committed(
+                    journal.PAGE_SIZE - 2, 4), bytes(4))
+                # interrupted between the journal and the image writes
+                journaled_file._write_journal(
+                    [(number * journal.PAGE_SIZE, bytes(page)) for
+                     number, page in journaled_file._pages.items()])
+            if not is_complete:
+                with open(journal_path, "r+b") as journal_file:
+                    journal_file.truncate(
+                        os.path.getsize(journal_path) - 1)
+
+            with open(path, "r+b") as fi:
+                journaled_file = journal.JournaledFile(fi, journal_path)
+                self.assertEqual(journaled_file.recovered_pages,
+                                 2 if is_complete else 0)
+                journaled_file.seek(journal.PAGE_SIZE - 2)
+                self.assertEqual(journaled_file.read(4),
+                                 b'data' if is_complete else bytes(4))
+            self.assertFalse(os.path.exists(journal_path))
+
+
+class GeneratorTests(GeneratedImageTestCase):
+    def test_generated_image(self):
+        path = os.path.join(self.temp_dir, "generated.img")
+        with open(path, "w+b") as fi:
+            builder = fatgen.ImageBuilder(fi, 8 * 2 ** 20, 512)
+            directory = builder.add_directory(builder.root, "DIR",
+                                              "Directory")
+            builder.add_file(directory, "LONGFI~1.TXT",
+                             "Long file name.txt", 1000)
+            builder.add_files_interleaved(
+                builder.root, [("A.BIN", ""), ("B.BIN", "")], 2048)
+            builder.finish()
+
+        with open(path, "rb") as fi:
+            f = fateditor.Fat32Reader(fi)
+            root = f.get_root_directory()
+            self.assertEqual([file.name for file in root.content],
+                             ["Directory", "A.BIN", "B.BIN"])
+            file = root.content[0].content[0]
+            self.assertEqual(file.name, "Long file name.txt")
+            self.assertEqual(
+                f.get_data_from_cluster_chain(
+                    file._start_cluster)[:file.size_bytes],
+                fatgen.get_file_content(file, 512))
+            self.assertEqual(
+                len(f.get_cluster_extents(root.content[1]._start_cluster)),
+                4)
+
+    def test_generated_image_fill(self):
+        path, builder = self.create_image(
+            cluster_size=4096, size_bytes=256 * 2 ** 20, files_amount=30,
+            directories_amount=5, depth=2, file_size=20000, fragments=3,
+            long_names_part=0.5)
+        self.assertLess(os.stat(path).st_blocks * 512, 2 ** 20)
+        with open(path, "rb") as fi:
+            f = fateditor.Fat32Reader(fi)
+            self.assertEqual(f._free_clusters, builder.free_clusters)
+            files = list(f.get_root_directory().iter_tree())
+            regular_files = [file for file in files
+                             if not file.is_directory]
+            self.assertEqual(len(files), 35)
+            self.assertEqual(sum(1 for file in regular_files
+                                 if file.name.startswith("long")), 15)
+            for file in regular_files:
+                self.assertEqual(
+                    len(f.get_cluster_extents(file._start_cluster)), 3)
+
+
+class DefragmentationTests(GeneratedImageTestCase):
+    def test_defragment(self):
+        path, _ = self.create_image(files_amount=10, directories_amount=2,
+                                    depth=2, file_size=2000, fragments=3)
+        with open(path, "r+b") as fi:
+            f = fateditor.Fat32Editor(fi)
+            before, after, defragmenter = defrag.defragment(
+                f, f.get_root_directory())
+        self.assertEqual(before.fragmented_chains, 10)
+        self.assertEqual(after.fragmented_chains, 0)
+        self.assertEqual(defragmenter.moved_chains, 10)
+
+        with open(path, "rb") as fi:
+            f = fateditor.Fat32Reader(fi, cache_size=0)
+            for file in f.get_root_directory().iter_tree():
+                if file.is_directory:
+                    continue
+                self.assertEqual(
+                    len(f.get_cluster_extents(file._start_cluster)), 1)
+                self.assertEqual(
+                    b''.join(file.iter_file_content(f)),
+                    fatgen.get_file_content(file, 512))
+
+    def test_defragment_dry_run(self):
+        path, _ = self.create_image(files_amount=10, file_size=2000,
+                                    fragments=3)
+        with open(path, "rb") as fi:
+            image = fi.read()
+        with open(path, "r+b") as fi:
+            f = fateditor.Fat32Editor(fi)
+            root = f.get_root_directory()
+            starts = [file._start_cluster for file in root.content]
+            before, after, defragmenter = defrag.defragment(
+                f, root, dry_run=True)
+            self.assertEqual(before.fragmented_chains, 10)
+            self.assertEqual(after.fragmented_chains, 0)
+            self.assertEqual(defragmenter.moved_chains, 10)
+            self.assertEqual([file._start_cluster
+                              for file in root.content], starts)
+            for file in root.content:
+                self.assertEqual(b''.join(file.iter_file_content(f)),
+                                 fatgen.get_file_content(file, 512))
+            f.close()
+        with open(path, "rb") as fi:
+            self.assertEqual(fi.read(), image)
+
+    def test_defragment_root(self):
+        path, _ = self.create_image()
+        with open(path, "r+b") as fi:
+            with fateditor.Fat32Editor(fi) as f:
+                root = f.get_root_directory()
+                for number in range(40):
+                    f.write_stream_to_image(
+                        "F{:02d}.BIN".format(number), [b'x' * 600], root)
+
+        with open(path, "r+b") as fi:
+            f = fateditor.Fat32Editor(fi)
+            root = f.get_root_directory()
+            before, after, defragmenter = defrag.defragment(f, root)
+            self.assertEqual(before.fragmented_chains, 1)
+            self.assertEqual(after.fragmented_chains, 1)
+            self.assertTrue(defragmenter.root_skipped)
+            self.assertEqual(defragmenter.skipped_chains, 0)
+            self.assertEqual(defragmenter.moved_chains, 0)
+            f.close()
+
+    def test_defragment_directories(self):
+        path, _ = self.create_image()
+        contents = dict()
+        with open(path, "r+b") as fi:
+            with fateditor.Fat32Editor(fi) as f:
+                root = f.get_root_directory()
+                directory = f.create_directory("DIR", root)
+                subdirectory = f.create_directory("SUB", directory)
+                f.write_stream_to_image("IN_SUB.BIN", [b'sub'],
+                                        subdirectory)
+                # every cluster of the directory (16 entries) is
+                # followed by the content of its files
+                for number in range(40):
+                    name = "F{:02d}.BIN".format(number)
+                    contents[name] = bytes([number]) * 600
+                    f.write_stream_to_image(name, [contents[name]],
+                                            directory)
+
+        with open(path, "r+b") as fi:
+            f = fateditor.Fat32Editor(fi)
+            root = f.get_root_directory()
+            before, after, _ = defrag.defragment(f, root)
+            self.assertGreater(before.fragmented_chains, 0)
+            self.assertEqual(after.fragmented_chains, 0)
+            f.close()
+
+        with open(path, "rb") as fi:
+            f = fateditor.Fat32Reader(fi, cache_size=0)
+            directory = dirbrowser.find("DIR", f.get_root_directory())
+            self.assertEqual(
+                len(f.get_cluster_extents(directory._start_cluster)), 1)
+            files = {file.name: file for file in directory.content}
+            self.assertEqual(len(files), 41)
+            for name, content in contents.items():
+                self.assertEqual(
+                    b''.join(files[name].iter_file_content(f)), content)
+            subdirectory = f.get_data_from_cluster_chain(
+                files["SUB"]._start_cluster)
+            # ".." entry of the subdirectory points to the moved one
+            self.assertEqual(
+                fateditor.parse_file_first_cluster_number(BytesParser(
+                    subdirectory[fateditor.BYTES_PER_DIR_ENTRY:])),
+                directory._start_cluster)
+            self.assertEqual(b''.join(files["SUB"].content[0]
+                                      .iter_file_content(f)), b'sub')
+
+
+class AnalyticsTests(GeneratedImageTestCase):
+    def test_analyze(self):
+        path, builder = self.create_image(files_amount=6,
+                                          directories_amount=1,
+                                          file_size=1000, fragments=2)
+        with open(path, "rb") as fi:
+            f = fateditor.Fat32Reader(fi)
+            report = analytics.analyze(f, f.get_root_directory(), 2)
+        self.assertEqual(report.free_clusters, builder.free_clusters)
+        self.assertEqual(report.files, 6)
+        self.assertEqual(report.directories, 1)
+        self.assertEqual(report.fragmented_files, 6)
+        self.assertEqual(report.slack_bytes, 6 * 24)
+        self.assertEqual(len(report.most_fragmented_files), 2)
+        self.assertEqual(report.largest_directories[0][:2], (6000, 4))
+        self.assertEqual(sum(runs for _, _, runs, _ in
+                             report.free_runs_histogram), 7)
+
+
+class SessionTests(GeneratedImageTestCase):
+    def test_session_copy(self):
+        source_path, _ = self.create_image(
+            "source.img", files_amount=12, directories_amount=3, depth=2,
+            file_size=3000, fragments=2, long_names_part=0.5)
+        target_path, _ = self.create_image("target.img", 1024,
+                                           files_amount=1)
+
+        with session.Session(cache_size=64 * 1024) as s:
+            source = s.open(source_path, "source", read_only=True)
+            s.open(target_path, "target",
+                   flush_policy=fateditor.FLUSH_PER_OPERATION)
+            s.copy("source", "/", "target", "/")
+            self.assertLessEqual(s.block_cache.size_bytes, 64 * 1024)
+            self.assertGreater(len(source.block_cache), 0)
+            with self.assertRaises(session.SessionError):
+                s.copy("target", "/", "source", "/")
+            s.close_image("source")
+            self.assertEqual(s.names, ["target"])
+            self.assertEqual(len(s["target"].block_cache),
+                             len(s.block_cache))
+
+        with open(source_path, "rb") as source_file, \
+                open(target_path, "rb") as target_file:
+            source = fateditor.Fat32Reader(source_file)
+            target = fateditor.Fat32Reader(target_file, cache_size=0)
+            source_files = list(source.get_root_directory().iter_tree())
+            target_files = list(
+                target.get_root_directory().iter_tree())[1:]
+            self.assertEqual(
+                [file.get_absolute_path() for file in source_files],
+                [file.get_absolute_path() for file in target_files])
+            for source_file, target_file in zip(source_files,
+                                                target_files):
+                self.assertEqual(
+                    b''.join(source_file.iter_file_content(source)),
+                    b''.join(target_file.iter_file_content(target)))
+
+
+class ImageDiffTests(GeneratedImageTestCase):
+    def test_image_diff(self):
+        old_path, _ = self.create_image("old.img", files_amount=8,
+                                        directories_amount=2,
+                                        file_size=3000, fragments=2)
+        new_path = os.path.join(self.temp_dir, "new.img")
+        with open(old_path, "rb") as old_file, \
+                open(new_path, "wb") as new_file:
+            new_file.write(old_file.read())
+
+        with open(new_path, "r+b") as fi:
+            f = fateditor.Fat32Editor(fi)
+            root = f.get_root_directory()
+            f.write_stream_to_image("added.txt", [b"added"], root)
+            changed = [file for file in root.iter_tree()
+                       if not file.is_directory][-1]
+            offset, _ = f.get_file_byte_ranges(changed)[-1]
+            fi.seek(offset)
+            fi.write(b"changed")
+
+        with open(old_path, "rb") as old_file, \
+                open(new_path, "rb") as new_file:
+            old = fateditor.Fat32Reader(old_file)
+            new = fateditor.Fat32Reader(new_file, cache_size=0)
+            report = imagediff.diff(old, new)
+            self.assertEqual(report.added, ["/added.txt"])
+            self.assertEqual(report.removed, [])
+            self.assertEqual(report.modified, [])
+            self.assertEqual(report.compared_files, 0)
+
+            report = imagediff.diff(new, old, compare_content=True,
+                                    workers=2)
+            self.assertEqual(report.removed, ["/added.txt"])
+            self.assertEqual(report.modified,
+                             [(changed.get_absolute_path(), 1)])
+            self.assertEqual(report.compared_files, 8)
+            self.assertEqual(report.hashed_blocks, 8 * 2 * 6)
+
+    def test_image_diff_zero_dates(self):
+        old_path, _ = self.create_image("old.img", files_amount=3,
+                                        file_size=1000)
+        new_path = os.path.join(self.temp_dir, "new.img")
+        with open(old_path, "r+b") as fi:
+            f = fateditor.Fat32Reader(fi)
+            for file in f.get_root_directory().content:
+                # creation time and date, modification time and date
+                for start in 13, 22:
+                    fi.seek(file._entry_start + start)
+                    fi.write(bytes(5 if start == 13 else 4))
+        with open(old_path, "rb") as old_file, \
+                open(new_path, "wb") as new_file:
+            new_file.write(old_file.read())
+
+        with open(old_path, "rb") as old_file, \
+                open(new_path, "rb") as new_file:
+            report = imagediff.diff(fateditor.Fat32Reader(old_file),
+                                    fateditor.Fat32Reader(new_file),
+                                    compare_content=True)
+            self.assertFalse(report.has_differences)
+            self.assertEqual(report.compared_files, 3)
+
+
+class HashingTests(GeneratedImageTestCase):
+    def test_hash_image(self):
+        path, _ = self.create_image(files_amount=3, file_size=1500,
+                                    fragments=2)
+        index_path = treeindex.get_index_path(path)
+        content = bytes(range(256)) * 9
+        with open(path, "r+b") as fi:
+            with fateditor.Fat32Editor(fi) as f:
+                root = f.get_root_directory()
+                for name in "copy1.bin", "copy2.bin", "copy3.bin":
+                    f.write_stream_to_image(name, [content], root)
+
+        with open(path, "rb") as fi:
+            f = fateditor.Fat32Reader(fi)
+            root = treeindex.get_root_directory(f, index_path)
+            report = hashing.hash_image(f, root, workers=2,
+                                        index_path=index_path)
+            self.assertEqual(report.hashed_files, 6)
+            self.assertEqual(report.files[3],
+                             ("/copy1.bin", len(content),
+                              hashlib.sha256(content).digest()))
+            self.assertEqual(report.duplicates, [(
+                len(content), ["/copy1.bin", "/copy2.bin",
+                               "/copy3.bin"])])
+            self.assertEqual(report.wasted_bytes, 2 * len(content))
+
+            root = treeindex.get_root_directory(f, index_path)
+            cached = hashing.hash_image(f, root, index_path=index_path)
+            self.assertEqual(cached.hashed_files, 0)
+            self.assertEqual(cached.cached_files, 6)
+            self.assertEqual(cached.files, report.files)
+
+            # rewritten in place, the unrelated file changes the FAT
+            copy1 = root.content[3]
+            offset, _ = f.get_file_byte_ranges(copy1)[0]
+        with open(path, "r+b") as fi:
+            fi.seek(offset)
+            fi.write(b'rewritten')
+            with fateditor.Fat32Editor(fi) as f:
+                f.write_stream_to_image("other.bin", [b'other'],
+                                        f.get_root_directory())
+        changed = b'rewritten' + content[len(b'rewritten'):]
+        with open(path, "rb") as fi:
+            f = fateditor.Fat32Reader(fi)
+            root = treeindex.get_root_directory(f, index_path)
+            report = hashing.hash_image(f, root, index_path=index_path)
+            self.assertEqual(report.cached_files, 0)
+            self.assertEqual(report.files[3][2],
+                             hashlib.sha256(changed).digest())
+
+            report = hashing.hash_image(f, root, "xxh64")
+            self.assertEqual(report.algorithm,
+                             hashing.get_algorithm_name("xxh64"))
+            self.assertEqual(len(report.files[0][2]), 8)
+            with self.assertRaises(ValueError):
+                hashing.hash_image(f, root, "unknown")
+
+
+class UndeleteTests(GeneratedImageTestCase):
+    def test_undelete(self):
+        path, _ = self.create_image(files_amount=2, file_size=1000)
+        content = bytes(range(256)) * 12
+        with open(path, "r+b") as fi:
+            with fateditor.Fat32Editor(fi) as f:
+                root = f.get_root_directory()
+                for name in "Deleted file.bin", "kept chain.bin":
+                    f.write_stream_to_image(name, [content], root)
+            with fateditor.Fat32Editor(fi) as f:
+                for file in f.get_root_directory().content[-2:]:
+                    lfn_entries = len(fsobjects.to_lfn_parts(file.name))
+                    for entry in range(lfn_entries + 1):
+                        f._write_content_to_image(
+                            file._entry_start -
+                            entry * fateditor.BYTES_PER_DIR_ENTRY,
+                            b'\xe5')
+                    if file.name == "Deleted file.bin":
+                        for cluster in f._get_cluster_chain(
+                                file._start_cluster):
+                            f._write_fat_value(cluster, 0)
+
+        with open(path, "rb") as fi:
+            f = fateditor.Fat32Reader(fi)
+            report = undelete.scan(f)
+            self.assertIsNone(f.deleted_entries)
+            self.assertEqual(
+                [(file.path, file.status) for file in report.files],
+                [("/Deleted file.bin", undelete.RECOVERABLE),
+                 ("/kept chain.bin", undelete.OVERWRITTEN)])
+            self.assertEqual(report.orphan_names, [])
+            self.assertEqual(report.files[0].file.short_name[0], "D")
+            recovered = undelete.recover_all(
+                f, report, os.path.join(self.temp_dir, "out"))
+            self.assertEqual(len(recovered), 1)
+            with open(recovered[0][1], "rb") as output:
+                self.assertEqual(output.read(), content)
+
+
+class CarvingTests(GeneratedImageTestCase):
+    def test_carving(self):
+        path, _ = self.create_image(files_amount=2, file_size=1000)
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, "w") as zip_file:
+            zip_file.writestr("a.txt", "text " * 300)
+        contents = {
+            "jpeg": b'\xff\xd8\xff\xe0' + bytes(range(200)) * 10 +
+                    b'\xff\xd9',
+            "png": b'\x89PNG\r\n\x1a\n' + bytes(1500) +
+                   b'IEND\xaeB`\x82',
+            "zip": archive.getvalue(),
+        }
+        with open(path, "r+b") as fi:
+            with fateditor.Fat32Editor(fi) as f:
+                root = f.get_root_directory()
+                files = [f.write_stream_to_image(name, [content], root)
+                         for name, content in sorted(contents.items())]
+                f.write_stream_to_image("used.png", [contents["png"]],
+                                        root)
+                with f.operation():
+                    for file in files:
+                        for cluster in f._get_cluster_chain(
+                                file._start_cluster):
+                            f._write_fat_value(cluster, 0)
+
+        self.assertEqual(carving.split_runs([(2, 5), (10, 2)], 3),
+                         [[(2, 3, 7)], [(5, 2, 7), (10, 1, 12)],
+                          [(11, 1, 12)]])
+        with open(path, "rb") as fi:
+            f = fateditor.Fat32Reader(fi)
+            output_dir = os.path.join(self.temp_dir, "carved")
+            report = carving.carve(f, path, output_dir, workers=2)
+            self.assertEqual(
+                [(file.signature_name, file.first_cluster)
+                 for file in report.files],
+                [(name, file._start_cluster) for name, file in
+                 zip(sorted(contents), files)])
+            for file in report.files:
+                with open(file.output_path, "rb") as output:
+                    self.assertEqual(output.read(),
+                                     contents[file.signature_name])
+
+
 if __name__ == '__main__':
     unittest.main()
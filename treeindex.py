@@ -0,0 +1,376 @@
+# !/usr/bin/env python3
+import array
+import collections
+import hashlib
+import os
+import struct
+
+import fsobjects
+
+INDEX_FILE_SUFFIX = ".idx"
+INDEX_MAGIC = b'FAT32IDX'
+INDEX_VERSION = 3
+
+# magic, version, fingerprint, files amount, directories amount,
+# digests amount
+_HEADER = struct.Struct('<8sH16sIII')
+# parent record, first cluster, size, entry start,
+# creation ms/time/date, last access date, modification time/date,
+# attributes, short name length, long name length
+_RECORD = struct.Struct('<iIIqHHHHHHBHH')
+# directory record (-1 for the root), directory content hash,
+# cluster chain hash
+_DIRECTORY = struct.Struct('<iQQ')
+# size and modification time of the image file
+_FILE_STAT = struct.Struct('<qq')
+# first cluster, size, algorithm name length, digest length
+_DIGEST = struct.Struct('<IIBB')
+
+
+def get_index_path(image_path):
+    return image_path + INDEX_FILE_SUFFIX
+
+
+def get_fingerprint(fat_reader):
+    """
+    Cheap fingerprint of the image: the boot sector, free clusters amount
+    and next free cluster of the FS Info sector, size and modification
+    time of the image file. Nothing of the FAT or the directories is read,
+    cluster chains of the directories are checked by their hashes kept
+    in the index, see get_root_directory.
+    """
+    fingerprint = hashlib.blake2b(digest_size=16)
+    fingerprint.update(fat_reader._sector_slice(0))
+    fingerprint.update(
+        fat_reader._sector_slice(fat_reader._fs_info_sector)[0x1e8:0x1f0])
+    image_stat = os.fstat(fat_reader._fat_image_file.fileno())
+    fingerprint.update(_FILE_STAT.pack(image_stat.st_size,
+                                       image_stat.st_mtime_ns))
+    return fingerprint.digest()
+
+
+def get_directory_hash(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(),
+                          byteorder='little')
+
+
+def get_chain_hash(chain):
+    return get_directory_hash(array.array('I', chain).tobytes())
+
+
+def get_root_directory(fat_reader, index_path):
+    """
+    Returns root directory of the image, loading the tree from the index
+    file. If the fingerprint of the image is the same, only the FAT
+    entries of the directory chains are read: the tree is taken from the
+    index as it is if no chain has changed, otherwise only directories
+    with changed chains are read again. If the image has changed, data of
+    every directory is read and only directories with changed content are
+    parsed. In both cases the index is rewritten without the cached
+    content digests. Changes of the image which keep the fingerprint and
+    the directory chains (e.g. the file modification time is restored
+    after the edit) are not found.
+    """
+    fingerprint = get_fingerprint(fat_reader)
+    index = read_index(index_path)
+    is_same_image = index is not None and index.fingerprint == fingerprint
+    if is_same_image and index.has_same_chains(fat_reader):
+        return index.to_tree(fat_reader.root_catalog_first_cluster)
+
+    root, directory_hashes = build_tree(fat_reader, index, is_same_image)
+    # content digests are dropped, a file with the same first cluster and
+    # size may have been rewritten
+    write_index(index_path, fingerprint, root, directory_hashes)
+    return root
+
+
+def build_tree(fat_reader, old_index=None, trust_chains=False):
+    """
+    Returns root and dict of id of directory -> (content hash, chain
+    hash). Content of the directories found in the old index is reused if
+    the content hash is the same or, with trust_chains, if the chain is
+    the same (then the directory is not read).
+    """
+    root = fsobjects.File("", "", fsobjects.DIRECTORY, None, None, None,
+                          0, fat_reader.root_catalog_first_cluster)
+    directory_hashes = dict()
+    directories = [root]
+    while directories:
+        directory = directories.pop()
+        chain_hash = get_chain_hash(
+            fat_reader._get_cluster_chain(directory._start_cluster))
+        content = None
+        if trust_chains and old_index is not None:
+            directory_hash = old_index.get_directory_hash(directory,
+                                                          chain_hash)
+            if directory_hash is not None:
+                content = old_index.get_directory_content(directory,
+                                                          directory_hash)
+        if content is None:
+            data = fat_reader.get_data_from_cluster_chain(
+                directory._start_cluster)
+            directory_hash = get_directory_hash(data)
+            if old_index is not None:
+                content = old_index.get_directory_content(
+                    directory, directory_hash)
+            if content is None:
+                content = fat_reader._parse_dir_files(data, directory,
+                                                      recursive=False)
+        directory_hashes[id(directory)] = (directory_hash, chain_hash)
+        directory.content = content
+        for file in content:
+            if file.is_directory and file.content is None:
+                directories.append(file)
+    return root, directory_hashes
+
+
+def _file_to_record(file, parent_record):
+    short_name = file.short_name.encode("utf-8")
+    long_name = file.long_name.encode("utf-8")
+    return _RECORD.pack(parent_record,
+                        max(file._start_cluster, 0),
+                        file._size_bytes,
+                        file._entry_start,
+                        file._create_millis,
+                        file._create_time,
+                        file._create_date,
+                        file._last_open_date,
+                        file._change_time,
+                        file._change_date,
+                        file.attributes,
+                        len(short_name), len(long_name)
+                        ) + short_name + long_name
+
+
+def _record_to_file(record, short_name, long_name):
+    (_, first_cluster, size_bytes, entry_start,
+     create_millis, create_time, create_date,
+     last_open_date, change_time, change_date,
+     attributes, _, _) = record
+    file = fsobjects.File.from_raw(short_name, long_name, attributes,
+                                   create_millis, create_time, create_date,
+                                   last_open_date, change_time, change_date,
+                                   size_bytes, first_cluster)
+    file._entry_start = entry_start
+    return file
+
+
+def _flatten_tree(root):
+    """
+    Yields (file, parent record number) pairs, parents always go before
+    their content
+    """
+    directories = collections.deque([(root, -1)])
+    record = 0
+    while directories:
+        directory, directory_record = directories.popleft()
+        for file in directory.content:
+            yield file, directory_record
+            if file.is_directory:
+                directories.append((file, record))
+            record += 1
+
+
+def write_index(index_path, fingerprint, root, directory_hashes,
+                digests=None):
+    """
+    Writes index of the tree, digests is dict of (algorithm, first
+    cluster, size) -> digest of the file content
+    """
+    records = list()
+    directories = [_DIRECTORY.pack(-1, *directory_hashes[id(root)])]
+    for record, (file, parent_record) in enumerate(_flatten_tree(root)):
+        records.append(_file_to_record(file, parent_record))
+        if id(file) in directory_hashes:
+            directories.append(
+                _DIRECTORY.pack(record, *directory_hashes[id(file)]))
+    _write_index_data(index_path, fingerprint, len(records),
+                      len(directories),
+                      b''.join(records) + b''.join(directories), digests)
+
+
+def _write_index_data(index_path, fingerprint, files_amount,
+                      directories_amount, tree_data, digests):
+    digests = digests or dict()
+    # unique per process, readers of the same image may rebuild it at once
+    temp_path = "{}.{:d}.tmp".format(index_path, os.getpid())
+    with open(temp_path, "wb") as index_file:
+        index_file.write(_HEADER.pack(INDEX_MAGIC, INDEX_VERSION,
+                                      fingerprint, files_amount,
+                                      directories_amount, len(digests)))
+        index_file.write(tree_data)
+        for (algorithm, first_cluster, size), digest in digests.items():
+            algorithm = algorithm.encode("utf-8")
+            index_file.write(_DIGEST.pack(first_cluster, size,
+                                          len(algorithm), len(digest)))
+            index_file.write(algorithm + digest)
+    os.replace(temp_path, index_path)
+
+
+def save_digests(index_path, index, digests):
+    """
+    Rewrites the index read earlier with digests added to its own ones
+    """
+    index.digests.update(digests)
+    _write_index_data(index_path, index.fingerprint, len(index.records),
+                      len(index.directory_hashes), index.tree_data,
+                      index.digests)
+
+
+def read_index(index_path):
+    """
+    Returns TreeIndex read from the file or None if there is no index
+    or it cannot be read
+    """
+    try:
+        with open(index_path, "rb") as index_file:
+            data = index_file.read()
+        return TreeIndex.from_bytes(data)
+    except (OSError, ValueError, struct.error, UnicodeDecodeError):
+        return None
+
+
+class TreeIndex:
+    def __init__(self, fingerprint, records, names, directory_hashes,
+                 digests=None, tree_data=b''):
+        self.fingerprint = fingerprint
+        self.records = records
+        self.names = names
+        self.directory_hashes = directory_hashes
+        # (algorithm, first cluster, size) -> digest of the content
+        self.digests = dict() if digests is None else digests
+        # records and directories as they are stored
+        self.tree_data = tree_data
+        self._children = None
+        self._directories_by_cluster = None
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, version, fingerprint, files_amount, directories_amount, \
+            digests_amount = _HEADER.unpack_from(data, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError("Unsupported index format")
+        pos = _HEADER.size
+
+        records = list()
+        names = list()
+        for _ in range(files_amount):
+            record = _RECORD.unpack_from(data, pos)
+            pos += _RECORD.size
+            short_name_end = pos + record[-2]
+            long_name_end = short_name_end + record[-1]
+            names.append((data[pos:short_name_end].decode("utf-8"),
+                          data[short_name_end:long_name_end].decode("utf-8")))
+            records.append(record)
+            pos = long_name_end
+
+        directory_hashes = dict()
+        directories_end = pos + directories_amount * _DIRECTORY.size
+        for record, directory_hash, chain_hash in _DIRECTORY.iter_unpack(
+                data[pos:directories_end]):
+            directory_hashes[record] = (directory_hash, chain_hash)
+        if len(directory_hashes) != directories_amount:
+            raise ValueError("Index is truncated")
+        tree_data = data[_HEADER.size:directories_end]
+
+        pos = directories_end
+        digests = dict()
+        for _ in range(digests_amount):
+            first_cluster, size, algorithm_length, digest_length = \
+                _DIGEST.unpack_from(data, pos)
+            pos += _DIGEST.size
+            algorithm = data[pos:pos + algorithm_length].decode("utf-8")
+            pos += algorithm_length
+            digests[(algorithm, first_cluster, size)] = \
+                data[pos:pos + digest_length]
+            pos += digest_length
+        if pos > len(data):
+            raise ValueError("Index is truncated")
+
+        return cls(fingerprint, records, names, directory_hashes, digests,
+                   tree_data)
+
+    def _make_file(self, record):
+        file = _record_to_file(self.records[record], *self.names[record])
+        if file.is_directory and file._start_cluster == 0:
+            file.content = list()
+        return file
+
+    def to_tree(self, root_first_cluster):
+        root = fsobjects.File("", "", fsobjects.DIRECTORY, None, None, None,
+                              0, root_first_cluster)
+        root.content = list()
+        files = list()
+        for record in range(len(self.records)):
+            file = self._make_file(record)
+            parent_record = self.records[record][0]
+            file.parent = root if parent_record < 0 else files[parent_record]
+            if file.is_directory:
+                file.content = list()
+            file.parent.content.append(file)
+            files.append(file)
+        return root
+
+    def _find_directory(self, directory):
+        """
+        Returns record of the directory with the same first cluster
+        (-1 for the root) or None if it is not indexed
+        """
+        if self._directories_by_cluster is None:
+            self._build_lookup()
+        if directory.parent is None:
+            return -1
+        return self._directories_by_cluster.get(directory._start_cluster)
+
+    def has_same_chains(self, fat_reader):
+        """
+        Tells whether cluster chains of all the indexed directories are the
+        same in the image, only the FAT entries of the chains are read
+        """
+        for record, (_, chain_hash) in self.directory_hashes.items():
+            first_cluster = fat_reader.root_catalog_first_cluster \
+                if record < 0 else self.records[record][1]
+            if get_chain_hash(
+                    fat_reader._get_cluster_chain(first_cluster)) != \
+                    chain_hash:
+                return False
+        return True
+
+    def get_directory_hash(self, directory, chain_hash):
+        """
+        Returns content hash of the directory indexed with the same cluster
+        chain or None
+        """
+        record = self._find_directory(directory)
+        if record is None or self.directory_hashes[record][1] != chain_hash:
+            return None
+        return self.directory_hashes[record][0]
+
+    def get_directory_content(self, directory, directory_hash):
+        """
+        Returns content of the directory from index if the directory
+        with the same first cluster and content hash is indexed, otherwise
+        None. Content of the returned subdirectories is not filled.
+        """
+        record = self._find_directory(directory)
+        if record is None or \
+                self.directory_hashes[record][0] != directory_hash:
+            return None
+        content = list()
+        for child_record in self._children[record]:
+            file = self._make_file(child_record)
+            file.parent = directory
+            content.append(file)
+        return content
+
+    def _build_lookup(self):
+        self._children = collections.defaultdict(list)
+        self._directories_by_cluster = dict()
+        for record, values in enumerate(self.records):
+            self._children[values[0]].append(record)
+        for record in self.directory_hashes:
+            if record >= 0:
+                self._directories_by_cluster[self.records[record][1]] = record
+
+    def __len__(self):
+        return len(self.records)
@@ -0,0 +1,266 @@
+# !/usr/bin/env python3
+"""
+Recovery of deleted files. Deleted (0xE5) entries and the LFN entries
+preceding them are gathered while directories are parsed and decoded
+in bulk. The FAT chain of a deleted file is cleared, so its content is
+assumed to be stored in consecutive clusters from the first one, which
+is checked against the runs of free clusters of the FAT (one pass over
+the FAT, then a binary search per file).
+"""
+import bisect
+import math
+import os
+import struct
+
+import fateditor
+import fsobjects
+
+RECOVERABLE = "recoverable"
+PARTIAL = "partial"
+OVERWRITTEN = "overwritten"
+EMPTY = "empty"
+# first name byte of the deleted entry when it cannot be guessed
+UNKNOWN_NAME_CHAR = b'_'
+READ_CHUNK_CLUSTERS = 256
+
+# name, attributes, reserved, creation ms, creation time and date,
+# last access date, first cluster (high), modification time and date,
+# first cluster (low), size
+_ENTRY = struct.Struct('<11sBBBHHHHHHHI')
+
+
+class DeletedFile:
+    def __init__(self, file, status, recoverable_bytes):
+        self.file = file
+        self.status = status
+        self.recoverable_bytes = recoverable_bytes
+
+    @property
+    def path(self):
+        return self.file.get_absolute_path()
+
+    def to_dict(self):
+        return {
+            "path": self.path,
+            "short_name": self.file.short_name,
+            "directory": self.file.is_directory,
+            "first_cluster": self.file._start_cluster,
+            "size": self.file._size_bytes,
+            "status": self.status,
+            "recoverable_bytes": self.recoverable_bytes,
+        }
+
+
+class UndeleteReport:
+    def __init__(self):
+        self.files = list()
+        # (directory path, name) of LFN entries without deleted short entry
+        self.orphan_names = list()
+
+    def to_dict(self):
+        return {
+            "files": [file.to_dict() for file in self.files],
+            "orphan_names": [{"directory": directory or "/", "name": name}
+                             for directory, name in self.orphan_names],
+        }
+
+    def get_report_str(self):
+        lines = ["{:<12} {:>12} {}".format(file.status,
+                                           file.file._size_bytes, file.path)
+                 for file in self.files]
+        lines += ["orphan LFN   {}/{}".format(directory, name)
+                  for directory, name in self.orphan_names]
+        lines.append("Deleted entries: {:d}, recoverable: {:d}, partially "
+                     "recoverable: {:d}, orphan long names: {:d}".format(
+                         len(self.files),
+                         sum(1 for file in self.files
+                             if file.status in (RECOVERABLE, EMPTY)),
+                         sum(1 for file in self.files
+                             if file.status == PARTIAL),
+                         len(self.orphan_names)))
+        return "\n".join(lines)
+
+
+class _FreeClusters:
+    """
+    Runs of free clusters searched by binary search
+    """
+
+    def __init__(self, runs):
+        self._starts = [start for start, _ in runs]
+        self._ends = [start + length for start, length in runs]
+
+    def get_free_length(self, cluster):
+        """
+        Returns amount of free clusters starting from the cluster
+        """
+        run = bisect.bisect_right(self._starts, cluster) - 1
+        if run < 0 or cluster >= self._ends[run]:
+            return 0
+        return self._ends[run] - cluster
+
+
+def get_raw_name_checksum(raw_name):
+    checksum = 0
+    for byte in raw_name:
+        checksum = (((checksum & 1) << 7) + (checksum >> 1) + byte) & 0xFF
+    return checksum
+
+
+def guess_first_name_byte(raw_name, long_name, lfn_checksum):
+    """
+    Returns the first byte of the short name replaced by 0xE5, it is found
+    by the checksum stored in the LFN entries if there are any
+    """
+    if not long_name:
+        return UNKNOWN_NAME_CHAR
+    guess = long_name[0].upper().encode("cp866", "replace")[:1]
+    candidates = [guess] + [bytes([byte]) for byte in range(0x21, 0x100)]
+    for candidate in candidates:
+        if get_raw_name_checksum(candidate + raw_name[1:]) == lfn_checksum:
+            return candidate
+    return UNKNOWN_NAME_CHAR
+
+
+def _decode_short_name(raw_name, is_directory):
+    name = raw_name[:8].decode("cp866", "replace").strip()
+    extension = raw_name[8:].decode("cp866", "replace").strip()
+    return name + ("." + extension if extension and not is_directory
+                   else "")
+
+
+def _iter_deleted_files(deleted_entries, report):
+    """
+    Yields files of the deleted short entries, long names are taken from
+    the deleted LFN entries right before them. LFN entries not followed by
+    a matching short entry are added to the report as orphan names.
+    """
+    raw_entries = b''.join(entry for _, _, entry in deleted_entries)
+    lfn_parts = list()
+    lfn_checksum = -1
+    lfn_directory = None
+    lfn_end = -1
+
+    def add_orphan_name():
+        report.orphan_names.append((lfn_directory.get_absolute_path(),
+                                    "".join(lfn_parts)))
+
+    for (directory, start, entry), values in zip(
+            deleted_entries, _ENTRY.iter_unpack(raw_entries)):
+        (raw_name, attributes, _, create_millis, create_time, create_date,
+         last_open_date, cluster_high, change_time, change_date,
+         cluster_low, size) = values
+        if lfn_parts and (directory is not lfn_directory or
+                          start != lfn_end):
+            add_orphan_name()
+            lfn_parts = list()
+        if attributes == fsobjects.LFN:
+            lfn_part, lfn_checksum = fateditor.get_lfn_part(entry)
+            lfn_parts.insert(0, lfn_part)
+            lfn_directory = directory
+            lfn_end = start + fateditor.BYTES_PER_DIR_ENTRY
+            continue
+        if attributes & fsobjects.VOLUME_ID:
+            lfn_parts = list()
+            continue
+        long_name = "".join(lfn_parts)
+        first_byte = guess_first_name_byte(raw_name, long_name, lfn_checksum)
+        if long_name and first_byte == UNKNOWN_NAME_CHAR:
+            add_orphan_name()
+            long_name = ""
+        lfn_parts = list()
+        is_directory = bool(attributes & fsobjects.DIRECTORY)
+        file = fsobjects.File.from_raw(
+            _decode_short_name(first_byte + raw_name[1:], is_directory),
+            long_name, attributes, create_millis, create_time, create_date,
+            last_open_date, change_time, change_date, size,
+            fateditor.format_fat_address(cluster_high << 16 | cluster_low))
+        file.parent = directory
+        yield file
+    if lfn_parts:
+        add_orphan_name()
+
+
+def scan(fat_reader, root=None):
+    """
+    Returns UndeleteReport of the deleted entries of the image. The tree
+    is parsed again unless the root is given, deleted entries of the
+    directories parsed before are not known.
+    """
+    fat_reader.deleted_entries = list()
+    try:
+        if root is None:
+            root = fat_reader.get_root_directory()
+        deleted_entries = fat_reader.deleted_entries
+    finally:
+        fat_reader.deleted_entries = None
+    free_clusters = _FreeClusters(fat_reader.get_free_cluster_runs())
+    cluster_size = fat_reader.get_cluster_size()
+
+    report = UndeleteReport()
+    for file in _iter_deleted_files(deleted_entries, report):
+        size = file._size_bytes
+        # size of a directory is not stored, its first cluster is checked
+        clusters = 1 if file.is_directory else \
+            math.ceil(size / cluster_size)
+        free = free_clusters.get_free_length(file._start_cluster)
+        if file._start_cluster < 2 or clusters == 0:
+            status = EMPTY if clusters == 0 else OVERWRITTEN
+            recoverable_bytes = 0
+        elif free >= clusters:
+            status, recoverable_bytes = RECOVERABLE, size
+        elif free > 0:
+            status, recoverable_bytes = PARTIAL, free * cluster_size
+        else:
+            status, recoverable_bytes = OVERWRITTEN, 0
+        report.files.append(DeletedFile(file, status, recoverable_bytes))
+    return report
+
+
+def recover(fat_reader, deleted_file, output_path):
+    """
+    Writes recoverable content of the deleted file to the host file,
+    returns amount of written bytes
+    """
+    file = deleted_file.file
+    left = deleted_file.recoverable_bytes
+    cluster = file._start_cluster
+    chunk_size = fat_reader.get_cluster_size() * READ_CHUNK_CLUSTERS
+    with open(output_path, "wb") as output:
+        while left > 0:
+            clusters = math.ceil(min(left, chunk_size) /
+                                 fat_reader.get_cluster_size())
+            data = fat_reader._get_cluster_run_data(cluster, clusters)
+            output.write(data[:left])
+            left -= min(left, len(data))
+            cluster += clusters
+    return deleted_file.recoverable_bytes
+
+
+def _get_free_path(path):
+    base, extension = os.path.splitext(path)
+    number = 1
+    while os.path.lexists(path):
+        path = "{}~{:d}{}".format(base, number, extension)
+        number += 1
+    return path
+
+
+def recover_all(fat_reader, report, output_dir):
+    """
+    Recovers all the deleted files which are not overwritten to the
+    directory keeping their paths, returns list of (path, host path).
+    Deleted directories are not recovered.
+    """
+    recovered = list()
+    for deleted_file in report.files:
+        if deleted_file.file.is_directory or \
+                deleted_file.status == OVERWRITTEN:
+            continue
+        path = os.path.join(output_dir,
+                            *deleted_file.path.strip("/").split("/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        path = _get_free_path(path)
+        recover(fat_reader, deleted_file, path)
+        recovered.append((deleted_file.path, path))
+    return recovered